@@ -18,25 +18,100 @@ webbrowser with application landing page).
 # OTHER DEALINGS IN THE SOFTWARE.
 # -----------------------------------------------------------------------------------------------------------------------
 
+import argparse
+import hashlib
+import os
+import subprocess
+import sys
+import time
 import venv
+import webbrowser
+from os.path import dirname, abspath, exists, join
+from urllib.error import URLError
+from urllib.request import urlopen
+
+
+PORT = 8000
+READINESS_URL = 'http://localhost:{}/metrics'.format(PORT)  # served once whole app is loaded
+READINESS_TIMEOUT = 30  # seconds
+READINESS_INTERVAL = 0.05  # seconds between probes
+REQUIREMENTS_HASH_FILE = 'requirements.sha256'  # kept in venv, it's reused as long as the hash is the same
+
+
+class _Timings():
+    """Startup timing breakdown (durations of bootstrap phases)"""
+
+    def __init__(self):
+        self._started, self._phases = time.perf_counter(), []
+
+    def phase(self, name, started):
+        self._phases.append((name, time.perf_counter() - started))
+
+    def report(self):
+        print("\n--> Startup timing breakdown:\n")
+        for name, seconds in self._phases + [('total', time.perf_counter() - self._started)]:
+            print("  {:<24} {:>8.2f}s".format(name, seconds))
+
+
+def _requirements_hash(requirements_path):
+    """Returns hash of requirements (and of python version, as venv is bound to it)"""
+    with open(requirements_path, 'rb') as requirements:
+        content = requirements.read()
+    return hashlib.sha256(content + sys.version.encode('utf-8')).hexdigest()
 
-import subprocess
+
+def prepare_venv(venv_path, requirements_path, offline=False, wheels_path=None):
+    """
+    Prepares dedicated virtualenv with installed requirements, unless it's been already prepared for the same ones
+    (then it's just reused). Pip is installed by bundled ensurepip (no download), requirements are installed from
+    given wheels directory (if it exists) and from package index, unless offline (then only wheels are used).
+    :return: Tuple of path to venv's python executable and whether venv has been reused.
+    """
+    python_path = join(venv_path, 'bin', 'python3')
+    hash_path, requirements_hash = join(venv_path, REQUIREMENTS_HASH_FILE), _requirements_hash(requirements_path)
+    if exists(python_path) and exists(hash_path):
+        with open(hash_path) as hash_file:
+            if hash_file.read().strip() == requirements_hash:
+                return python_path, True
+    venv.EnvBuilder(system_site_packages=offline, clear=True, symlinks=True, with_pip=True).create(venv_path)
+    command = [python_path, '-m', 'pip', 'install', '--disable-pip-version-check', '-r', requirements_path]
+    if wheels_path and exists(wheels_path):
+        command += ['--find-links', wheels_path]
+    if offline:
+        command += ['--no-index']
+    subprocess.run(command, check=True)
+    with open(hash_path, 'w') as hash_file:  # written last, so venv is prepared again if installation is interrupted
+        hash_file.write(requirements_hash)
+    return python_path, False
 
 
-def bootstrap(project_path, app_path, test_path, venv_path):
+def wait_until_ready(process, url=READINESS_URL, timeout=READINESS_TIMEOUT):
     """
-    Bootstrap python app (checking compatibility issues, prepares dedicated virtualnenv, runs tests starts webserver,
-    opens webbrowser with landing page)
+    Probes (frequently) whether webserver started by given process responds properly to given URL (connection is
+    refused until its port is open), returns False if it's not ready in given time or if its process has terminated.
+    """
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline and process.poll() is None:
+        try:
+            with urlopen(url, timeout=timeout) as response:
+                return response.status == 200
+        except (OSError, URLError):
+            time.sleep(READINESS_INTERVAL)
+    return False
+
+
+def bootstrap(project_path, app_path, test_path, venv_path, offline=False, tests=True, browser=True, limits=None):
+    """
+    Bootstrap python app (checking compatibility issues, prepares dedicated virtualnenv or reuses one prepared for the
+    same requirements, runs tests starts webserver - with given admission limits, i.e. rate - and waits until it's
+    ready, opens webbrowser with landing page)
     """
 
     print("\n+-------------------------------------------------------------------------+"
           "\n| -=((( The Ultimate PythonApp Bootstrap ;)))=-  (C) 2017 Krystian Rembas |"
           "\n+----------------------------<  HINT: Press CTRL-C to exit anytime... >---+\n")
-    time.sleep(1)
     print("...Brace yourselves! Awesome is coming! ;)\n")
-    time.sleep(2)
-    PYTHON_EXE_PATH = join(venv_path, 'bin', 'python3')
-    PIP_EXE_PATH = join(venv_path, 'bin', 'pip3')
+    timings = _Timings()
 
     print("\n--> Examining your system for compatibility issues...\n")
     if os.name == 'nt':
@@ -44,50 +119,64 @@ def bootstrap(project_path, app_path, test_path, venv_path):
         return -1
 
     print("\n--> Preparing runtime environment...\n")
-    env_builder = venv.EnvBuilder(system_site_packages=False, clear=False, symlinks=True)
-    env_builder.create(venv_path)
-    getpip_path = join(venv_path, 'bin', 'get-pip.py')
-    urlretrieve('https://bootstrap.pypa.io/get-pip.py', getpip_path)  # download pip bootstrap
-    os.system(PYTHON_EXE_PATH + ' {}'.format(getpip_path))
-    os.unlink(getpip_path)  # clean up, no longer needed
-    os.system(PIP_EXE_PATH + ' install -r {}'.format(join(project_path, 'requirements.txt'))),
-
-    print("\n--> Running the tests and source code syntax/style validator...\n")
-    os.system(PYTHON_EXE_PATH + ' -m flake8 ' + app_path)
-    os.system(PYTHON_EXE_PATH + ' -c "import pytest; pytest.main([\'-v\', \'{}\'])"'.format(test_path))
-    print("\n--> Starting webserwer that serves app (@localhost:8000)...\n")
+    started = time.perf_counter()
     try:
-        sp = subprocess.Popen([PYTHON_EXE_PATH, '-c', 'import app; app.serve()'], cwd=app_path, stdout=subprocess.PIPE)
-    except Exception:
-        raise
+        python_path, reused = prepare_venv(venv_path, join(project_path, 'requirements.txt'), offline,
+                                           wheels_path=join(project_path, 'wheels'))
+    except subprocess.CalledProcessError as error:
+        print(" (!) Installing requirements failed{}, exiting now".format(
+            " (only wheels from 'wheels' directory are used offline)" if offline else ""))
+        return error.returncode
+    print("  [DONE] Virtualenv {} ({})".format("reused, requirements are unchanged" if reused else "prepared", venv_path))
+    timings.phase('runtime environment', started)
+
+    if tests:
+        print("\n--> Running the tests and source code syntax/style validator...\n")
+        started = time.perf_counter()
+        subprocess.run([python_path, '-m', 'flake8', app_path])
+        subprocess.run([python_path, '-m', 'pytest', '-q', test_path], cwd=app_path)
+        timings.phase('tests', started)
+
+    print("\n--> Starting webserwer that serves app (@localhost:{})...\n".format(PORT))
+    started = time.perf_counter()
+    arguments = ', '.join('{}={!r}'.format(name, value) for name, value in sorted((limits or {}).items()) if value is not None)
+    sp = subprocess.Popen([python_path, '-c', 'import app; app.serve({})'.format(arguments)], cwd=app_path)
     print("  [IN PROGRESS] Webserver's PID is {}".format(str(sp.pid)))
-    time.sleep(3)  # give sometime to fully run server
-    rc = sp.poll()
-    if rc is not None:
-        print("oops.. webserver terminated - sth gone wrong, exiting\n")
-        sys.exit(rc)
+    if not wait_until_ready(sp):
+        print("oops.. webserver terminated or is not ready in {}s - sth gone wrong, exiting\n".format(READINESS_TIMEOUT))
+        sp.terminate()
+        return sp.wait() or -1
+    timings.phase('webserver readiness', started)
+    timings.report()
 
-    print("\n--> Opening web browser with app's landing page...\n")
-    try:
-        webbrowser.open('http://localhost:8000/', new=1)
-    except Exception:
-        raise
+    if browser:
+        print("\n--> Opening web browser with app's landing page...\n")
+        webbrowser.open('http://localhost:{}/'.format(PORT), new=1)
     print("\n--> ALL DONE! Stop the server at any time and exit by pressing CTRL-C...\n")
-    sp.wait()
+    try:
+        return sp.wait()
+    except KeyboardInterrupt:
+        sp.terminate()
+        return sp.wait()
 
 
 if __name__ == '__main__':
-    import sys
-    import time
-    import os
-    import webbrowser
-    from os.path import dirname, abspath, join
-    from urllib.request import urlretrieve
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--offline', action='store_true',
+                        help="don't use package index (requirements are installed from 'wheels' directory, system "
+                             "site packages are visible in virtualenv)")
+    parser.add_argument('--no-tests', dest='tests', action='store_false', help="don't run tests before starting app")
+    parser.add_argument('--no-browser', dest='browser', action='store_false', help="don't open web browser")
+    parser.add_argument('--rate', type=float,
+                        help="rate limit every client to given number of requests per second (not limited by default)")
+    parser.add_argument('--burst', type=int, help="how many requests of rate limited client may come at once")
+    args = parser.parse_args()
 
     PROJECT_ROOT_PATH = dirname(dirname(abspath(__file__)))
     APP_ROOT_PATH = join(PROJECT_ROOT_PATH, 'app')
     VENV_PATH = join(PROJECT_ROOT_PATH, '.venv')
     TEST_FILE_PATH = join(APP_ROOT_PATH, 'tests.py')
 
-    sys.exit(bootstrap(project_path=PROJECT_ROOT_PATH, app_path=APP_ROOT_PATH,
-                       test_path=TEST_FILE_PATH, venv_path=VENV_PATH))
+    sys.exit(bootstrap(project_path=PROJECT_ROOT_PATH, app_path=APP_ROOT_PATH, test_path=TEST_FILE_PATH,
+                       venv_path=VENV_PATH, offline=args.offline, tests=args.tests, browser=args.browser,
+                       limits={'rate': args.rate, 'burst': args.burst}))
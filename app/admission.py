@@ -0,0 +1,218 @@
+"""
+Admission control of requests (bounded number of requests in flight, per-client rate limiting and priorities), so
+under overload excess requests are rejected fast instead of queueing up and slowing down all of them.
+"""
+# Copyright (C) 2017 Krystian Rembas
+# -----------------------------------------------------------------------------------------------------------------------
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+# CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# -----------------------------------------------------------------------------------------------------------------------
+
+
+import threading
+import time
+from math import ceil
+
+from falcon import HTTPServiceUnavailable, HTTPTooManyRequests, HTTP_429, HTTP_503
+
+
+MAX_IN_FLIGHT = 16  # requests handled at once (by a process), as many as threads of production webserver's worker
+ASYNC_MAX_IN_FLIGHT = 1024  # ...by asyncio event loop (they mostly wait for I/O, so it's many more than threads)
+LOW_SHARE = 0.5  # part of them that may be taken by low priority requests (so high priority ones always have room)
+MAX_QUEUE = 64  # requests that may wait for their turn (others are rejected at once)
+MAX_WAIT = 1.0  # seconds that request may wait for its turn (then it's rejected)
+RATE = None  # requests per second allowed for every client (on average), None - clients are not rate limited (opt-in)
+BURST = 100  # how many requests of client may come at once (if it's rate limited)
+MAX_CLIENTS = 100000  # clients which rate is tracked (buckets of the least recently seen ones are dropped)
+RETRY_AFTER = 1  # seconds that rejected client should wait (unless it's rate limited, then it's when it has a token)
+
+HIGH, LOW = 0, 1  # priorities of requests
+PRIORITIES = ('high', 'low')
+REASONS = ('rate_limited', 'overloaded', 'timed_out')  # why requests are rejected
+LIMITS = ('max_in_flight', 'low_share', 'max_queue', 'max_wait', 'rate', 'burst', 'max_clients', 'retry_after')
+
+ERRORS = {HTTP_429: 'Too many requests, retry after {} seconds', HTTP_503: 'Service is overloaded, retry after {} seconds'}
+
+controls = {}  # all admission controls by name (their statistics are exported by metrics)
+
+
+def check_rate(rate, burst):
+    """Raises ValueError if given rate limit can't admit any request (clients would never get a token)"""
+    if rate is not None and (rate <= 0 or burst < 1):
+        raise ValueError('Rate must be positive and burst at least 1 (or rate None to not limit it), got: rate={}, '
+                         'burst={}'.format(rate, burst))
+
+
+class AdmissionControl():
+    """
+    Admission control of requests handled by a process. If rate is given, every client has a token bucket (rate tokens
+    added per second, at most burst of them) and its request takes a token or it's rejected with 429 Too Many Requests
+    (rate_limited).
+    At most max_in_flight requests are handled at once (low priority ones may take only low_share of them), others wait
+    for their turn (high priority ones first) unless max_queue of them are waiting already (overloaded) or they've
+    waited for max_wait seconds (timed_out), then they're rejected with 503 Service Unavailable. Rejection is cheap, so
+    excess requests are shed fast instead of queueing up and slowing down all of them.
+    """
+
+    def __init__(self, name, max_in_flight=MAX_IN_FLIGHT, low_share=LOW_SHARE, max_queue=MAX_QUEUE, max_wait=MAX_WAIT,
+                 rate=RATE, burst=BURST, max_clients=MAX_CLIENTS, retry_after=RETRY_AFTER):
+        check_rate(rate, burst)
+        self.name, self.max_in_flight, self.low_share, self.max_queue = name, max_in_flight, low_share, max_queue
+        self.max_wait, self.rate, self.burst, self.max_clients = max_wait, rate, burst, max_clients
+        self.retry_after = retry_after
+        self._buckets = {}  # (tokens, time they were counted) by client, the least recently seen first
+        self._turn = threading.Condition(threading.Lock())  # notified whenever request is released
+        self.in_flight, self._waiting = 0, [0] * len(PRIORITIES)
+        self.admitted = [0] * len(PRIORITIES)
+        self.rejected = {(reason, priority): 0 for reason in REASONS for priority in range(len(PRIORITIES))}
+        controls[name] = self
+
+    def configure(self, **limits):
+        """Sets given limits (i.e. rate=50, burst=100 - see LIMITS), clients' buckets are refilled"""
+        unknown = set(limits) - set(LIMITS)
+        if unknown:
+            raise TypeError('Unknown admission limit(s): {}'.format(', '.join(sorted(unknown))))
+        check_rate(limits.get('rate', self.rate), limits.get('burst', self.burst))
+        with self._turn:
+            for name, value in limits.items():
+                setattr(self, name, value)
+            self._buckets.clear()
+            self._turn.notify_all()  # (waiting requests may enter if in flight limit has been raised)
+
+    def admit(self, client, priority=HIGH, wait=True):
+        """
+        Admits request of given client with given priority (waiting for its turn, unless wait is False). Admitted
+        request has to be released once it's handled.
+        :return: None if request is admitted or tuple of HTTP status and seconds to retry after if it's rejected.
+        """
+        with self._turn:
+            retry_after = self._take_token(client, time.monotonic())
+            if retry_after:
+                return self._reject('rate_limited', priority, HTTP_429, retry_after)
+            if not self._may_enter(priority):
+                if not wait or sum(self._waiting) >= self.max_queue:
+                    return self._reject('overloaded', priority, HTTP_503, self.retry_after)
+                if not self._wait(priority):
+                    return self._reject('timed_out', priority, HTTP_503, self.retry_after)
+            self.in_flight += 1
+            self.admitted[priority] += 1
+        return None
+
+    def release(self):
+        """Releases admitted request (once it's been handled), so waiting ones may enter"""
+        with self._turn:
+            self.in_flight -= 1
+            if any(self._waiting):
+                self._turn.notify_all()  # (not just one, as it may be low priority one that can't enter yet)
+
+    def _take_token(self, client, now):
+        """Takes token from bucket of given client, returns 0 or seconds until it has one (if it has none now)"""
+        if self.rate is None:
+            return 0
+        tokens, counted = self._buckets.pop(client, (self.burst, now))  # (inserted again, as the most recently seen)
+        tokens = min(self.burst, tokens + (now - counted) * self.rate)
+        if tokens < 1:
+            self._buckets[client] = tokens, now
+            return ceil((1 - tokens) / self.rate)
+        self._buckets[client] = tokens - 1, now
+        if len(self._buckets) > self.max_clients:
+            del self._buckets[next(iter(self._buckets))]
+        return 0
+
+    def _may_enter(self, priority):
+        """Returns whether request with given priority may be handled now (should be called with lock acquired)"""
+        if priority == HIGH:
+            return self.in_flight < self.max_in_flight
+        return self.in_flight < self.max_in_flight * self.low_share and not self._waiting[HIGH]
+
+    def _wait(self, priority):
+        """Waits for turn of request with given priority (with lock acquired), returns False if it's waited too long"""
+        deadline = time.monotonic() + self.max_wait
+        self._waiting[priority] += 1
+        try:
+            while not self._may_enter(priority):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._turn.wait(remaining)
+            return True
+        finally:
+            self._waiting[priority] -= 1
+
+    def _reject(self, reason, priority, status, retry_after):
+        self.rejected[reason, priority] += 1
+        return status, retry_after
+
+    def stats(self):
+        """Returns statistics of admission (as a dict) - requests in flight and waiting, admitted and rejected ones"""
+        with self._turn:
+            return {'in_flight': self.in_flight, 'queued': sum(self._waiting),
+                    'admitted': dict(zip(PRIORITIES, self.admitted)),
+                    'rejected': {reason: {name: self.rejected[reason, priority] for priority, name in enumerate(PRIORITIES)}
+                                 for reason in REASONS}}
+
+
+def rejection(status, retry_after):
+    """Returns HTTP error (with Retry-After header) for request rejected with given status"""
+    error = HTTPTooManyRequests if status == HTTP_429 else HTTPServiceUnavailable
+    return error(description=ERRORS[status].format(retry_after), retry_after=retry_after)
+
+
+class _AdmittedStream():
+    """Response stream of admitted request that releases it once the stream is read to the end or closed"""
+
+    def __init__(self, stream, release):
+        self._stream, self._release = stream, release
+
+    def read(self, size=-1):
+        chunk = self._stream.read(size)
+        if not chunk:
+            self.close()
+        return chunk
+
+    def close(self):
+        release, self._release = self._release, None
+        if release is not None:
+            release()
+        if hasattr(self._stream, 'close'):
+            self._stream.close()
+
+
+class Admission():
+    """
+    Falcon middleware that admits requests by given admission control with priority returned by given function (of
+    request method, url template and query parameters, requests which priority is None are not controlled). Rejected
+    ones get 429 Too Many Requests or 503 Service Unavailable with Retry-After header, streamed responses are in flight
+    until they're sent.
+    """
+
+    def __init__(self, control, priority):
+        self._control, self._priority = control, priority
+
+    def process_resource(self, request, response, resource, params):
+        priority = self._priority(request.method, request.uri_template, request.params)
+        if priority is None:
+            return
+        rejected = self._control.admit(request.remote_addr, priority)
+        if rejected is not None:
+            raise rejection(*rejected)
+        request.context['admitted'] = True
+
+    def process_response(self, request, response, resource, request_succeeded):
+        if not request.context.get('admitted'):
+            return
+        request.context['admitted'] = False
+        if response.stream is not None:
+            response.stream = _AdmittedStream(response.stream, self._control.release)
+        else:
+            self._control.release()
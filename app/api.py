@@ -1,5 +1,6 @@
 """
-API handlers definition (de-coupled from request handlers, can be used for CLI API as well).
+API handlers definition (de-coupled from request handlers, can be used for CLI API as well - they return data, except
+retrieve_invitees_encoded which is retrieve_invitees for HTTP routes, returning encoded or streamed responses).
 """
 # Copyright (C) 2017 Krystian Rembas
 # -----------------------------------------------------------------------------------------------------------------------
@@ -17,48 +18,335 @@ API handlers definition (de-coupled from request handlers, can be used for CLI A
 # OTHER DEALINGS IN THE SOFTWARE.
 # -----------------------------------------------------------------------------------------------------------------------
 
+import time
 
-from validators import existing_invitee, nonexisting_invitee, email
+from falcon import HTTP_304, HTTP_400, HTTP_409, HTTP_410, HTTP_412
+
+from validators import existing_invitee, nonexisting_invitee, email, page_size, cursor, cursor_of, batch, invitees
+from validators import prefix, list_version, expiry, ttl, EXISTING_INVITEE_ERROR, MISSING_INVITEE_ERROR
+from validators import validate_batch, ConflictErrors
+from cache import ResponseCache
+from compression import CODINGS, coded_etag
 from models import Invitee
+from outputs import EncodedJSON
+from stores import StoreChangesExpired, StoreUniqueConflict, StoreVersionConflict, current_namespace
+
+
+CHANGED_INVITEE_ERROR = 'Invitee has been changed in the meantime (If-Match precondition failed)'
+EXPIRED_CHANGES_ERROR = 'Changes since version {} are not available anymore, retrieve the whole list again (full resync)'
+
+
+# Conditional requests (ETag response header is a version of invitee or of the whole list, so it can be passed back in
+# If-None-Match header to get 304 Not Modified if nothing has changed or in If-Match one to change only unchanged data)
+
+def _etag(version):
+    """Returns ETag (response header value) of given version"""
+    return '"{}"'.format(version)
+
+
+def _etag_matches(header, version, weak=False):
+    """
+    Returns whether If-Match / If-None-Match header value (list of ETags or '*') matches given version (ETags of
+    compressed responses - with content coding suffix - included)
+    """
+    tags = {tag.strip() for tag in header.split(',')}
+    if weak:
+        tags |= {tag[2:] for tag in tags if tag.startswith('W/')}
+    etag = _etag(version)
+    return '*' in tags or etag in tags or any(coded_etag(etag, coding) in tags for coding in CODINGS)
+
+
+def _not_modified(request, response, version):
+    """Sets ETag response header and returns whether request has If-None-Match header that matches given version"""
+    if response is not None:
+        response.set_header('ETag', _etag(version))
+    header = request.get_header('If-None-Match') if request is not None else None
+    if header is not None and _etag_matches(header, version, weak=True):
+        if response is not None:
+            response.status = HTTP_304
+        return True
+    return False
+
+
+def _expected_version(request, instance):
+    """
+    Returns version that instance has to have to be changed according to If-Match request header (None if there is no
+    such header). Raises StoreVersionConflict if instance doesn't have any of versions listed in the header already.
+    """
+    header = request.get_header('If-Match') if request is not None else None
+    if header is None:
+        return None
+    if not _etag_matches(header, instance.version):
+        raise StoreVersionConflict(instance.invitee)
+    return instance.version
+
+
+def _precondition_failed(response):
+    """Returns 412 Precondition Failed for write rejected as If-Match request header doesn't match version of invitee"""
+    if response is not None:
+        response.status = HTTP_412
+    return {'errors': {'invitee': CHANGED_INVITEE_ERROR}}
+
+
+def _conflict(response, conflict):
+    """Returns 409 Conflict for write rejected by unique index (i.e. if Invitee email index is declared unique)"""
+    if response is not None:
+        response.status = HTTP_409
+    return {'errors': {conflict.field: str(conflict)}}
+
+
+def _expiry_fields(expires, ttl):
+    """Returns expiry field of invitee data (for expiry time given explicitly or ttl seconds from now, if any is given)"""
+    if ttl is not None:
+        expires = time.time() + ttl
+    return {} if expires is None else {'expires': expires}
+
+
+# Caches of encoded responses (single invitees and pages of lists of current namespace, entries are valid only for the
+# version of invitee or of the whole list, so they're never stale, but writes drop them early anyway - any write may
+# change any list)
+
+invitee_responses = ResponseCache('invitee', max_entries=100000)
+list_responses = ResponseCache('list', max_entries=1000)
+
+
+def _invalidate_responses(keys):
+    namespace = current_namespace.get()
+    invitee_responses.invalidate((namespace, key) for key in keys)
+    list_responses.invalidate()
+
+
+Invitee.listeners.append(_invalidate_responses)
+
+
+def _retrieve_page(email, prefix, after, limit):
+    """Returns page of invitees list and pk of the last one (None if there is nothing more to retrieve)"""
+    if email is None:
+        return Invitee.select(after=after, limit=limit, prefix=prefix)
+    # invitees sharing an email are few, so they're filtered (and paginated) after lookup
+    invitees = [data for data in Invitee.find('email', email)
+                if data['invitee'].startswith(prefix or '') and (after is None or data['invitee'] > after)]
+    last = invitees[limit - 1]['invitee'] if limit is not None and len(invitees) > limit else None
+    return invitees[:limit], last
+
+
+def _retrieve_changes(since, response):
+    """Returns changes of invitees list made after given version (or 410 Gone if they're not kept anymore)"""
+    try:
+        version, changes = Invitee.changes(since)
+    except StoreChangesExpired:
+        if response is not None:
+            response.status = HTTP_410
+        return {'errors': {'since': EXPIRED_CHANGES_ERROR.format(since)}}
+    return {'version': version, 'changes': changes}
 
 
 # Request handlers
 
-def retrieve_invitees(invitee: existing_invitee=None):
+def retrieve_invitees(invitee: existing_invitee=None, limit: page_size=None, after: cursor=None, email: email=None,
+                      prefix: prefix=None, since: list_version=None, request=None, response=None):
+    """
+    Retrieves invitees data (the same way as retrieve_invitees_encoded, with the same parameters) as it is - invitee
+    data, list of invitees data (retrieved at once) or changes of the list, i.e. for CLI API.
+    """
+    if invitee is not None:
+        instance = Invitee(invitee=invitee)
+        return None if _not_modified(request, response, instance.version) else instance.get()
+    if _not_modified(request, response, Invitee.current_version()):  # version is taken before data, never newer
+        return None
+    if since is not None:
+        return _retrieve_changes(since, response)
+    invitees, last = _retrieve_page(email, prefix, after, limit)
+    if last is not None and response is not None:
+        response.set_header('X-Next-Cursor', cursor_of(last))
+    return invitees
+
+
+def retrieve_invitees_encoded(invitee: existing_invitee=None, limit: page_size=None, after: cursor=None,
+                              email: email=None, prefix: prefix=None, since: list_version=None, request=None,
+                              response=None):
     """
     Retrieves invitees data.
 
     If parameter 'invitee' is provided (with proper invitee name, existing in system) then as a result invitee data
-    is returned, otherwise list of all invitee data records is returned or None if no data exists in system.
+    is returned, otherwise list of all invitee data records is returned (empty if no data exists in system).
+    List may be narrowed to invitees with given 'email' and / or to ones which name starts with given 'prefix' (both
+    are looked up in indexes, so they don't scan all invitees).
+    List may be paginated with 'limit' (page size) and 'after' (cursor taken from X-Next-Cursor response header,
+    which is present only if there are more invitees to retrieve).
+    If parameter 'since' is provided (version of the list - its ETag or version returned by previous call) then only
+    changes made after it are returned (delta sync) - changed invitees data along with tombstones of deleted ones
+    ({"invitee": ..., "deleted": true}) and version of the list they're up to, unless they're too old to be retrieved,
+    then 410 Gone is returned (so client should retrieve the whole list instead).
+    Response has ETag header (version of invitee or of the whole list), if it matches If-None-Match request header
+    then nothing is retrieved and 304 Not Modified is returned.
+    Invitee and pages of list are encoded once per version and then served from cache (whole list is streamed).
+    Invitees which invitation has expired are never retrieved (they're deleted as soon as they expire).
     """
-    return Invitee(invitee=invitee).get()
+    if invitee is not None:
+        instance = Invitee(invitee=invitee)
+        if _not_modified(request, response, instance.version):
+            return None
+        key = (current_namespace.get(), str(invitee))
+        cached = invitee_responses.get(key, instance.version)
+        if cached is not None:
+            return EncodedJSON(cached[0])
+        return EncodedJSON(invitee_responses.put(key, instance.version, EncodedJSON.encode(instance.get())))
+    version = Invitee.current_version()
+    if _not_modified(request, response, version):  # version is taken before data, never newer
+        return None
+    if since is not None:
+        return _retrieve_changes(since, response)
+    if limit is None and after is None and email is None:
+        return Invitee.iterate(prefix=prefix)  # lazily, so the whole list may be streamed
+    query = (current_namespace.get(), email, prefix, after, limit)
+    cached = list_responses.get(query, version)
+    if cached is not None:
+        body, headers = cached
+    else:
+        invitees, last = _retrieve_page(email, prefix, after, limit)
+        headers = () if last is None else (('X-Next-Cursor', cursor_of(last)),)
+        body = list_responses.put(query, version, EncodedJSON.encode(invitees), headers)
+    if response is not None:
+        for name, value in headers:
+            response.set_header(name, value)
+    return EncodedJSON(body)
 
 
-def create_invitee(invitee: nonexisting_invitee, email: email):
+def create_invitee(invitee: nonexisting_invitee, email: email, expires: expiry=None, ttl: ttl=None, response=None):
     """
     Creates invitee data.
 
     Validates if invitee is a text and email format is proper (and then stores new invitee record) then returns
     appropriate response with HTTP status code & response data.
+    Invitee is created atomically only if it doesn't exist, so if it's been created concurrently (after validation),
+    it's not overwritten and the same error as by validation is returned.
+    Invitation may expire at given time ('expires' - UNIX timestamp) or after given number of seconds ('ttl', it takes
+    precedence), then invitee is deleted.
     """
-    return Invitee(invitee=invitee, email=email).save()
+    instance = Invitee(invitee=invitee, email=email, **_expiry_fields(expires, ttl))
+    try:
+        data = instance.create()
+    except StoreVersionConflict:
+        if response is not None:
+            response.status = HTTP_400
+        return {'errors': {'invitee': EXISTING_INVITEE_ERROR.format(invitee)}}
+    except StoreUniqueConflict as conflict:
+        return _conflict(response, conflict)
+    if response is not None:
+        response.set_header('ETag', _etag(instance.version))
+    return data
 
 
-def update_invitee(invitee: existing_invitee, email: email):
+def update_invitee(invitee: existing_invitee, email: email, expires: expiry=None, ttl: ttl=None, request=None,
+                   response=None):
     """
     Updates invitee data.
 
     Validates if invitee does not existing yet and email format is proper (and then stores new invitee record)
     then returns appropriate response with HTTP status code & response data.
+    If If-Match request header is given, invitee is updated only if its version (ETag) still matches the header,
+    otherwise 412 Precondition Failed is returned.
+    Expiry time of invitation is changed only if 'expires' or 'ttl' is given (as on creation).
     """
-    return Invitee(invitee=invitee, email=email).save()
+    instance = Invitee(invitee=invitee, email=email, **_expiry_fields(expires, ttl))
+    try:
+        data = instance.save(version=_expected_version(request, instance))
+    except StoreVersionConflict:
+        return _precondition_failed(response)
+    except StoreUniqueConflict as conflict:
+        return _conflict(response, conflict)
+    if response is not None:
+        response.set_header('ETag', _etag(instance.version))
+    return data
 
 
-def delete_invitee(invitee: existing_invitee):
+def delete_invitee(invitee: existing_invitee, request=None, response=None):
     """
     Deletes invitee data.
 
     Validates if invitee exists (and if so removes it from the system) then returns
     appropriate response with HTTP status code & response data.
+    If If-Match request header is given, invitee is deleted only if its version (ETag) still matches the header,
+    otherwise 412 Precondition Failed is returned.
+    """
+    instance = Invitee(invitee=invitee)
+    try:
+        instance.delete(version=_expected_version(request, instance))
+    except StoreVersionConflict:
+        return _precondition_failed(response)
+
+
+# Bulk request handlers (every item of a batch is validated and reported separately, all valid ones are written at once)
+
+def _batch_results(errors, results, status):
+    """Returns results of batch items (HTTP status code along with item data or errors)"""
+    results = iter(results)
+    return [{'status': 409 if isinstance(item_errors, ConflictErrors) else 400, 'errors': item_errors} if item_errors
+            else {'status': status, 'data': next(results)} for item_errors in errors]
+
+
+def _save_batch(body, errors, found, existing, status):
+    """
+    Saves valid items of batch at once (conditionally on versions of invitees looked up by validation, so invitees
+    created, changed or deleted in the meantime are not overwritten), returns results of all items.
+    """
+    instances = [Invitee(**dict(item, invitee=found[item['invitee']])) for item, item_errors in zip(body, errors)
+                 if not item_errors]
+    saved, failed = Invitee.save_many(instances, existing=existing)
+    for index, item in enumerate(body):
+        error = failed.get(item['invitee']) if not errors[index] else None
+        if isinstance(error, StoreUniqueConflict):  # value taken after validation
+            errors[index] = ConflictErrors({error.field: str(error)})
+        elif error is not None:  # created (or deleted) after validation
+            errors[index] = {'invitee': (MISSING_INVITEE_ERROR if existing else EXISTING_INVITEE_ERROR).format(item['invitee'])}
+    return _batch_results(errors, saved, status)
+
+
+def retrieve_invitees_batch(invitee: invitees):
+    """
+    Retrieves data of many invitees at once.
+
+    Returns list of results (with HTTP status code and invitee data or errors) for every requested invitee name.
+    """
+    items = [{'invitee': name} for name in invitee]
+    errors, found = validate_batch(items, ['invitee'], existing=True)
+    return _batch_results(errors, (Invitee(invitee=found[item['invitee']]).get() for item, item_errors in zip(items, errors)
+                                   if not item_errors), 200)
+
+
+def create_invitees_batch(body: batch):
+    """
+    Creates many invitees data at once.
+
+    Validates every invitee data object of given list (JSON array or NDJSON) same way as single one is validated on
+    creation (only 'expires' may be given as expiry time), stores all valid ones then returns list of results (with HTTP
+    status code and invitee data or errors).
+    """
+    errors, found = validate_batch(body, ['invitee', 'email', 'expires'], existing=False)
+    return _save_batch(body, errors, found, False, 201)
+
+
+def update_invitees_batch(body: batch):
+    """
+    Updates many invitees data at once.
+
+    Validates every invitee data object of given list (JSON array or NDJSON) same way as single one is validated on
+    update, stores all valid ones then returns list of results (with HTTP status code and invitee data or errors).
+    """
+    errors, found = validate_batch(body, ['invitee', 'email', 'expires'], existing=True)
+    return _save_batch(body, errors, found, True, 200)
+
+
+def delete_invitees_batch(body: batch):
+    """
+    Deletes many invitees data at once.
+
+    Validates if every invitee of given list (JSON array or NDJSON of invitee data objects) exists, removes all
+    existing ones then returns list of results (with HTTP status code and deleted invitee data or errors) - deleted
+    ones are reported with 200 OK, as their data is returned (unlike single invitee deletion, which has no content).
     """
-    Invitee(invitee=invitee).delete()
+    errors, found = validate_batch(body, ['invitee'], existing=True)
+    deleted = [Invitee(invitee=found[item['invitee']]).get() for item, item_errors in zip(body, errors) if not item_errors]
+    Invitee.delete_many(data['invitee'] for data in deleted)
+    return _batch_results(errors, deleted, 200)
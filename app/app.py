@@ -19,12 +19,42 @@ Please read README.md from application's repo for detailed info.
 # -----------------------------------------------------------------------------------------------------------------------
 
 import hug
-from falcon import HTTP_200, HTTP_201, HTTP_204
+from falcon import HTTP_200, HTTP_201, HTTP_204, HTTP_207
 
-from api import create_invitee, retrieve_invitees, update_invitee, delete_invitee
+import metrics
+import server
+from admission import Admission, AdmissionControl, BURST, HIGH, LOW, RATE
+from bulk import import_invitees, export_invitees
+from api import create_invitee, retrieve_invitees_encoded, update_invitee, delete_invitee
+from api import create_invitees_batch, retrieve_invitees_batch, update_invitees_batch, delete_invitees_batch
+from compression import Compression
+from inputs import ndjson
+from models import Model
+from namespaces import Namespaces
+from outputs import json_stream
+from stores import LogStore, NamespacedStore, DURABILITY_SYNC, store_namespaces
 
 
+def request_priority(method, url, params):
+    """
+    Returns priority of request to given route (for admission control) - low for ones that retrieve (scan) the list and
+    bulk ones, so single invitee ones go first, or None if it's not controlled (metrics, so monitoring works under
+    overload, and urls that are not routed).
+    """
+    if url is None or url == metrics_url:
+        return None
+    return LOW if url.endswith(bulk_api_url) or method == 'GET' and 'invitee' not in params else HIGH
+
+
+admission_control = AdmissionControl('api')  # used by ASGI application as well (see admission.py for limits)
+
 hug_api = hug.API(__name__)  # used also by tests
+hug_api.http.set_input_format(ndjson.content_type, ndjson)
+hug_api.http.output_format = metrics.timed('serialization', 'json')(hug.output_format.json)
+hug_api.http.add_middleware(metrics.RouteMetrics())
+hug_api.http.add_middleware(Admission(admission_control, request_priority))  # excess requests are rejected at once
+hug_api.http.add_middleware(Compression())  # responses are compressed (gzip / brotli) as Accept-Encoding allows
+hug_api.http.add_middleware(Namespaces())  # events' routes use their own stores
 router = hug.route.API(__name__)
 
 
@@ -32,11 +62,59 @@ router = hug.route.API(__name__)
 
 api_url = '/invitation'
 router.post(api_url, status=HTTP_201)(create_invitee)
-router.get(api_url, status=HTTP_200)(retrieve_invitees)
+router.get(api_url, status=HTTP_200, output=json_stream)(retrieve_invitees_encoded)  # list is streamed (chunked)
 router.put(api_url, status=HTTP_200)(update_invitee)
 router.delete(api_url, status=HTTP_204)(delete_invitee)
 
+# ...and its bulk version (results are reported for every item of a batch separately)
+
+bulk_api_url = api_url + '/_bulk'
+router.post(bulk_api_url, status=HTTP_207)(create_invitees_batch)
+router.get(bulk_api_url, status=HTTP_207)(retrieve_invitees_batch)
+router.put(bulk_api_url, status=HTTP_207)(update_invitees_batch)
+router.delete(bulk_api_url, status=HTTP_207)(delete_invitees_batch)
+
+# ...and the same API for invitees of many events (every event has its own invitees list, kept in its own store)
+
+event_url = '/events/{event}'
+event_api_url, event_bulk_api_url = event_url + api_url, event_url + bulk_api_url
+router.post(event_api_url, status=HTTP_201)(create_invitee)
+router.get(event_api_url, status=HTTP_200, output=json_stream)(retrieve_invitees_encoded)
+router.put(event_api_url, status=HTTP_200)(update_invitee)
+router.delete(event_api_url, status=HTTP_204)(delete_invitee)
+router.post(event_bulk_api_url, status=HTTP_207)(create_invitees_batch)
+router.get(event_bulk_api_url, status=HTTP_207)(retrieve_invitees_batch)
+router.put(event_bulk_api_url, status=HTTP_207)(update_invitees_batch)
+router.delete(event_bulk_api_url, status=HTTP_207)(delete_invitees_batch)
+
+# ...and instrumentation (latency histograms of routes, validators, model methods and serialization) for monitoring
+
+metrics_url = '/metrics'
+router.get(metrics_url, status=HTTP_200, output=metrics.text)(metrics.export)
+
+# ...and CLI API for bulk import / export of invitees files (i.e. `hug -f app.py -c import_invitees guests.csv`)
+
+router.cli()(import_invitees)
+router.cli()(export_invitees)
+
 
-def serve():
-    """Serves API via falcon webserver (hug uses it internally)"""
-    hug_api.http.serve(port=8000)
+def serve(storage_path=None, durability=DURABILITY_SYNC, workers=0, threads=16, rate=RATE, burst=BURST):
+    """
+    Serves API via falcon webserver (hug uses it internally) or, if number of workers is given, via production
+    webserver (see server.py). Data is kept only in memory unless storage_path is given (then it's kept durably in this
+    directory, see stores.LogStore for available durability levels, events' data in its subdirectories - loaded when
+    event is used and evicted from memory when it's not used for a while).
+    Clients are rate limited only if rate is given (requests per second of every client, with bursts of burst
+    requests - limits are per process, so with many workers client may send up to workers times more of them).
+    """
+    if workers:
+        return server.serve(port=8000, workers=workers, threads=threads, storage_path=storage_path,
+                            durability=durability, rate=rate, burst=burst)
+    admission_control.configure(rate=rate, burst=burst)
+    if storage_path:
+        Model.use_storage(NamespacedStore(LogStore(storage_path, durability=durability),
+                                          store_namespaces(storage_path, durability)))
+    try:
+        hug_api.http.serve(port=8000)
+    finally:
+        Model._storage.close()
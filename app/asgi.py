@@ -0,0 +1,284 @@
+"""
+ASGI application that serves API on asyncio event loop (using the same request handlers and validators as app.py), so
+many concurrent, mostly idle connections could be served by a single process.
+"""
+# Copyright (C) 2017 Krystian Rembas
+# -----------------------------------------------------------------------------------------------------------------------
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+# CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# -----------------------------------------------------------------------------------------------------------------------
+
+import asyncio
+import contextvars
+import inspect
+import json
+import re
+from functools import partial
+from io import BytesIO
+from urllib.parse import parse_qs
+
+from falcon import HTTPBadRequest, HTTPError, HTTP_200, HTTP_201, HTTP_204, HTTP_207, HTTP_304
+
+import metrics
+from api import create_invitee, retrieve_invitees_encoded, update_invitee, delete_invitee
+from api import create_invitees_batch, retrieve_invitees_batch, update_invitees_batch, delete_invitees_batch
+from admission import AdmissionControl, ASYNC_MAX_IN_FLIGHT, BURST, RATE, rejection
+from app import api_url, bulk_api_url, event_url, metrics_url, hug_api, request_priority
+from compression import coded_etag, compressed, negotiate, not_modified_etag
+from inputs import ndjson
+from models import Model
+from namespaces import use_namespace
+from outputs import EncodedJSON, JSONArrayStream
+
+
+# API for invitation (routing API urls and HTTP methods to appropriate handlers, same as in app.py)
+
+routes = {
+    api_url: {'POST': (create_invitee, HTTP_201), 'GET': (retrieve_invitees_encoded, HTTP_200),
+              'PUT': (update_invitee, HTTP_200), 'DELETE': (delete_invitee, HTTP_204)},
+    bulk_api_url: {'POST': (create_invitees_batch, HTTP_207), 'GET': (retrieve_invitees_batch, HTTP_207),
+                   'PUT': (update_invitees_batch, HTTP_207), 'DELETE': (delete_invitees_batch, HTTP_207)},
+}
+# requests are not queued (event loop mustn't be blocked), so they're limited by number of connections loop may serve
+admission_control = AdmissionControl('asgi', max_in_flight=ASYNC_MAX_IN_FLIGHT)
+
+_parameters = {handler: inspect.signature(handler).parameters
+               for methods in routes.values() for handler, status in methods.values()}
+_event_url = re.compile(re.escape(event_url).replace(re.escape('{event}'), '([^/]+)') + '(/.*)$')
+
+
+def _route(url):
+    """
+    Returns route of given url (url of events' routes with {event} placeholder) and its methods (None if url isn't
+    routed or event id is wrong), making namespace of event given by url (if any) current one.
+    """
+    match = _event_url.match(url)
+    try:
+        use_namespace(None if match is None else match.group(1))
+    except ValueError:
+        return url, None
+    if match is None:
+        return url, routes.get(url)
+    return event_url + match.group(2), routes.get(match.group(2))
+
+
+class _Request():
+    """Request passed to handlers that take it (they may get its headers)"""
+
+    def __init__(self, headers):
+        self.headers = headers
+
+    def get_header(self, name):
+        value = self.headers.get(name.lower().encode('latin-1'))
+        return None if value is None else value.decode('latin-1')
+
+
+class _Response():
+    """Response passed to handlers that take it (they may set its headers)"""
+
+    def __init__(self, status):
+        self.status, self.headers = status, {}
+
+    def set_header(self, name, value):
+        self.headers[name] = value
+
+
+def _parse_body(headers, body):
+    """Returns request body parsed according to its content type (None if there is no body)"""
+    if not body:
+        return None
+    content_type = headers.get(b'content-type', b'application/json').decode('latin-1').split(';')[0].strip()
+    if content_type == ndjson.content_type:
+        return ndjson(BytesIO(body))
+    try:
+        return json.loads(body.decode('utf-8'))
+    except ValueError as exception:
+        raise HTTPBadRequest('Invalid JSON', 'Could not parse JSON body - {}'.format(exception))
+
+
+def _validate(handler, inputs, request, response):
+    """
+    Returns parameters for handler converted by types it's annotated with (validators), along with errors (the same way
+    hug does it)
+    """
+    arguments, errors = {}, {}
+    for name, parameter in _parameters[handler].items():
+        if name == 'request':
+            arguments[name] = request
+        elif name == 'response':
+            arguments[name] = response
+        elif name not in inputs:
+            if parameter.default is parameter.empty:
+                errors[name] = "Required parameter '{}' not supplied".format(name)
+        elif parameter.annotation is parameter.empty:
+            arguments[name] = inputs[name]
+        else:
+            try:
+                arguments[name] = parameter.annotation(inputs[name])
+            except Exception as exception:
+                errors[name] = exception.args[0] if exception.args else str(exception)
+    return arguments, errors
+
+
+def _handle(handler, status, query, headers, body):
+    """Validates request data and calls handler with it, returns response and its data"""
+    inputs = {name: values[0] if len(values) == 1 else values for name, values in query.items()}
+    try:
+        inputs['body'] = _parse_body(headers, body)
+    except HTTPError as error:
+        return _Response(error.status), error.to_dict()
+    if isinstance(inputs['body'], dict):
+        inputs.update(inputs['body'])
+    response = _Response(status)
+    arguments, errors = _validate(handler, inputs, _Request(headers), response)
+    if errors:
+        response.status = '400 Bad Request'
+        return response, {'errors': errors}
+    return response, handler(**arguments)
+
+
+async def _run(function, *args):
+    """
+    Runs given function (that uses storage). Unless storage is in-memory one, it's run in a thread (storage may block
+    on I/O) so event loop is not blocked.
+    """
+    if getattr(Model._storage, 'blocking', True):  # with context of request (i.e. its current namespace)
+        return await asyncio.get_running_loop().run_in_executor(None, partial(contextvars.copy_context().run,
+                                                                              function, *args))
+    return function(*args)
+
+
+async def _read_body(receive):
+    chunks, more_body = [], True
+    while more_body:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        more_body = message.get('more_body', False)
+    return b''.join(chunks)
+
+
+async def _send(send, status, headers=(), body=b'', more_body=False, content_type=b'application/json; charset=utf-8'):
+    headers = [(b'content-type', content_type)] + [
+        (name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+    if not more_body:
+        headers.append((b'content-length', str(len(body)).encode('latin-1')))
+    await send({'type': 'http.response.start', 'status': int(status.split()[0]), 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body, 'more_body': more_body})
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            Model._storage.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+def _compressed(scope, headers, response, body, stream):
+    """Returns response body (data or stream) compressed as Accept-Encoding allows (as Compression middleware does)"""
+    response.set_header('Vary', 'Accept-Encoding')
+    coding = negotiate(headers.get(b'accept-encoding', b'').decode('latin-1'))
+    if coding is None:
+        return body, stream
+    uri = scope['path'] + ('?' + scope['query_string'].decode('latin-1') if scope['query_string'] else '')
+    etag = response.headers.get('ETag')
+    compressed_body = compressed(uri, etag if scope['method'] == 'GET' else None, coding, body, stream)
+    if compressed_body is None:
+        return body, stream
+    response.set_header('Content-Encoding', coding)
+    if etag is not None:
+        response.set_header('ETag', coded_etag(etag, coding))
+    return compressed_body
+
+
+async def _respond(scope, receive, send):
+    """Handles HTTP request, returns its route (url, None if request hasn't been routed) and response status"""
+    url = scope['path'].rstrip('/') or '/'
+    if url == metrics_url and scope['method'] == 'GET':
+        await _send(send, HTTP_200, body=metrics.text(metrics.export()), content_type=metrics.text.content_type.encode())
+        return url, HTTP_200
+    url, methods = _route(url)
+    if methods is None:
+        status = '404 Not Found'
+        await _send(send, status, body=b'{"404": "The API call you tried to make was not defined."}')
+        return None, status
+    if scope['method'] not in methods:
+        status = '405 Method Not Allowed'
+        await _send(send, status, [('Allow', ', '.join(methods))])
+        return url, status
+    query = parse_qs(scope['query_string'].decode('utf-8'), keep_blank_values=True)
+    client = (scope.get('client') or ('',))[0]
+    rejected = admission_control.admit(client, request_priority(scope['method'], url, query), wait=False)
+    if rejected is not None:  # (it doesn't wait for its turn, as event loop mustn't be blocked)
+        error = rejection(*rejected)
+        await _send(send, error.status, error.headers.items(), error.to_json().encode('utf-8'))
+        return url, error.status
+    try:
+        return url, await _respond_admitted(scope, receive, send, methods, query)
+    finally:
+        admission_control.release()
+
+
+async def _respond_admitted(scope, receive, send, methods, query):
+    """Handles admitted HTTP request to given route (its methods), returns response status"""
+    handler, status = methods[scope['method']]
+    body = await _read_body(receive)
+    headers = dict(scope['headers'])
+    response, data = await _run(_handle, handler, status, query, headers, body)
+    body, stream = None, None
+    if inspect.isgenerator(data):  # list is streamed (chunked)
+        stream = JSONArrayStream(data)
+    elif response.status not in (HTTP_204, HTTP_304):
+        body = data.body if isinstance(data, EncodedJSON) else hug_api.http.output_format(data)
+    if body or stream:
+        body, stream = _compressed(scope, headers, response, body, stream)
+    elif response.status == HTTP_304 and 'ETag' in response.headers:  # (as Compression middleware does)
+        coding = negotiate(headers.get(b'accept-encoding', b'').decode('latin-1'))
+        if_none_match = headers.get(b'if-none-match', b'').decode('latin-1')
+        response.set_header('ETag', not_modified_etag(response.headers['ETag'], coding, if_none_match))
+    if stream is not None:
+        await _send(send, response.status, response.headers.items(), await _run(stream.read), more_body=True)
+        chunk = await _run(stream.read)
+        while chunk:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            chunk = await _run(stream.read)
+        await send({'type': 'http.response.body', 'body': b''})
+    else:
+        await _send(send, response.status, response.headers.items(), body or b'')
+    return response.status
+
+
+async def application(scope, receive, send):
+    """ASGI application that serves API (sampling requests for metrics, as RouteMetrics middleware does in app.py)"""
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+    started = metrics.request_started()
+    url, status = await _respond(scope, receive, send)
+    metrics.request_finished(scope['method'], url, status, started)
+
+
+def serve(port=8000, rate=RATE, burst=BURST, max_in_flight=ASYNC_MAX_IN_FLIGHT):
+    """
+    Serves ASGI application via uvicorn webserver (it has to be installed: pip install uvicorn), handling at most
+    max_in_flight requests at once (others are rejected). Clients are rate limited only if rate is given (requests per
+    second, with bursts of burst requests).
+    """
+    try:
+        import uvicorn
+    except ImportError:
+        raise SystemExit('Sorry, uvicorn is required to serve ASGI application, please install it (pip install uvicorn)')
+    admission_control.configure(rate=rate, burst=burst, max_in_flight=max_in_flight)
+    uvicorn.run(application, port=port, log_level='warning')
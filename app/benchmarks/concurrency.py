@@ -0,0 +1,129 @@
+"""
+Concurrency benchmark - compares latency of WSGI (production webserver) and ASGI (uvicorn) serving of API when many
+concurrent clients (keep-alive connections) retrieve single invitees. Requires uvicorn to be installed.
+"""
+# Copyright (C) 2017 Krystian Rembas
+# -----------------------------------------------------------------------------------------------------------------------
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+# CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# -----------------------------------------------------------------------------------------------------------------------
+
+import argparse
+import asyncio
+import json
+import signal
+import socket
+import subprocess
+import sys
+import time
+from http.client import HTTPConnection
+from os.path import dirname, abspath
+
+from benchmarks.results import percentile
+
+
+APP_ROOT_PATH = dirname(dirname(abspath(__file__)))
+PORT = 8000
+SERVERS = {
+    'wsgi': 'import app; app.serve(workers={workers}, threads={threads})',
+    'asgi': 'import asgi; asgi.serve()',
+}
+
+
+def start_server(code, timeout=30):
+    """Starts server (running given python code) and waits until it accepts connections"""
+    process = subprocess.Popen([sys.executable, '-c', code], cwd=APP_ROOT_PATH, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('localhost', PORT), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('Server has not started in {}s'.format(timeout))
+
+
+def stop_server(process):
+    process.send_signal(signal.SIGTERM)
+    process.wait()
+
+
+def seed(invitees):
+    """Creates invitees used by benchmark"""
+    connection = HTTPConnection('localhost', PORT)
+    data = [{'invitee': 'Invitee {}'.format(i), 'email': 'invitee.{}@email.me'.format(i)} for i in range(invitees)]
+    connection.request('POST', '/invitation/_bulk', json.dumps(data), {'Content-Type': 'application/json'})
+    connection.getresponse().read()
+    connection.close()
+
+
+async def client(number, requests, invitees, latencies, errors):
+    """
+    Single client - sends given number of requests (one by one) via its keep-alive connection, failed ones (i.e.
+    rejected) are counted as errors.
+    """
+    try:
+        reader, writer = await asyncio.open_connection('localhost', PORT)
+        for i in range(requests):
+            name = 'Invitee%20{}'.format((number * requests + i) % invitees)
+            request = 'GET /invitation?invitee={} HTTP/1.1\r\nHost: localhost\r\n\r\n'.format(name).encode('ascii')
+            started = time.perf_counter()
+            writer.write(request)
+            headers = await reader.readuntil(b'\r\n\r\n')
+            length = [line for line in headers.lower().split(b'\r\n') if line.startswith(b'content-length:')]
+            await reader.readexactly(int(length[0].split(b':')[1]))
+            if int(headers.split(None, 2)[1]) >= 400:  # i.e. rejected by admission control, so it's not a latency sample
+                errors.append(number)
+            else:
+                latencies.append(time.perf_counter() - started)
+        writer.close()
+    except (OSError, asyncio.IncompleteReadError, IndexError, ValueError):
+        errors.append(number)
+
+
+async def load(clients, requests, invitees):
+    """Runs given number of concurrent clients, returns their requests latencies, number of errors and duration"""
+    latencies, errors = [], []
+    started = time.perf_counter()
+    await asyncio.gather(*(client(number, requests, invitees, latencies, errors) for number in range(clients)))
+    return latencies, len(errors), time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--clients', type=int, default=1000, help='concurrent clients (default: %(default)s)')
+    parser.add_argument('--requests', type=int, default=10, help='requests per client (default: %(default)s)')
+    parser.add_argument('--invitees', type=int, default=1000, help='invitees in store (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=1, help='WSGI server workers (default: %(default)s)')
+    parser.add_argument('--threads', type=int, default=16, help='WSGI server threads (default: %(default)s)')
+    parser.add_argument('servers', nargs='*', default=sorted(SERVERS), help='servers to benchmark (default: all)')
+    args = parser.parse_args()
+
+    print('{:<6} {:>10} {:>10} {:>10} {:>10} {:>8}'.format('server', 'req/s', 'p50 [ms]', 'p99 [ms]', 'max [ms]', 'errors'))
+    for name in args.servers:
+        server = start_server(SERVERS[name].format(workers=args.workers, threads=args.threads))
+        try:
+            seed(args.invitees)
+            latencies, errors, duration = asyncio.run(load(args.clients, args.requests, args.invitees))
+        finally:
+            stop_server(server)
+        latencies.sort()
+        print('{:<6} {:>10.0f} {:>10.1f} {:>10.1f} {:>10.1f} {:>8}'.format(
+            name, len(latencies) / duration, percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+            (latencies[-1] if latencies else float('nan')) * 1000, errors))
+
+
+if __name__ == '__main__':
+    main()
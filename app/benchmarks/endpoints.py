@@ -0,0 +1,127 @@
+"""
+Endpoints benchmark - measures throughput and latencies of every /invitation endpoint method served by locally started
+server to many concurrent clients (i.e. python -m benchmarks.endpoints --server asgi --output endpoints.json).
+"""
+# Copyright (C) 2017 Krystian Rembas
+# -----------------------------------------------------------------------------------------------------------------------
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+# CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# -----------------------------------------------------------------------------------------------------------------------
+
+import argparse
+import asyncio
+import json
+import time
+from urllib.parse import quote
+
+from benchmarks.concurrency import SERVERS, PORT, seed, start_server, stop_server
+from benchmarks.results import add_arguments, report, summary
+
+
+def _name(number):
+    return 'Invitee {}'.format(number)
+
+
+def _new_name(number):
+    return 'New Invitee {}'.format(number)
+
+
+# endpoints (name, function that returns HTTP method, url and body of the request for given request number)
+ENDPOINTS = [
+    ('POST /invitation', lambda i, invitees: (
+        'POST', '/invitation', {'invitee': _new_name(i), 'email': 'new.{}@email.me'.format(i)})),
+    ('GET /invitation?invitee=', lambda i, invitees: (
+        'GET', '/invitation?invitee={}'.format(quote(_name(i % invitees))), None)),
+    ('GET /invitation?limit=100', lambda i, invitees: (
+        'GET', '/invitation?limit=100', None)),
+    ('PUT /invitation', lambda i, invitees: (
+        'PUT', '/invitation', {'invitee': _new_name(i), 'email': 'updated.{}@email.me'.format(i)})),
+    ('DELETE /invitation', lambda i, invitees: (
+        'DELETE', '/invitation?invitee={}'.format(quote(_new_name(i))), None)),
+]
+
+
+async def _request(reader, writer, method, url, data):
+    """Sends request via keep-alive connection, returns response status (once whole response is read)"""
+    body = b'' if data is None else json.dumps(data).encode('utf-8')
+    writer.write('{} {} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'
+                 .format(method, url, len(body)).encode('ascii') + body)
+    lines = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1').lower().split('\r\n')
+    status = int(lines[0].split()[1])
+    headers = dict(line.split(':', 1) for line in lines[1:] if ':' in line)
+    if status in (204, 304):
+        return status
+    if headers.get('transfer-encoding', '').strip() == 'chunked':
+        size = None
+        while size != 0:
+            size = int((await reader.readuntil(b'\r\n')).split(b';')[0], 16)
+            await reader.readexactly(size + 2)
+    else:
+        await reader.readexactly(int(headers['content-length']))
+    return status
+
+
+async def client(number, endpoint, requests, invitees, latencies, errors):
+    """Single client - sends given number of requests (one by one) to given endpoint via its keep-alive connection"""
+    try:
+        reader, writer = await asyncio.open_connection('localhost', PORT)
+        for i in range(number * requests, (number + 1) * requests):
+            started = time.perf_counter()
+            status = await _request(reader, writer, *endpoint(i, invitees))
+            if status >= 400:
+                errors.append(status)
+            else:
+                latencies.append(time.perf_counter() - started)
+        writer.close()
+    except (OSError, asyncio.IncompleteReadError, KeyError, ValueError) as error:
+        errors.append(error)
+
+
+async def load(endpoint, clients, requests, invitees):
+    """Runs given number of concurrent clients, returns summary of their requests latencies and number of errors"""
+    latencies, errors = [], []
+    started = time.perf_counter()
+    await asyncio.gather(*(client(number, endpoint, requests, invitees, latencies, errors)
+                           for number in range(clients)))
+    return summary(latencies, time.perf_counter() - started), len(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--server', choices=sorted(SERVERS), default='wsgi', help='server (default: %(default)s)')
+    parser.add_argument('--clients', type=int, default=100, help='concurrent clients (default: %(default)s)')
+    parser.add_argument('--requests', type=int, default=100, help='requests per client (default: %(default)s)')
+    parser.add_argument('--invitees', type=int, default=10000, help='invitees in store (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=1, help='WSGI server workers (default: %(default)s)')
+    parser.add_argument('--threads', type=int, default=16, help='WSGI server threads (default: %(default)s)')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    results, errors = {}, 0
+    server = start_server(SERVERS[args.server].format(workers=args.workers, threads=args.threads))
+    try:
+        seed(args.invitees)
+        for name, endpoint in ENDPOINTS:  # in this order, so every new invitee is created, updated and deleted
+            results[name], endpoint_errors = asyncio.run(load(endpoint, args.clients, args.requests, args.invitees))
+            errors += endpoint_errors
+    finally:
+        stop_server(server)
+    status = report(results, args, server=args.server, clients=args.clients, requests=args.requests,
+                    invitees=args.invitees, workers=args.workers, threads=args.threads)
+    if errors:
+        print('{} request(s) failed'.format(errors))
+    return status or (1 if errors else 0)
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,91 @@
+"""
+Instrumentation overhead benchmark - measures how much slower requests (handled in process by WSGI application, so
+no network is involved) are when metrics are enabled (i.e. python -m benchmarks.instrumentation --requests 100000).
+"""
+# Copyright (C) 2017 Krystian Rembas
+# -----------------------------------------------------------------------------------------------------------------------
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+# CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# -----------------------------------------------------------------------------------------------------------------------
+
+import argparse
+import json
+import time
+from io import BytesIO
+
+from falcon.testing import create_environ
+
+import metrics
+from app import hug_api
+from models import Invitee
+from stores import SortedInMemoryStore
+
+
+def _environ(method, query_string='', body=None):
+    """Returns environ of request along with its body (every request needs a new input stream with it)"""
+    body = b'' if body is None else json.dumps(body).encode('utf-8')
+    return create_environ('/invitation', query_string=query_string, method=method, body=body,
+                          headers={'Content-Type': 'application/json'}), body
+
+
+def requests_cycle(number):
+    """Returns environs of requests that create, retrieve, update and delete an invitee (and retrieve the list)"""
+    name = 'Invitee {}'.format(number)
+    return [_environ('POST', body={'invitee': name, 'email': 'invitee@email.me'}),
+            _environ('GET', query_string='invitee=' + name.replace(' ', '+')),
+            _environ('GET', query_string='limit=10'),
+            _environ('PUT', body={'invitee': name, 'email': 'updated@email.me'}),
+            _environ('DELETE', query_string='invitee=' + name.replace(' ', '+'))]
+
+
+def measure(application, cycles):
+    """Returns time (in seconds) of handling all requests of given cycles"""
+    def start_response(status, headers):
+        pass
+
+    started = time.perf_counter()
+    for cycle in cycles:
+        for environ, body in cycle:
+            b''.join(application(dict(environ, **{'wsgi.input': BytesIO(body)}), start_response))
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=100000, help='requests (default: %(default)s)')
+    parser.add_argument('--chunk', type=int, default=500,
+                        help='requests handled in turn with metrics enabled and disabled (default: %(default)s)')
+    parser.add_argument('--invitees', type=int, default=10000, help='invitees in store (default: %(default)s)')
+    args = parser.parse_args()
+
+    Invitee.use_storage(SortedInMemoryStore())
+    Invitee.save_many(Invitee(invitee='Stored Invitee {}'.format(i), email='invitee@email.me')
+                      for i in range(args.invitees))
+    application = hug_api.http.server()
+    cycles = [requests_cycle(number) for number in range(args.chunk // 5)]
+    measure(application, cycles)  # warm up
+    durations = {True: [], False: []}
+    for i in range(args.requests // args.chunk // 2):
+        # chunks are handled in turn (in changing order), so both modes are affected by machine load the same way
+        for enabled in ((False, True) if i % 2 else (True, False)):
+            metrics.enabled = enabled
+            durations[enabled].append(measure(application, cycles))
+    ratios = sorted(enabled / disabled for enabled, disabled in zip(durations[True], durations[False]))
+    for enabled in (False, True):
+        print('metrics {:<9} {:8.1f} us/request (median)'.format(
+            'enabled:' if enabled else 'disabled:', sorted(durations[enabled])[len(ratios) // 2] / args.chunk * 1e6))
+    print('overhead: {:+.2%} (median of {} chunks)'.format(ratios[len(ratios) // 2] - 1, len(ratios)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Memory benchmark - measures how many bytes a single invitee takes in storage (with its record, key and index entry).
+"""
+# Copyright (C) 2017 Krystian Rembas
+# -----------------------------------------------------------------------------------------------------------------------
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+# CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# -----------------------------------------------------------------------------------------------------------------------
+
+import argparse
+import gc
+import tracemalloc
+
+from models import Invitee
+from stores import SortedInMemoryStore
+
+
+def _invitee_data(count):
+    for i in range(count):
+        name = 'Invitee Number {:08d}'.format(i)
+        yield name, {'invitee': name, 'email': 'invitee.{:08d}@email.me'.format(i)}
+
+
+def dict_records(count):
+    """Invitees data kept as dicts (as models did before compact records were introduced)"""
+    store = SortedInMemoryStore()
+    store.set_many(dict(_invitee_data(count)))
+    return store
+
+
+def compact_records(count):
+    """Invitees data kept as compact records (as models do)"""
+    store = SortedInMemoryStore()
+    Invitee.use_storage(store)
+    Invitee.save_many(Invitee(**data) for name, data in _invitee_data(count))
+    return store
+
+
+def measure(build, count):
+    """Returns number of bytes allocated per invitee by given storage build function"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    store = build(count)  # noqa: F841 (kept alive until memory is measured)
+    gc.collect()
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return allocated / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=100000, help='number of invitees (default: %(default)s)')
+    args = parser.parse_args()
+    results = [(build.__doc__, measure(build, args.count)) for build in (dict_records, compact_records)]
+    for description, bytes_per_invitee in results:
+        print('{:<75} {:8.1f} B/invitee'.format(description, bytes_per_invitee))
+    print('Saved: {:.1%}'.format(1 - results[1][1] / results[0][1]))
+
+
+if __name__ == '__main__':
+    main()
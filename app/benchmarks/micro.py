@@ -0,0 +1,96 @@
+"""
+Micro benchmarks - measures latencies of model operations (Model.save / get / delete) and validators at different
+store sizes (i.e. python -m benchmarks.micro --sizes 100,10000 --output micro.json).
+"""
+# Copyright (C) 2017 Krystian Rembas
+# -----------------------------------------------------------------------------------------------------------------------
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+# CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# -----------------------------------------------------------------------------------------------------------------------
+
+
+import argparse
+import random
+import time
+
+from benchmarks.results import add_arguments, report, summary
+from models import Invitee
+from stores import SortedInMemoryStore
+from validators import email, existing_invitee, nonexisting_invitee
+
+
+def _name(number):
+    return 'Invitee Number {:08d}'.format(number)
+
+
+def _email(number):
+    return 'invitee.{:08d}@email.me'.format(number)
+
+
+def populate(size):
+    """Makes invitee model use new store with given number of invitees"""
+    Invitee.use_storage(SortedInMemoryStore())
+    Invitee.save_many(Invitee(invitee=_name(i), email=_email(i)) for i in range(size))
+
+
+def measure(operation, arguments):
+    """Calls operation with every given argument, returns summary of calls latencies"""
+    latencies = []
+    for argument in arguments:
+        started = time.perf_counter()
+        operation(argument)
+        latencies.append(time.perf_counter() - started)
+    return summary(latencies)
+
+
+def benchmark(size, operations, seed=0):
+    """
+    Runs benchmarks at given store size, every one with given number of operations on invitees picked at random.
+    New invitees are spread over the whole store (not appended at the end of sorted index) and are deleted in the end,
+    so store size is the same for every benchmark.
+    """
+    populate(size)
+    rand = random.Random(seed)
+    existing = [_name(rand.randrange(size)) for i in range(operations)]
+    new = ['{} ({})'.format(_name(rand.randrange(size)), i) for i in range(operations)]
+    emails = [_email(rand.randrange(size)) for i in range(operations)]
+    benchmarks = [
+        ('validators.email', email, emails),
+        ('validators.nonexisting_invitee', nonexisting_invitee, new),
+        ('validators.existing_invitee', existing_invitee, existing),
+        ('Model.save (create)', lambda name: Invitee(invitee=name, email=emails[0]).save(), new),
+        ('Model.save (update)', lambda name: Invitee(invitee=name, email=emails[0]).save(), existing),
+        ('Model.get', lambda name: Invitee(invitee=name).get(), existing),
+        ('Model.delete', lambda name: Invitee(invitee=name).delete(), new),
+    ]
+    return {'{} [n={}]'.format(name, size): measure(operation, arguments)
+            for name, operation, arguments in benchmarks}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', default='100,1000,10000,100000,1000000',
+                        help='comma separated store sizes (default: %(default)s)')
+    parser.add_argument('--operations', type=int, default=10000,
+                        help='operations per benchmark (default: %(default)s)')
+    add_arguments(parser)
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(',')]
+    results = {}
+    for size in sizes:
+        results.update(benchmark(size, args.operations))
+    return report(results, args, sizes=sizes, operations=args.operations)
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
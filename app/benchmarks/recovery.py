@@ -0,0 +1,87 @@
+"""
+Recovery benchmark - measures how long durable store (LogStore) of given number of invitees takes to start (to be opened
+and to have indexes created, as models do when they start using it) and how long it takes until its data is recovered,
+i.e. its snapshot loaded, the log written after it replayed and data indexed (in background).
+"""
+# Copyright (C) 2017 Krystian Rembas
+# -----------------------------------------------------------------------------------------------------------------------
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+# CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# -----------------------------------------------------------------------------------------------------------------------
+
+import argparse
+import tempfile
+import time
+
+from benchmarks.results import add_arguments, report, summary
+from models import Invitee
+from stores import LogStore, DURABILITY_NONE
+
+
+def _record(i, expires):
+    data = {'invitee': 'Invitee Number {:08d}'.format(i), 'email': 'invitee.{:08d}@email.me'.format(i)}
+    if i % 10 == 0:  # some invitations expire
+        data['expires'] = expires
+    return data['invitee'], Invitee._as_record(data)
+
+
+def prepare(path, records, log):
+    """Writes store with snapshot of given number of records and given number of writes logged after it"""
+    expires = time.time() + 24 * 3600
+    store = LogStore(path, DURABILITY_NONE, compact_after=records + log)
+    for start in range(0, records, 10000):
+        store.set_many(dict(_record(i, expires) for i in range(start, min(start + 10000, records))))
+    store.compact()
+    for i in range(log):
+        store.set(*_record(i * 7 % (records + log), expires))  # updates and inserts
+    store.close()
+
+
+def recover(path):
+    """Returns durations of store start and of its data recovery (until invitee can be found by email)"""
+    started = time.perf_counter()
+    store = LogStore(path, DURABILITY_NONE)
+    for field, index in Invitee.indexes.items():
+        store.create_index(field, index.bound(field, Invitee.fields.index(field)))
+    opened = time.perf_counter()
+    assert store.find('email', 'invitee.00000001@email.me') == ['Invitee Number 00000001']
+    recovered = time.perf_counter()
+    store.close()
+    return opened - started, recovered - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--records', type=int, default=1000000, help='invitees in snapshot (default: %(default)s)')
+    parser.add_argument('--log', type=int, default=1000, help='writes logged after snapshot (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5, help='recoveries measured (default: %(default)s)')
+    parser.add_argument('--target', type=float, default=1.0, help='target start time [s] (default: %(default)s)')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as path:
+        prepare(path, args.records, args.log)
+        durations = [recover(path) for _ in range(args.repeat)]
+    results = {
+        'recovery (store start)': summary([opened for opened, recovered in durations]),
+        'recovery (data recovered and indexed)': summary([recovered for opened, recovered in durations]),
+    }
+    status = report(results, args, records=args.records, log=args.log)
+    started, recovered = (results[name]['p50'] / 1000 for name in results)
+    print('Store of {} invitees started in {:.3f}s ({} target of {}s), data was recovered in {:.3f}s'.format(
+        args.records, started, 'within' if started < args.target else 'MISSED', args.target, recovered))
+    return status
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
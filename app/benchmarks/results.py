@@ -0,0 +1,99 @@
+"""
+Benchmark results - summarizing latencies, saving results as JSON and comparing them with a baseline.
+"""
+# Copyright (C) 2017 Krystian Rembas
+# -----------------------------------------------------------------------------------------------------------------------
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+# CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# -----------------------------------------------------------------------------------------------------------------------
+
+
+import json
+import platform
+import sys
+
+
+def percentile(values, percent):
+    """Returns given percentile of sorted values"""
+    return values[min(len(values) - 1, int(len(values) * percent / 100))] if values else float('nan')
+
+
+def summary(latencies, duration=None):
+    """
+    Returns summary of operations latencies (in seconds): ops/sec (by duration of all operations, if it's given,
+    otherwise by sum of latencies) and latencies percentiles (in milliseconds).
+    """
+    latencies = sorted(latencies)
+    duration = sum(latencies) if duration is None else duration
+    return {
+        'count': len(latencies),
+        'ops': len(latencies) / duration if duration else float('nan'),
+        'p50': percentile(latencies, 50) * 1000,
+        'p90': percentile(latencies, 90) * 1000,
+        'p99': percentile(latencies, 99) * 1000,
+        'max': (latencies[-1] if latencies else float('nan')) * 1000,
+    }
+
+
+def print_results(results):
+    print('{:<45} {:>12} {:>10} {:>10} {:>10} {:>10}'.format('benchmark', 'ops/s', 'p50 [ms]', 'p90 [ms]',
+                                                            'p99 [ms]', 'max [ms]'))
+    for name, result in results.items():
+        print('{:<45} {ops:>12.0f} {p50:>10.3f} {p90:>10.3f} {p99:>10.3f} {max:>10.3f}'.format(name, **result))
+
+
+def save(results, path, **parameters):
+    """Saves results as JSON (along with benchmark parameters and platform they were taken on)"""
+    with open(path, 'w') as results_file:
+        json.dump({'python': sys.version.split()[0], 'platform': platform.platform(), 'parameters': parameters,
+                   'results': results}, results_file, indent=2, sort_keys=True)
+
+
+def compare(results, baseline_path, tolerance):
+    """
+    Compares results with baseline ones (saved before), returns list of regressions - benchmarks which ops/s dropped
+    or median latency rose by more than given tolerance (fraction of baseline value).
+    """
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)['results']
+    regressions = []
+    for name in sorted(set(results) & set(baseline)):
+        result, base = results[name], baseline[name]
+        for metric, regressed in (('ops', result['ops'] < base['ops'] * (1 - tolerance)),
+                                  ('p50', result['p50'] > base['p50'] * (1 + tolerance))):
+            if regressed:
+                regressions.append('{}: {} {:.3f} (baseline {:.3f}, {:+.0%})'.format(
+                    name, metric, result[metric], base[metric], result[metric] / base[metric] - 1))
+    return regressions
+
+
+def add_arguments(parser):
+    """Adds arguments of reporting results to given argparse parser"""
+    parser.add_argument('--output', help='path of JSON file to save results to (i.e. to use them as a baseline)')
+    parser.add_argument('--baseline', help='path of JSON file with baseline results to compare results with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed relative slowdown before a regression is reported (default: %(default)s)')
+
+
+def report(results, args, **parameters):
+    """Prints results, saves and compares them according to arguments, returns exit status (1 if regressed)"""
+    print_results(results)
+    if args.output:
+        save(results, args.output, **parameters)
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        print('{} regression(s) compared with {}'.format(len(regressions), args.baseline))
+        return 1 if regressions else 0
+    return 0
@@ -0,0 +1,261 @@
+"""
+Bulk import / export of invitees (streamed CSV or NDJSON files, used by CLI API).
+"""
+# Copyright (C) 2017 Krystian Rembas
+# -----------------------------------------------------------------------------------------------------------------------
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+# CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# -----------------------------------------------------------------------------------------------------------------------
+
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from itertools import islice
+
+import hug
+
+from models import Invitee, Model
+from namespaces import use_namespace
+from stores import LogStore, NamespacedStore, StoreUniqueConflict, DURABILITY_SYNC, current_namespace, store_namespaces
+from validators import validate_batch, validate_fields, EXISTING_INVITEE_ERROR
+
+
+FORMATS = ('csv', 'ndjson')
+FIELDS = Invitee.fields
+ENCODING = 'utf-8'
+BATCH_SIZE = 10000  # rows validated and written at once
+PARALLEL_MIN_SIZE = 16 * 2 ** 20  # smaller files are validated by importing process (starting workers costs more)
+PROGRESS_INTERVAL = 1  # seconds between progress reports
+
+
+def _format_of(path, file_format):
+    """Returns format of given file (given explicitly or by file extension, NDJSON is used by default)"""
+    if file_format is None:
+        file_format = 'csv' if path.lower().endswith('.csv') else 'ndjson'
+    if file_format not in FORMATS:
+        raise ValueError('Unsupported format: {} (supported ones: {})'.format(file_format, ', '.join(FORMATS)))
+    return file_format
+
+
+@contextmanager
+def _storage(storage_path, durability, event):
+    """
+    Uses durable stores kept in given directory as storage of models while in context (storage used before is used
+    again afterwards), makes namespace of given event (if it's given) current one.
+    """
+    if storage_path is None:  # (in memory storage of command's own process would be just dropped)
+        raise ValueError('storage_path (directory of durable storage, i.e. one that app is served with) is required')
+    token, previous = use_namespace(event), Model._storage
+    try:
+        Model._storage = NamespacedStore(LogStore(storage_path, durability=durability),
+                                         store_namespaces(storage_path, durability))
+        Model._create_indexes()
+        yield
+    finally:
+        current_namespace.reset(token)
+        if Model._storage is not previous:
+            Model._storage.close()
+        Model._storage = previous
+
+
+class _Progress():
+    """Reports progress and throughput (to stderr, at most once per PROGRESS_INTERVAL) of rows processing"""
+
+    def __init__(self, action, output=sys.stderr):
+        self._action, self._output = action, output
+        self._started = self._reported = time.perf_counter()
+        self.rows = self.rejected = 0
+
+    def update(self, rows, rejected=0, final=False):
+        self.rows, self.rejected = self.rows + rows, self.rejected + rejected
+        now = time.perf_counter()
+        if final or now - self._reported >= PROGRESS_INTERVAL:
+            self._reported = now
+            print('\r{} {} rows ({} rejected), {:.0f} rows/s'.format(self._action, self.rows, self.rejected, self.rate),
+                  end='\n' if final else '', file=self._output, flush=True)
+
+    @property
+    def seconds(self):
+        return time.perf_counter() - self._started
+
+    @property
+    def rate(self):
+        return self.rows / max(self.seconds, 1e-9)
+
+
+# Import (rows are parsed & validated in chunks, in parallel by worker processes for large files, then every chunk is
+# checked against storage and written at once by importing process - so memory usage is bounded by size of chunks)
+
+def _chunks(source, file_format, batch_size):
+    """
+    Yields chunks of raw lines (with number of the first one) read from given binary file. CSV header is read first
+    and chunks are split only between records (never within quoted value that contains new line).
+    """
+    header, number = None, 1
+    if file_format == 'csv':
+        header, number = next(csv.reader([source.readline().decode(ENCODING)]), None), 2
+    lines, first, quotes = [], number, 0
+    for number, line in enumerate(source, start=number):
+        lines.append(line)
+        quotes += line.count(b'"')
+        if len(lines) >= batch_size and quotes % 2 == 0:
+            yield file_format, header, first, lines
+            lines, first = [], number + 1
+    if lines:
+        yield file_format, header, first, lines
+
+
+def _rows(file_format, header, first, lines):
+    """Yields (line number, row as read, row dict or error message) for every row of given chunk of lines"""
+    if file_format == 'csv':
+        reader, read = csv.reader(line.decode(ENCODING, 'replace') for line in lines), 0
+        for row in reader:
+            number, read = first + read, reader.line_num  # row may span many lines, so it's number of its first one
+            if not row:
+                continue
+            if header is None or len(row) != len(header):
+                yield number, row, 'Row must have the same number of values as header: {}'.format(header)
+            else:
+                yield number, row, dict(zip(header, row))
+        return
+    for number, line in enumerate(lines, start=first):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line.decode(ENCODING))
+        except ValueError as exception:
+            yield number, line.decode(ENCODING, 'replace').rstrip('\r\n'), 'Invalid NDJSON: {}'.format(exception)
+            continue
+        yield number, row, row if isinstance(row, dict) else 'Row must be invitee data object'
+
+
+def _validate_chunk(file_format, header, first, lines):
+    """
+    Parses and validates (as on invitee creation, but without looking invitees up) chunk of lines, returns tuple of
+    valid items (with line numbers and rows as read) and rejects (rejected rows with their errors).
+    """
+    parsed, valid, rejects = [], [], []
+    for number, row, data in _rows(file_format, header, first, lines):
+        if isinstance(data, str):
+            rejects.append({'line': number, 'row': row, 'errors': {'row': data}})
+        else:
+            parsed.append((number, row, {field: data.get(field) for field in FIELDS}))
+    for entry, errors in zip(parsed, validate_fields([item for _, _, item in parsed], FIELDS)):
+        if errors:
+            rejects.append({'line': entry[0], 'row': entry[1], 'errors': errors})
+        else:
+            valid.append(entry)
+    return valid, rejects
+
+
+def _validated(chunks, processes):
+    """
+    Yields validated chunks (in order) - by given number of worker processes, keeping only a few chunks per worker in
+    flight (so not the whole file is read ahead into memory), or by current process if just one is given.
+    """
+    if processes <= 1:
+        yield from (_validate_chunk(*chunk) for chunk in chunks)
+        return
+    with multiprocessing.get_context('spawn').Pool(processes) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(_validate_chunk, chunk))
+            if len(pending) > 2 * processes:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def _failure_errors(item, error):
+    """Returns errors of item which write has failed with given error (StoreUniqueConflict or StoreVersionConflict)"""
+    if isinstance(error, StoreUniqueConflict):
+        return {error.field: str(error)}
+    return {'invitee': EXISTING_INVITEE_ERROR.format(item['invitee'])}
+
+
+def _import_chunk(valid, rejects):
+    """Writes valid items of validated chunk (but only invitees that don't exist yet) at once, returns all its rejects"""
+    items = [item for _, _, item in valid]
+    errors, found = validate_batch(items, [], existing=False)  # fields are validated already, so just looks them up
+    rejects += [{'line': number, 'row': row, 'errors': item_errors}
+                for (number, row, _), item_errors in zip(valid, errors) if item_errors]
+    instances = [Invitee(**dict(item, invitee=found[item['invitee']])) for item, item_errors in zip(items, errors)
+                 if not item_errors]
+    failed = Invitee.save_many(instances, existing=False)[1]  # (created or their values taken in the meantime)
+    rejects += [{'line': number, 'row': row, 'errors': _failure_errors(item, failed[item['invitee']])}
+                for (number, row, item), item_errors in zip(valid, errors) if not item_errors and item['invitee'] in failed]
+    return sorted(rejects, key=lambda reject: reject['line'])
+
+
+def import_invitees(path: hug.types.text, rejects_path: hug.types.text=None, file_format: hug.types.one_of(FORMATS)=None,
+                    batch_size: hug.types.number=BATCH_SIZE, processes: hug.types.number=None,
+                    storage_path: hug.types.text=None, durability: hug.types.text=DURABILITY_SYNC,
+                    event: hug.types.text=None):
+    """
+    Imports invitees from CSV (with header row) or NDJSON file (into invitees list of given event, if it's given).
+
+    Every row is validated as on invitee creation (invitee must not exist yet), valid ones are written in batches and
+    rejected ones are written (as NDJSON with line number, row as read and errors) to rejects file (path.rejects by
+    default, removed if no row is rejected). Large files are parsed and validated in parallel by worker processes (CPU
+    count by default). Data is imported into durable store kept in storage_path directory (required).
+    """
+    file_format, rejects_path = _format_of(path, file_format), rejects_path or path + '.rejects'
+    if processes is None:
+        processes = os.cpu_count() if os.path.getsize(path) >= PARALLEL_MIN_SIZE else 1
+    progress = _Progress('Imported')
+    with _storage(storage_path, durability, event), open(path, 'rb') as source, open(rejects_path, 'w') as rejects_file:
+        for valid, rejects in _validated(_chunks(source, file_format, batch_size), processes):
+            rows, rejects = len(valid) + len(rejects), _import_chunk(valid, rejects)
+            rejects_file.writelines(json.dumps(reject) + '\n' for reject in rejects)
+            progress.update(rows, len(rejects))
+    progress.update(0, final=True)
+    if not progress.rejected:
+        os.remove(rejects_path)
+    return {'imported': progress.rows - progress.rejected, 'rejected': progress.rejected,
+            'rejects': rejects_path if progress.rejected else None,
+            'seconds': round(progress.seconds, 3), 'rows_per_second': round(progress.rate)}
+
+
+# Export (invitees are read from storage in batches, every one is a consistent snapshot)
+
+def export_invitees(path: hug.types.text, file_format: hug.types.one_of(FORMATS)=None,
+                    batch_size: hug.types.number=BATCH_SIZE, storage_path: hug.types.text=None,
+                    durability: hug.types.text=DURABILITY_SYNC, event: hug.types.text=None):
+    """
+    Exports all invitees (of given event, if it's given) sorted by name into CSV (with header row) or NDJSON file (or
+    to stdout if path is '-', then summary is reported only with progress to stderr).
+
+    Invitees are read from storage and written in batches, so memory usage does not depend on number of invitees.
+    Data is exported from durable store kept in storage_path directory (required).
+    """
+    file_format, progress = _format_of(path, file_format), _Progress('Exported')
+    with _storage(storage_path, durability, event), (open(path, 'w', encoding=ENCODING, newline='') if path != '-'
+                                                     else nullcontext(sys.stdout)) as target:
+        writer = csv.writer(target, lineterminator='\n') if file_format == 'csv' else None
+        if writer is not None:
+            writer.writerow(FIELDS)
+        invitees = Invitee.iterate(batch=batch_size)
+        for batch in iter(lambda: list(islice(invitees, batch_size)), []):
+            if writer is not None:
+                writer.writerows([data.get(field) for field in FIELDS] for data in batch)
+            else:
+                target.writelines(json.dumps(data) + '\n' for data in batch)
+            progress.update(len(batch))
+    progress.update(0, final=True)
+    if path != '-':
+        return {'exported': progress.rows, 'seconds': round(progress.seconds, 3), 'rows_per_second': round(progress.rate)}
@@ -0,0 +1,92 @@
+"""
+Cache of encoded responses (bounded LRU, entries are valid only for the version of data they were encoded from).
+"""
+# Copyright (C) 2017 Krystian Rembas
+# -----------------------------------------------------------------------------------------------------------------------
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+# CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# -----------------------------------------------------------------------------------------------------------------------
+
+import threading
+from collections import OrderedDict
+
+
+caches = {}  # all response caches by name (their statistics are exported by metrics)
+
+
+class ResponseCache():
+    """
+    Bounded LRU cache of encoded responses (bodies along with headers) by key. Every entry is stored with version of
+    data it was encoded from and it's returned only for the same version, so stale entries are never served (even if
+    data has been changed by other process sharing the store) - writes invalidate them too, only to free memory early.
+    Least recently used entries are evicted once there are more than max_entries of them or more than max_bytes of
+    bodies, bodies larger than max_entry_bytes are not cached at all.
+    """
+
+    def __init__(self, name, max_entries=10000, max_bytes=64 * 2 ** 20, max_entry_bytes=2 ** 20):
+        self.name, self.max_entries, self.max_bytes, self.max_entry_bytes = name, max_entries, max_bytes, max_entry_bytes
+        self._entries = OrderedDict()  # (version, body, headers) by key, least recently used first
+        self._lock = threading.Lock()
+        self.size = self.hits = self.misses = self.evictions = self.invalidations = 0
+        caches[name] = self
+
+    def get(self, key, version):
+        """Returns cached (body, headers) for given key and data version or None if there is no such entry"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def put(self, key, version, body, headers=()):
+        """Caches given body (and headers) of response for given key and data version, returns the body"""
+        if len(body) > self.max_entry_bytes:
+            return body
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= len(entry[1])
+            self._entries[key] = version, body, headers
+            self.size += len(body)
+            while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                self.size -= len(self._entries.popitem(last=False)[1][1])
+                self.evictions += 1
+        return body
+
+    def invalidate(self, keys=None):
+        """Drops entries for given keys (all entries if no keys are given)"""
+        with self._lock:
+            if keys is None:
+                self.invalidations += len(self._entries)
+                self._entries.clear()
+                self.size = 0
+                return
+            for key in keys:
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self.size -= len(entry[1])
+                    self.invalidations += 1
+
+    @property
+    def hit_rate(self):
+        """Ratio of lookups that found valid entry (None if there were no lookups yet)"""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else None
+
+    def stats(self):
+        """Returns statistics of cache usage (as a dict)"""
+        return {'entries': len(self._entries), 'bytes': self.size, 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hit_rate, 'evictions': self.evictions, 'invalidations': self.invalidations}
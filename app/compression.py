@@ -0,0 +1,174 @@
+"""
+Compression of responses (gzip, or brotli if it is installed) negotiated by Accept-Encoding request header.
+"""
+# Copyright (C) 2017 Krystian Rembas
+# -----------------------------------------------------------------------------------------------------------------------
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+# CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# -----------------------------------------------------------------------------------------------------------------------
+
+import gzip
+import zlib
+
+from falcon import HTTP_304
+
+from cache import ResponseCache
+from metrics import timed
+
+try:
+    import brotli
+except ImportError:
+    brotli = None  # brotli is optional (pip install brotli), responses are compressed by gzip only without it
+
+
+MIN_SIZE = 1024  # smaller bodies (i.e. of single invitee) are sent uncompressed, compression costs more than it saves
+GZIP_LEVEL, BROTLI_QUALITY = 6, 5  # good ratio at speed of (almost) fastest levels
+CODINGS = ('br', 'gzip') if brotli else ('gzip',)  # supported content codings, preferred first
+
+# compressed bodies of responses with ETag (by url and coding), valid only for the version they've been compressed from
+compressed_responses = ResponseCache('compressed', max_entries=1000, max_bytes=64 * 2 ** 20, max_entry_bytes=16 * 2 ** 20)
+
+
+def negotiate(accept_encoding):
+    """Returns the best supported content coding accepted by client (per Accept-Encoding header) or None if there's no one"""
+    weights = {}
+    for part in (accept_encoding or '').lower().split(','):
+        coding, _, parameters = part.partition(';')
+        weight = 1.0
+        if parameters.strip().startswith('q='):
+            try:
+                weight = float(parameters.strip()[2:])
+            except ValueError:
+                weight = 0.0
+        weights[coding.strip()] = weight
+    best, best_weight = None, 0.0
+    for coding in CODINGS:
+        weight = weights.get(coding, weights.get('*', 0.0))
+        if weight > best_weight:
+            best, best_weight = coding, weight
+    return best
+
+
+def coded_etag(etag, coding):
+    """
+    Returns ETag of response body compressed with given content coding, i.e. '"123-gzip"' for '"123"' (compressed body
+    is other representation than the identity one, so it mustn't have the same strong ETag)
+    """
+    return '{}-{}"'.format(etag[:-1], coding)
+
+
+def not_modified_etag(etag, coding, if_none_match):
+    """
+    Returns ETag of 304 Not Modified response (it has no body to be compressed) - coded one if request's If-None-Match
+    header has it (client has compressed body), given identity one otherwise
+    """
+    if coding is not None and etag is not None and coded_etag(etag, coding) in (if_none_match or ''):
+        return coded_etag(etag, coding)
+    return etag
+
+
+@timed('serialization', 'compression')
+def compress(body, coding):
+    """Returns given body compressed with given content coding"""
+    if coding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, GZIP_LEVEL, mtime=0)
+
+
+class CompressedStream():
+    """
+    File-like object that compresses chunks read from given stream (so compressed response is streamed as well). Once
+    the whole stream is read, its compressed body is passed to on_complete callback (if it's given and body is not
+    larger than max_size).
+    """
+
+    def __init__(self, stream, coding, on_complete=None, max_size=16 * 2 ** 20):
+        self._stream, self._on_complete, self._max_size = stream, on_complete, max_size
+        if coding == 'br':
+            self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+            self._compress, self._flush = self._compressor.process, self._compressor.finish
+        else:
+            self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # with gzip header
+            self._compress, self._flush = self._compressor.compress, self._compressor.flush
+        self._chunks, self._size, self._finished = [], 0, False
+
+    @timed('serialization', 'compression chunk')
+    def read(self, size=-1):
+        """Returns next compressed chunk (of any size, regardless given one) or empty bytes when there is no more data"""
+        chunk = b''
+        while not chunk and not self._finished:
+            data = self._stream.read()
+            if data:
+                chunk = self._compress(data)
+            else:
+                chunk, self._finished = self._flush(), True
+        self._keep(chunk)
+        return chunk
+
+    def _keep(self, chunk):
+        """Keeps compressed chunks (while they are not too large) to pass the whole body to on_complete callback"""
+        if self._on_complete is None:
+            return
+        self._size += len(chunk)
+        if self._size > self._max_size:
+            self._on_complete, self._chunks = None, None
+        elif chunk:
+            self._chunks.append(chunk)
+        if self._finished and self._on_complete is not None:
+            on_complete, self._on_complete = self._on_complete, None  # reads past the end must not complete it again
+            on_complete(b''.join(self._chunks))
+
+
+def compressed(key, etag, coding, data=None, stream=None):
+    """
+    Returns compressed response body - tuple of data and stream (one of them is None) for given uncompressed one,
+    served from cache if response has ETag (so it's compressed once per version) or None if body is too small to be
+    compressed.
+    """
+    if stream is None and len(data) < MIN_SIZE:
+        return None
+    if etag is not None:
+        cached = compressed_responses.get((key, coding), etag)
+        if cached is not None:
+            return cached[0], None
+    if stream is not None:
+        on_complete = None if etag is None else lambda body: compressed_responses.put((key, coding), etag, body)
+        return None, CompressedStream(stream, coding, on_complete, compressed_responses.max_entry_bytes)
+    body = compress(data, coding)
+    return (body if etag is None else compressed_responses.put((key, coding), etag, body)), None
+
+
+class Compression():
+    """Falcon middleware that compresses responses with content coding negotiated by Accept-Encoding request header"""
+
+    def process_response(self, request, response, resource, request_succeeded):
+        etag = response.get_header('ETag')
+        if response.status == HTTP_304:  # (its body is dropped by falcon)
+            response.append_header('Vary', 'Accept-Encoding')
+            if etag is not None:
+                coding = negotiate(request.get_header('Accept-Encoding'))
+                response.set_header('ETag', not_modified_etag(etag, coding, request.get_header('If-None-Match')))
+            return
+        if response.stream is None and not response.data:
+            return  # no body (i.e. 204 No Content)
+        response.append_header('Vary', 'Accept-Encoding')
+        coding = negotiate(request.get_header('Accept-Encoding'))
+        if coding is None or response.get_header('Content-Encoding'):
+            return
+        body = compressed(request.relative_uri, etag if request.method == 'GET' else None, coding, response.data,
+                          response.stream)
+        if body is not None:
+            response.data, response.stream = body
+            response.set_header('Content-Encoding', coding)
+            if etag is not None:
+                response.set_header('ETag', coded_etag(etag, coding))
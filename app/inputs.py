@@ -0,0 +1,47 @@
+"""
+Input formats used by routes (to parse request bodies into data passed to request handlers).
+"""
+# Copyright (C) 2017 Krystian Rembas
+# -----------------------------------------------------------------------------------------------------------------------
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+# CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# -----------------------------------------------------------------------------------------------------------------------
+
+import json
+
+import hug
+from falcon import HTTPBadRequest
+
+
+def _lines(body, chunk_size=64 * 1024):
+    """Yields lines of given body stream (read chunk by chunk)"""
+    rest = b''
+    for chunk in iter(lambda: body.read(chunk_size), b''):
+        lines = (rest + chunk).split(b'\n')
+        rest = lines.pop()
+        yield from lines
+    yield rest
+
+
+@hug.format.content_type('application/x-ndjson')
+def ndjson(body, charset='utf-8', **kwargs):
+    """Takes NDJSON (newline delimited JSON) formatted data, converting it line by line into list of Python objects"""
+    items = []
+    for number, line in enumerate(_lines(body), start=1):
+        if not line.strip():
+            continue
+        try:
+            items.append(json.loads(line.decode(charset)))
+        except ValueError as exception:
+            raise HTTPBadRequest('Invalid NDJSON', 'Could not parse line {}: {}'.format(number, exception))
+    return items
@@ -0,0 +1,258 @@
+"""
+Instrumentation of application - latency histograms (along with counts and errors) of request processing stages:
+routes, validators (hug types), model methods and serialization, exposed in Prometheus text format (along with
+statistics of response caches).
+To keep overhead low (below 2% of in-process request handling time) only sampled requests are measured. Metrics are
+kept by process, so every worker of production server (see server.py) reports its own ones.
+"""
+# Copyright (C) 2017 Krystian Rembas
+# -----------------------------------------------------------------------------------------------------------------------
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+# CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# -----------------------------------------------------------------------------------------------------------------------
+
+from bisect import bisect_left
+from contextvars import ContextVar
+from functools import wraps
+from time import perf_counter
+
+import hug
+
+from admission import PRIORITIES, REASONS, controls
+from cache import caches
+
+
+enabled = True  # whether requests are sampled (if not, instrumented calls cost one additional function call only)
+sample_every = 32  # every n-th request is sampled - its route and all stages are measured (1 measures every request)
+# whether current request is sampled, i.e. its stages are measured (kept in context of request - its thread or task and
+# functions it runs in other threads with its context, so stages of other requests handled meanwhile are not measured)
+_sampled = ContextVar('sampled', default=False)
+_requests = 0
+
+# upper bounds of histogram buckets (in seconds), from 1 microsecond to 10 seconds
+BUCKETS = tuple(base * 10 ** exponent for exponent in range(-6, 1) for base in (1, 2.5, 5)) + (10,)
+
+
+class Histogram():
+    """
+    Latency histogram of single stage (with numbers of measured calls and failed ones). It's updated without locking
+    (GIL makes lost update very unlikely and it's cheaper than lock).
+    """
+    __slots__ = ('counts', 'sum', 'calls', 'errors')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # the last one is for latencies beyond the last bucket (+Inf)
+        self.sum, self.calls, self.errors = 0.0, 0, 0
+
+    def observe(self, latency, error=False):
+        """Records latency (in seconds) of a call (which has failed if error is set)"""
+        self.counts[bisect_left(BUCKETS, latency)] += 1
+        self.sum += latency
+        self.calls += 1
+        self.errors += error
+
+
+histograms = {}  # histograms by stage and name
+storage_stats = {}  # callables returning statistics of models storages by model name (registered by models)
+
+
+def histogram(stage, name):
+    """Returns histogram of given stage name (registered by first call)"""
+    stage_histogram = histograms.get((stage, name))
+    if stage_histogram is None:
+        stage_histogram = histograms.setdefault((stage, name), Histogram())
+    return stage_histogram
+
+
+def reset():
+    """Resets all histograms (i.e. to measure from scratch)"""
+    for stage_histogram in histograms.values():
+        stage_histogram.__init__()
+
+
+def _measure(stage_histogram, function, *args, **kwargs):
+    """Calls function of a stage, measuring its latency"""
+    started = perf_counter()
+    try:
+        result = function(*args, **kwargs)
+    except Exception:
+        stage_histogram.observe(perf_counter() - started, error=True)
+        raise
+    stage_histogram.observe(perf_counter() - started)
+    return result
+
+
+def timed(stage, name):
+    """Decorator that measures latency (and failures - raised exceptions) of decorated function calls, if sampled"""
+    def decorator(function):
+        stage_histogram, sampled = histogram(stage, name), _sampled.get
+
+        @wraps(function)
+        def timed_function(*args, **kwargs):
+            if sampled():
+                return _measure(stage_histogram, function, *args, **kwargs)
+            return function(*args, **kwargs)
+        return timed_function
+    return decorator
+
+
+def timed_type(name):
+    """
+    As timed decorator but for hug types (annotations) of validation stage. Decorated type takes (and ignores) context
+    too, so hug (that tries to pass context to a type first) calls it once (original type is called again by hug
+    after it fails on context). It takes value only, so it's cheaper to call than generic timed function.
+    """
+    def decorator(type_handler):
+        stage_histogram, sampled = histogram('validation', name), _sampled.get
+
+        @wraps(type_handler)
+        def timed_type_handler(value, context=None):
+            if sampled():
+                return _measure(stage_histogram, type_handler, value)
+            return type_handler(value)
+        return timed_type_handler
+    return decorator
+
+
+def request_started():
+    """
+    Counts a request (that is handled in current context), returns its start time if it's sampled (then its stages are
+    measured until it's finished) or None, to be passed to request_finished.
+    """
+    global _requests
+    _requests += 1
+    sampled = enabled and not _requests % sample_every
+    _sampled.set(sampled)
+    return perf_counter() if sampled else None
+
+
+def request_finished(method, url, status, started):
+    """
+    Records latency of a route (url is None if request hasn't been routed, so all such ones share a histogram) of
+    sampled request started at given time (as returned by request_started). Responses with 4xx / 5xx status failed.
+    """
+    if started is None:
+        return
+    _sampled.set(False)
+    route_histogram = _route_histograms.get((method, url))
+    if route_histogram is None:
+        route_histogram = _route_histograms[method, url] = histogram('route', '{} {}'.format(method, url or 'unmatched'))
+    route_histogram.observe(perf_counter() - started, error=status[0] in '45')
+
+
+_route_histograms = {}  # histograms of route stage by HTTP method and url template
+
+
+class RouteMetrics():
+    """Falcon middleware that samples requests (measuring their routes and stages)"""
+
+    def process_request(self, request, response):
+        request.context['metrics_started'] = request_started()
+
+    def process_response(self, request, response, resource, request_succeeded):
+        request_finished(request.method, request.uri_template, response.status, request.context.get('metrics_started'))
+
+
+def _labels(stage, name, **labels):
+    labels = dict(stage=stage, name=name, **labels)
+    return ','.join('{}="{}"'.format(label, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                    for label, value in labels.items())
+
+
+def export():
+    """
+    Returns all histograms (of stages measured at least once) in Prometheus text format - cumulative buckets, sum and
+    count along with counter of failed calls. Only sampled requests are measured, so counts have to be multiplied by
+    sample ratio (exported as well) to estimate numbers of all calls.
+    """
+    lines = ['# HELP invitation_sample_every One of that many requests is sampled (measured).',
+             '# TYPE invitation_sample_every gauge',
+             'invitation_sample_every {}'.format(sample_every),
+             '# HELP invitation_stage_seconds Latency of request processing stage (of sampled requests).',
+             '# TYPE invitation_stage_seconds histogram']
+    errors = ['# HELP invitation_stage_errors_total Failed calls of request processing stage (of sampled requests).',
+              '# TYPE invitation_stage_errors_total counter']
+    for (stage, name), stage_histogram in sorted(histograms.items()):
+        if not stage_histogram.calls:
+            continue  # not measured yet (i.e. some routes are never called by some workers), so nothing to report
+        counts, total = list(stage_histogram.counts), stage_histogram.sum
+        cumulative = 0
+        for bound, bucket_count in zip(BUCKETS + ('+Inf',), counts):
+            cumulative += bucket_count
+            lines.append('invitation_stage_seconds_bucket{{{}}} {}'.format(_labels(stage, name, le=bound), cumulative))
+        lines.append('invitation_stage_seconds_sum{{{}}} {!r}'.format(_labels(stage, name), total))
+        lines.append('invitation_stage_seconds_count{{{}}} {}'.format(_labels(stage, name), cumulative))
+        errors.append('invitation_stage_errors_total{{{}}} {}'.format(_labels(stage, name), stage_histogram.errors))
+    return '\n'.join(lines + errors + _cache_lines() + _storage_lines() + _admission_lines()) + '\n'
+
+
+CACHE_METRICS = (('hits', 'counter', 'Lookups of response cache that found valid entry (of all requests).'),
+                 ('misses', 'counter', 'Lookups of response cache that found no valid entry (of all requests).'),
+                 ('evictions', 'counter', 'Entries evicted from response cache as it was full.'),
+                 ('invalidations', 'counter', 'Entries dropped from response cache by writes.'),
+                 ('entries', 'gauge', 'Number of entries in response cache.'),
+                 ('bytes', 'gauge', 'Size of response bodies in response cache.'))
+
+
+def _cache_lines():
+    """Returns statistics of response caches in Prometheus text format (hit rate is hits / (hits + misses))"""
+    lines = []
+    for stat, kind, description in CACHE_METRICS:
+        metric = 'invitation_response_cache_{}{}'.format(stat, '_total' if kind == 'counter' else '')
+        lines.extend(['# HELP {} {}'.format(metric, description), '# TYPE {} {}'.format(metric, kind)])
+        lines.extend('{}{{cache="{}"}} {}'.format(metric, name, cache.stats()[stat]) for name, cache in sorted(caches.items()))
+    return lines
+
+
+STORAGE_METRICS = (('expirations', 'counter', 'Instances deleted from model storage as they expired.'),)
+
+
+def _storage_lines():
+    """Returns statistics of models storages in Prometheus text format"""
+    lines, stats = [], {model: model_stats() for model, model_stats in sorted(storage_stats.items())}
+    for stat, kind, description in STORAGE_METRICS:
+        metric = 'invitation_storage_{}{}'.format(stat, '_total' if kind == 'counter' else '')
+        lines.extend(['# HELP {} {}'.format(metric, description), '# TYPE {} {}'.format(metric, kind)])
+        lines.extend('{}{{model="{}"}} {}'.format(metric, model, model_stats[stat]) for model, model_stats in stats.items())
+    return lines
+
+
+ADMISSION_METRICS = (('in_flight', 'gauge', 'Requests being handled (admitted ones).'),
+                     ('queued', 'gauge', 'Requests waiting for their turn to be admitted (queue depth).'),
+                     ('admitted', 'counter', 'Requests admitted (by priority).'),
+                     ('rejected', 'counter', 'Requests rejected - shed (by priority and reason).'))
+
+
+def _admission_lines():
+    """Returns statistics of admission controls in Prometheus text format"""
+    lines, stats = [], {name: control.stats() for name, control in sorted(controls.items())}
+    for stat, kind, description in ADMISSION_METRICS:
+        metric = 'invitation_admission_{}{}'.format(stat, '_total' if kind == 'counter' else '')
+        lines.extend(['# HELP {} {}'.format(metric, description), '# TYPE {} {}'.format(metric, kind)])
+        for name, control_stats in stats.items():
+            if stat == 'admitted':
+                lines.extend('{}{{control="{}",priority="{}"}} {}'.format(metric, name, priority, control_stats[stat][priority])
+                             for priority in PRIORITIES)
+            elif stat == 'rejected':
+                lines.extend('{}{{control="{}",priority="{}",reason="{}"}} {}'.format(
+                    metric, name, priority, reason, control_stats[stat][reason][priority])
+                    for reason in REASONS for priority in PRIORITIES)
+            else:
+                lines.append('{}{{control="{}"}} {}'.format(metric, name, control_stats[stat]))
+    return lines
+
+
+@hug.format.content_type('text/plain; version=0.0.4; charset=utf-8')
+def text(content, **kwargs):
+    """Prometheus text exposition format"""
+    return content.encode('utf-8')
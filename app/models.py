@@ -18,12 +18,50 @@ used by handlers "views").
 # OTHER DEALINGS IN THE SOFTWARE.
 # -----------------------------------------------------------------------------------------------------------------------
 
-from hug.store import InMemoryStore
+from hug.exceptions import StoreKeyNotFound
+
+from metrics import storage_stats, timed
+from stores import ABSENT, ExpiryIndex, HashIndex, NamespacedStore, SortedInMemoryStore, StoreUniqueConflict, StoreVersionConflict
+from stores import store_namespaces
+
+
+_NOT_LOOKED_UP = object()  # marker of model instance data not looked up in storage yet
+
+
+class Key(str):
+    """Pk value that carries instance data already looked up by it (None if not found), so it's not looked up again"""
+    data = version = None
 
 
 class Model():
-    """Simple generic "model" with runtime storage"""
-    _storage = InMemoryStore()  # actually it's just an "opaqued" dict but thanks hug ;)
+    """
+    Simple generic "model" with runtime storage. Instances data is kept in storage as compact records (tuples of
+    fields values, ordered as model fields are) and materialized into dicts only when it's retrieved.
+    Every instance has a version (of its storage record, None if it doesn't exist) that changes whenever it's saved.
+    Pk is indexed by storage keys index (sorted), other fields may have secondary indexes declared (i.e. HashIndex by
+    field name in indexes dict) which are kept in storage and updated along with instances data.
+    Storage keeps data of many namespaces (stores.NamespacedStore), instances are kept in the current one.
+    Optional fields (the last ones) are omitted from records and instance data while they're not set (i.e. expiry time
+    of instance that never expires - instance with stores.ExpiryIndex of such field is deleted by storage once it expires).
+    """
+    # actually it's just an "opaqued" dict (with sorted keys index) but thanks hug ;) - one per namespace (i.e. event)
+    _storage = NamespacedStore(SortedInMemoryStore(), store_namespaces())
+    _found = _NOT_LOOKED_UP
+    version = None
+    optional = []
+    indexes = {}
+    listeners = []  # callables notified with pks of instances changed by every write (i.e. to invalidate caches)
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.listeners = []
+        cls._create_indexes()
+        storage_stats[cls.__name__.lower()] = cls.stats
+
+    @classmethod
+    def _changed(cls, keys):
+        for listener in cls.listeners:
+            listener(keys)
 
     def __init__(self, **fields):
         """Instrumentates a model with appropriate field attributes and runtime storage"""
@@ -32,25 +70,138 @@ class Model():
         model_fields = {field: fields[field] for field in fields if field in self.fields}
         for field in model_fields:
             setattr(self, field, fields[field])
+        key = fields.get(self.pk)
+        if isinstance(key, Key):
+            # instance data has been already looked up (i.e. by validator) so reuse it instead of looking up again
+            setattr(self, self.pk, str(key))
+            self._found, self.version = key.data, key.version
+
+    @classmethod
+    def use_storage(cls, storage):
+        """Replaces runtime storage of model (with any stores.Store implementation, i.e. durable stores.LogStore)"""
+        cls._storage.close()
+        cls._storage = storage
+        cls._create_indexes()
+
+    @classmethod
+    def _create_indexes(cls):
+        """Adds declared secondary indexes (named as indexed fields) of model and its subclasses to model storage"""
+        for field, index in cls.indexes.items():
+            cls._storage.create_index(field, index.bound(field, cls.fields.index(field)))
+        for model in cls.__subclasses__():
+            if model._storage is cls._storage:
+                model._create_indexes()
 
-    def save(self):
+    @classmethod
+    def stats(cls):
+        """Returns statistics of model storage (i.e. number of instances deleted as they expired)"""
+        return cls._storage.stats()
+
+    @classmethod
+    @timed('model', 'Model.current_version')
+    def current_version(cls):
+        """Returns current version of model storage (it changes whenever any instance is saved or deleted)"""
+        return cls._storage.version()
+
+    @classmethod
+    @timed('model', 'Model.lookup')
+    def lookup(cls, key):
+        """
+        Looks up model instance data for given pk (with single storage read).
+        :return: Key (pk) that carries retrieved instance data and its version (or None if no instance found), to be
+        passed to model.
+        """
+        key = Key(key)
+        try:
+            key.data, key.version = cls._storage.get_versioned(key)
+        except StoreKeyNotFound:
+            pass
+        return key
+
+    @classmethod
+    def _as_record(cls, data):
+        """Returns storage record for given instance data (without trailing optional fields that are not set)"""
+        record = tuple(map(data.get, cls.fields))
+        size = len(record)
+        while size > len(cls.fields) - len(cls.optional) and record[size - 1] is None:
+            size -= 1
+        return record[:size]
+
+    @classmethod
+    def _as_data(cls, record):
+        """Returns instance data (dict) for given storage record (or None if there is no record)"""
+        return None if record is None else dict(zip(cls.fields, record))
+
+    @classmethod
+    @timed('model', 'Model.lookup_many')
+    def lookup_many(cls, keys):
+        """
+        Looks up model instances data for given pks (every pk once).
+        :return: Dict of Keys (pks that carry retrieved instance data and its version, see lookup) by pk.
+        """
+        found = {}
+        for key in keys:
+            key = Key(key)
+            try:
+                key.data, key.version = cls._storage.get_versioned(key)
+            except StoreKeyNotFound:
+                pass
+            found[key] = key
+        return found
+
+    def _lookup(self):
+        """Returns instance data (looked up in storage only if it's not been done before) or None if it doesn't exist"""
+        if self._found is _NOT_LOOKED_UP:
+            key = self.lookup(getattr(self, self.pk))
+            self._found, self.version = key.data, key.version
+        return self._found
+
+    @timed('model', 'Model.save')
+    def save(self, version=None):
         """
         Saves model instance. If instance exist will be just updated.
+        Instance is read, updated and written atomically (write is conditional on version of read data, so if it's
+        been changed concurrently, it's read and updated again), so no concurrent change is lost.
+        If version is given, instance is saved only if its stored version is still the same, otherwise
+        stores.StoreVersionConflict is raised.
         :return: Saved instance data
         """
+        while True:
+            try:
+                return self._save(version)
+            except StoreVersionConflict:
+                if version is not None:
+                    raise
+                self._found = _NOT_LOOKED_UP  # changed in the meantime, so look it up again
+
+    @timed('model', 'Model.create')
+    def create(self):
+        """
+        Saves model instance only if it doesn't exist (atomically, so concurrent creates of the same instance don't
+        overwrite each other), otherwise stores.StoreVersionConflict is raised.
+        :return: Saved instance data
+        """
+        self._found = None
+        return self._save(ABSENT)
+
+    def _save(self, version):
+        """Saves model instance (updated if it's been looked up) conditionally on given or looked up version"""
         key = getattr(self, self.pk)
-        if self._storage.exists(key):
+        data = self._as_data(self._lookup())
+        if data is not None:
             # update existing invitee data (only given fields)
-            data = self._storage.get(key)
-            data.update({field: getattr(self, field)
-                         for field in self.fields if getattr(self, field, None) != data[field]})
-            self._storage.set(key, data)
+            data = dict(data)
+            data.update({field: getattr(self, field) for field in self.fields if hasattr(self, field)})
         else:
             # create new invitee data
-            data = {field: getattr(self, field) for field in self.fields}
-            self._storage.set(key, data)
-        return self._storage.get(key)
+            data = {field: getattr(self, field, None) for field in self.fields}
+        record = self._as_record(data)
+        self.version = self._storage.set(key, record, version if version is not None else self.version or ABSENT)
+        self._found = record
+        self._changed((key,))
+        return self._as_data(record)
 
+    @timed('model', 'Model.get')
     def get(self):
         """
         Retrieves model instance for given pk
@@ -59,17 +210,136 @@ class Model():
         key = getattr(self, self.pk)
         if key is None:
             # special case - sorted (by pk field) list of instance data
-            return sorted([v for k, v in self._storage._data.items()], key=lambda data: data[self.pk])
-        return self._storage.get(key) if self._storage.exists(key) else None
+            return [self._as_data(data) for _, data in self._storage.items()]
+        return self._as_data(self._lookup())
+
+    @classmethod
+    @timed('model', 'Model.get_many')
+    def get_many(cls, keys):
+        """
+        Retrieves model instances for given pks (looking up every pk once).
+        :return: Dict of retrieved instances data by pk (pks of non existing instances are omitted).
+        """
+        found = {}
+        for key in keys:
+            try:
+                found[key] = cls._as_data(cls._storage.get(key))
+            except StoreKeyNotFound:
+                pass
+        return found
+
+    @classmethod
+    @timed('model', 'Model.save_many')
+    def save_many(cls, instances, existing=None):
+        """
+        Saves model instances in one storage write. Existing instances will be just updated (only given fields).
+        Write is conditional on versions of instances data (looked up unless instances have been created with Keys that
+        carry it, see lookup_many), so instances changed concurrently are looked up and updated again (no concurrent
+        change is lost). If existing is given, only instances that exist (True) or that don't exist (False) are saved,
+        so i.e. instances created concurrently are not overwritten by creation of the same ones.
+        Instances that would break unique index are not saved (others are).
+        :return: Tuple of list of saved instances data (in order of instances) and dict of errors of instances that are
+                 not saved by pk - StoreVersionConflict if instance exists (or not, depending on existing flag) or
+                 StoreUniqueConflict.
+        """
+        instances, failed = {getattr(instance, cls.pk): instance for instance in instances}, {}
+        while True:
+            records, versions = {}, {}
+            for key, instance in instances.items():
+                data = cls._as_data(instance._lookup())
+                if existing is not None and (data is not None) != existing:
+                    failed[key] = StoreVersionConflict(key)
+                    continue
+                data = dict(data or {})
+                data.update({field: getattr(instance, field) for field in cls.fields if hasattr(instance, field)})
+                records[key], versions[key] = cls._as_record(data), instance.version or ABSENT
+            instances = {key: instances[key] for key in records}
+            if not records:
+                break
+            try:
+                version = cls._storage.set_many(records, versions)
+            except StoreVersionConflict as conflict:
+                for key in conflict.args:  # changed in the meantime, so look them up again
+                    instances[key]._found = _NOT_LOOKED_UP
+                continue
+            except StoreUniqueConflict as conflict:  # (i.e. value has been taken in the meantime)
+                failed[conflict.key] = conflict
+                del instances[conflict.key]
+                continue
+            for key, record in records.items():
+                instances[key]._found, instances[key].version = record, version
+            cls._changed(records)
+            break
+        return [cls._as_data(record) for record in records.values()], failed
+
+    @classmethod
+    @timed('model', 'Model.delete_many')
+    def delete_many(cls, keys):
+        """Deletes model instances for given pks in one storage write (non existing ones are ignored)."""
+        keys = list(keys)
+        cls._storage.delete_many(keys)
+        cls._changed(keys)
+
+    @classmethod
+    @timed('model', 'Model.find')
+    def find(cls, field, value):
+        """
+        Retrieves model instances (sorted by pk) which given field (with declared secondary index) has given value.
+        :return: List of retrieved instances data.
+        """
+        return list(cls.get_many(cls._storage.find(field, value)).values())
+
+    @classmethod
+    @timed('model', 'Model.select')
+    def select(cls, after=None, limit=None, prefix=None):
+        """
+        Retrieves a page of model instances (sorted by pk) that follows given after pk (only ones which pk starts with
+        given prefix if it's given).
+        :return: Tuple of retrieved instances data and pk of the last one or None if there is nothing more to retrieve.
+        """
+        items = cls._storage.items(after=after, limit=None if limit is None else limit + 1, prefix=prefix)  # +1 to look ahead
+        more = limit is not None and len(items) > limit
+        items = items[:limit]
+        return [cls._as_data(data) for _, data in items], items[-1][0] if more else None
 
-    def delete(self):
+    @classmethod
+    @timed('model', 'Model.changes')
+    def changes(cls, since):
+        """
+        Retrieves model instances changed after given version of storage (along with tombstones of deleted ones).
+        Raises stores.StoreChangesExpired if storage doesn't keep all changes made after given version anymore.
+        :return: Tuple of current version of storage and list of changed instances data (ordered by version of their
+        last change) where deleted instances are tombstones - dicts with pk and 'deleted': True.
+        """
+        version, changes = cls._storage.changes(since)
+        return version, [{cls.pk: key, 'deleted': True} if data is None else cls._as_data(data) for key, data in changes]
+
+    @classmethod
+    def iterate(cls, batch=1000, prefix=None, after=None):
+        """
+        Lazily iterates over all model instances data (sorted by pk, only ones which pk starts with given prefix if it's
+        given) that follows given after pk, fetching them from storage in batches (every batch is a consistent snapshot).
+        :return: Generator of instances data (memory usage does not depend on number of instances).
+        """
+        items = cls._storage.items(after=after, limit=batch, prefix=prefix)
+        while items:
+            for _, data in items:
+                yield cls._as_data(data)
+            items = cls._storage.items(after=items[-1][0], limit=batch, prefix=prefix)
+
+    @timed('model', 'Model.delete')
+    def delete(self, version=None):
         """
         Deletes model instance.
+        If version is given, instance is deleted only if its stored version is still the same (atomically), otherwise
+        stores.StoreVersionConflict is raised.
         :return: Deleted object data or None if model instance didn't exist (so nothing to delete)
         """
-        key = getattr(self, self.pk)
-        data = self._storage.get(key) if self._storage.exists(key) else None
-        self._storage.delete(key)  # handles missing key, don't worry
+        data = self._as_data(self._lookup())
+        if data is not None or version is not None:
+            self._storage.delete(getattr(self, self.pk), version)
+            self._found, self.version = None, None
+            self._changed((getattr(self, self.pk),))
         return data
 
     @property
@@ -80,8 +350,11 @@ class Model():
 
 class Invitee(Model):
     """Model for Invitee"""
-    fields = ['invitee', 'email']
+    fields = ['invitee', 'email', 'expires']
     pk = fields[0]
+    optional = ['expires']  # expiry time of invitation (UNIX timestamp), it never expires if it's not set
+    indexes = {'email': HashIndex(unique=False),  # emails may be shared (i.e. by family members), unique=True forbids it
+               'expires': ExpiryIndex()}  # invitations are deleted once they expire (i.e. after the event)
 
     def __init__(self, **fields):
         super().__init__(**fields)
@@ -0,0 +1,48 @@
+"""
+Namespaces of invitees (every event has its own invitees list, kept in its own store).
+"""
+# Copyright (C) 2017 Krystian Rembas
+# -----------------------------------------------------------------------------------------------------------------------
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+# CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# -----------------------------------------------------------------------------------------------------------------------
+
+import re
+
+from falcon import HTTPNotFound
+
+from stores import current_namespace
+
+
+NAMESPACE = re.compile(r'[A-Za-z0-9][A-Za-z0-9_.-]{0,63}$')  # it names directory of durable store as well
+INCORRECT_EVENT_ERROR = 'Event id must be up to 64 letters, digits, "_", "." or "-" characters (not starting with last ones)'
+
+
+def use_namespace(event):
+    """
+    Makes namespace of given event current one (default one if it's None), raises ValueError if event id is wrong.
+    :return: Token to restore previous one (current_namespace.reset(token)).
+    """
+    if event is not None and not NAMESPACE.match(event):
+        raise ValueError(INCORRECT_EVENT_ERROR)
+    return current_namespace.set(event)
+
+
+class Namespaces():
+    """Falcon middleware that makes namespace of event given by route (its event parameter) current one for request"""
+
+    def process_resource(self, request, response, resource, params):
+        try:
+            use_namespace(params.pop('event', None))  # set for every request, as threads are reused
+        except ValueError as error:
+            raise HTTPNotFound(description=str(error))
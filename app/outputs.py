@@ -0,0 +1,77 @@
+"""
+Output formats used by routes (to serialize data returned by request handlers into responses).
+"""
+# Copyright (C) 2017 Krystian Rembas
+# -----------------------------------------------------------------------------------------------------------------------
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+# CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# -----------------------------------------------------------------------------------------------------------------------
+
+import json
+from types import GeneratorType
+
+import hug
+
+from metrics import timed
+
+
+class EncodedJSON():
+    """Content already encoded as JSON (i.e. cached response body), which body is passed through by JSON output format"""
+    __slots__ = ('body',)
+
+    def __init__(self, body):
+        self.body = body
+
+    @staticmethod
+    def encode(content):
+        """Returns given content encoded exactly as JSON output format encodes it"""
+        return hug.output_format.json(content)
+
+
+class JSONArrayStream():
+    """
+    File-like object that lazily encodes items of given iterable as JSON array, chunk by chunk on every read() call
+    (so the whole array is never kept in memory and the first chunk could be sent before encoding has finished).
+    """
+
+    def __init__(self, items, chunk_size=500):
+        self._chunks = self._encode(items, chunk_size)
+
+    @staticmethod
+    def _encode(items, chunk_size):
+        chunk, separator = [], '['
+        for item in items:
+            chunk.append(separator)
+            chunk.append(json.dumps(item, ensure_ascii=False))
+            separator = ','
+            if len(chunk) >= 2 * chunk_size:
+                yield ''.join(chunk).encode('utf8')
+                chunk = []
+        chunk.append('[]' if separator == '[' else ']')
+        yield ''.join(chunk).encode('utf8')
+
+    @timed('serialization', 'json_stream chunk')
+    def read(self, size=-1):
+        """Returns next encoded chunk (of any size, regardless given one) or empty bytes when there is no more data"""
+        return next(self._chunks, b'')
+
+
+@timed('serialization', 'json')
+@hug.format.content_type('application/json; charset=utf-8')
+def json_stream(content, request=None, response=None, **kwargs):
+    """JSON (Javascript Serialized Object Notation), streamed in chunks if content is a generator"""
+    if isinstance(content, GeneratorType):
+        return JSONArrayStream(content)
+    if isinstance(content, EncodedJSON):
+        return content.body
+    return hug.output_format.json(content, request=request, response=response, **kwargs)
@@ -0,0 +1,263 @@
+"""
+Production webserver (pre-forked worker processes with thread pools, HTTP/1.1 keep-alive and graceful reload) that
+serves API with all workers sharing the same storage.
+"""
+# Copyright (C) 2017 Krystian Rembas
+# -----------------------------------------------------------------------------------------------------------------------
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+# CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# -----------------------------------------------------------------------------------------------------------------------
+
+import multiprocessing
+import os
+import selectors
+import signal
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.simple_server import ServerHandler, WSGIRequestHandler, WSGIServer
+
+from admission import BURST, RATE, check_rate
+from stores import NamespacedStore, StoreManager, StoreShards, DURABILITY_SYNC
+
+
+class _Body():
+    """Request body stream that doesn't allow to read more than its content length (and drains what's left unread)"""
+
+    def __init__(self, stream, length):
+        self._stream, self._left = stream, length
+
+    def _size(self, size):
+        return self._left if size is None or size < 0 else min(size, self._left)
+
+    def read(self, size=-1):
+        data = self._stream.read(self._size(size)) if self._left else b''
+        self._left -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        data = self._stream.readline(self._size(size)) if self._left else b''
+        self._left -= len(data)
+        return data
+
+    def drain(self):
+        """Reads what's left unread (so the next request on the same connection could be read)"""
+        while self.read(64 * 1024):
+            pass
+
+
+class _ResponseHandler(ServerHandler):
+    """Response handler that sends responses of unknown length with chunked transfer encoding (if client supports it)"""
+    chunked = False
+
+    def cleanup_headers(self):
+        super().cleanup_headers()
+        request_handler = self.request_handler
+        if 'Content-Length' not in self.headers:
+            if request_handler.request_version == 'HTTP/1.1' and request_handler.command != 'HEAD':
+                self.headers['Transfer-Encoding'] = 'chunked'
+                self.chunked = True
+            else:
+                request_handler.close_connection = True  # the only way to tell client where response ends
+        if request_handler.close_connection or request_handler.server.stopping:
+            request_handler.close_connection = True
+            self.headers['Connection'] = 'close'
+
+    def write(self, data):
+        """Writes response data (as a chunk if chunked transfer encoding is used), headers are sent before first one"""
+        if not self.status:
+            raise AssertionError('write() before start_response()')
+        if not self.headers_sent:
+            self.bytes_sent = len(data)
+            self.send_headers()
+        else:
+            self.bytes_sent += len(data)
+        if not self.chunked:
+            self._write(data)
+        elif data:  # empty chunk would mean end of response
+            self._write(b'%x\r\n%s\r\n' % (len(data), data))
+        self._flush()
+
+    def finish_content(self):
+        super().finish_content()
+        if self.chunked:
+            self._write(b'0\r\n\r\n')
+        self._flush()  # (response without body has been just buffered)
+
+
+class _RequestHandler(WSGIRequestHandler):
+    """
+    Request handler that keeps HTTP/1.1 connection alive (it handles requests until client closes it or it's idle).
+    Responses are buffered, so status line, headers and the first chunk of body are sent at once (and with Nagle's
+    algorithm disabled, so they're not delayed until client acknowledges the previous packet).
+    """
+    protocol_version = 'HTTP/1.1'
+    timeout = 5  # seconds for idle connection to be closed
+    disable_nagle_algorithm = True
+    wbufsize = 64 * 1024  # written data is sent when it's flushed (by response handler) or when buffer is full
+
+    def send_error(self, code, message=None, explain=None):
+        super().send_error(code, message, explain)
+        self.wfile.flush()
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and not self.server.stopping:
+            self.handle_one_request()
+
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except OSError:  # timed out (connection has been idle for too long) or closed by client
+            self.raw_requestline = b''
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+        if len(self.raw_requestline) > 65536:
+            self.requestline, self.request_version, self.command = '', '', ''
+            self.send_error(414)
+            return
+        if not self.parse_request():  # an error code has been sent, just exit
+            return
+        if self.request_version != 'HTTP/1.1':
+            self.close_connection = True  # keep alive only HTTP/1.1 connections
+        try:
+            body = _Body(self.rfile, int(self.headers.get('Content-Length') or 0))
+        except ValueError:
+            self.send_error(400, 'Bad Content-Length')
+            return
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            self.send_error(411)  # chunked request bodies are not supported
+            return
+        handler = _ResponseHandler(body, self.wfile, self.get_stderr(), self.get_environ(), multithread=True)
+        handler.request_handler = self  # backpointer for logging and connection management
+        handler.http_version = self.request_version[len('HTTP/'):]
+        handler.run(self.server.get_app())
+        body.drain()
+
+
+class _WorkerServer(WSGIServer):
+    """WSGI server of worker process, accepts connections on shared listening socket and handles them in threads"""
+    stopping = False
+
+    def __init__(self, listener, app, threads):
+        super().__init__(listener.getsockname()[:2], _RequestHandler, bind_and_activate=False)
+        self.socket.close()
+        self.socket = listener  # already bound and listening (by master process)
+        self.server_name, self.server_port = self.server_address[:2]
+        self.setup_environ()
+        self.set_app(app)
+        self._threads = ThreadPoolExecutor(threads)
+
+    def process_request(self, request, client_address):
+        self._threads.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def serve(self):
+        """Serves until stopping flag is set, then waits for requests in progress to be finished"""
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.socket, selectors.EVENT_READ)
+            while not self.stopping:
+                if selector.select(0.5):
+                    self._handle_request_noblock()  # other worker may have accepted connection first, it's ok
+        self._threads.shutdown(wait=True)
+
+
+def _worker(listener, shard_addresses, store_authkey, store_args, threads, limits):
+    """Worker process, serves API (using shared stores, admitting requests with given limits) until SIGTERM is received"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # it's master process that stops workers
+    import app  # imported by worker (not by master), so workers started by reload use current code
+
+    shards = [StoreManager(address=address, authkey=store_authkey) for address in shard_addresses]
+    for shard in shards:
+        shard.connect()
+    app.Model.use_storage(NamespacedStore(shards[0].Store(*store_args),
+                                          StoreShards([shard.Namespaces(*store_args) for shard in shards])))
+    app.admission_control.configure(**limits)
+    server = _WorkerServer(listener, app.hug_api.http.server(), threads)
+    signal.signal(signal.SIGTERM, lambda signum, frame: setattr(server, 'stopping', True))
+    server.serve()
+
+
+def serve(port=8000, workers=None, threads=16, storage_path=None, durability=DURABILITY_SYNC, rate=RATE, burst=BURST):
+    """
+    Serves API via given number of worker processes (CPU count by default) with given number of threads each. All
+    workers share the same stores (durable ones if storage_path is given) kept by the same number of separate processes
+    (shards) - default one by the first shard and ones of events (namespaces) partitioned among all shards by hash of
+    event id, so work on data of many events is spread among all CPUs.
+    Every worker handles at most as many requests at once as it has threads (others wait for their turn, see
+    admission.py) and, if rate is given, rate limits its clients (rate requests per second with bursts of burst ones).
+    Send SIGHUP to reload gracefully (new workers start serving while old ones finish requests in progress) and SIGTERM
+    or SIGINT (CTRL-C) to stop.
+    """
+    check_rate(rate, burst)  # (before workers are started, they'd fail to configure admission control otherwise)
+    workers = workers or os.cpu_count()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('', port))
+    listener.listen(1024)
+    listener.setblocking(False)  # so worker doesn't block if other one has accepted connection first
+
+    authkey = os.urandom(32)
+    shards = [StoreManager(authkey=authkey) for _ in range(workers)]
+    for shard in shards:
+        shard.start()
+    store_args = (storage_path, durability)
+    store = shards[0].Store(*store_args)  # create (or recover) default store before workers start
+    namespaces = [shard.Namespaces(*store_args) for shard in shards]  # stores of events are loaded lazily
+    shard_addresses = [shard.address for shard in shards]
+    limits = {'max_in_flight': threads, 'rate': rate, 'burst': burst}
+
+    context = multiprocessing.get_context('spawn')
+
+    def start_worker():
+        worker = context.Process(target=_worker,
+                                 args=(listener, shard_addresses, authkey, store_args, threads, limits))
+        worker.start()
+        return worker
+
+    reload, stop = threading.Event(), threading.Event()
+    signal.signal(signal.SIGHUP, lambda signum, frame: reload.set())
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+
+    running, retiring = [start_worker() for _ in range(workers)], []
+    print('Serving on port {} with {} workers ({} threads each)...'.format(port, workers, threads))
+    try:
+        while not stop.wait(0.5):
+            if reload.is_set():
+                reload.clear()
+                retiring += running
+                running = [start_worker() for _ in range(workers)]
+                for worker in retiring:
+                    worker.terminate()  # SIGTERM, so worker finishes requests in progress first
+            running = [worker if worker.is_alive() else start_worker() for worker in running]  # replace dead ones
+            retiring = [worker for worker in retiring if worker.is_alive()]
+    finally:
+        for worker in running + retiring:
+            worker.terminate()
+        for worker in running + retiring:
+            worker.join()
+        store.close()
+        for shard, shard_namespaces in zip(shards, namespaces):
+            shard_namespaces.close()
+            shard.shutdown()
+        listener.close()
@@ -0,0 +1,1224 @@
+"""
+Storage backends used by models (key-value stores that keep model instances data).
+"""
+# Copyright (C) 2017 Krystian Rembas
+# -----------------------------------------------------------------------------------------------------------------------
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+# CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# -----------------------------------------------------------------------------------------------------------------------
+
+import fcntl
+import gc
+import json
+import mmap
+import os
+import pickle
+import shutil
+import threading
+import time
+import zlib
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from heapq import heapify, heappop, heappush
+from multiprocessing.managers import BaseManager
+
+from hug.exceptions import StoreKeyNotFound
+from hug.store import InMemoryStore
+
+
+DURABILITY_NONE = 'none'  # writes are left in OS buffers (survive app crash but not OS crash / power loss)
+DURABILITY_PERIODIC = 'periodic'  # as above but log is fsync-ed periodically (bounded window of possible data loss)
+DURABILITY_SYNC = 'sync'  # write returns when log is fsync-ed (concurrent writes share fsync thanks to group commit)
+
+
+# every key inserted into sorted keys index one by one shifts the rest of it (~0.2ns per shifted key), while sorting whole
+# index again with new keys costs ~150ns per key, so the latter is cheaper for more than a few hundreds of new keys
+INSERT_MAX = 512
+
+# snapshot is pickled in chunks of records, so thread that loads it lets other threads run between chunks (~10ms each)
+SNAPSHOT_CHUNK = 10000
+
+NAMESPACES_DIR = 'namespaces'  # subdirectory of durable store's directory where stores of namespaces are kept
+
+ABSENT = 0  # version of data that doesn't exist (write conditional on it creates data only if it's absent)
+
+USED_VALUE_ERROR = '{} {!r} is already used'  # (value of field with unique index)
+
+
+class StoreVersionConflict(Exception):
+    """
+    Raised by conditional write when data for given store key has other version than expected (or doesn't exist),
+    its arguments are conflicting keys.
+    """
+
+
+class StoreChangesExpired(Exception):
+    """Raised when changes made after given version are requested but some of them are not kept by store anymore"""
+
+
+class StoreInUse(Exception):
+    """Raised when durable store is opened while it's open already (by another process or in the same one)"""
+
+
+class StoreUniqueConflict(Exception):
+    """
+    Raised by write that would make two store keys have the same value of a field with unique index, along with the
+    written key that conflicts and the field.
+    """
+
+    def __init__(self, message, key=None, field=None):
+        super().__init__(message)
+        self.key, self.field = key, field
+
+    def __reduce__(self):  # (so it's raised with its key and field by proxies of shared stores too)
+        return type(self), (self.args[0], self.key, self.field)
+
+
+class HashIndex():
+    """
+    Secondary index of store data by value of a field (of records - tuples of fields values, where field value is at
+    given position) that maps field values to store keys. If it's unique, no two keys may have the same value. Models
+    declare it without field (it's given when model registers index in its store).
+    """
+
+    def __init__(self, unique=False, field=None, position=None):
+        self.unique, self.field, self.position = unique, field, position
+        self._keys = {}  # store key (or set of them if there are many) by field value
+
+    def bound(self, field, position):
+        """Returns new (empty) index of the same kind for given field"""
+        return HashIndex(self.unique, field, position)
+
+    def value_of(self, data):
+        return data[self.position]
+
+    def build(self, items):
+        """
+        Indexes given data (dict of key: data) of store at once, should be called on empty index. Values of all keys are
+        mapped at C speed and only if some of them are the same, data is checked (and added) key by key.
+        """
+        values = list(map(self.value_of, items.values()))
+        self._keys = dict(zip(values, items))
+        if len(self._keys) < len(values):
+            self._keys = {}
+            self.check(items)
+            for key, data in items.items():
+                self.add(key, data)
+
+    def check(self, items):
+        """Raises StoreUniqueConflict if index is unique and data of given keys (dict of key: data) would conflict"""
+        if not self.unique:
+            return
+        taken = {}  # key that would have the value after write, by value
+        for key, data in items.items():
+            value = self.value_of(data)
+            found = taken.setdefault(value, key)
+            if found == key and self._keys.get(value, key) not in items:  # (written key that keeps it is taken above)
+                found = self._keys.get(value, key)
+            if found != key:
+                raise StoreUniqueConflict(USED_VALUE_ERROR.format(self.field, value), key, self.field)
+
+    def add(self, key, data):
+        value = self.value_of(data)
+        found = self._keys.get(value)
+        if found is None:
+            self._keys[value] = key
+        elif isinstance(found, set):
+            found.add(key)
+        elif found != key:
+            self._keys[value] = {found, key}
+
+    def remove(self, key, data):
+        value = self.value_of(data)
+        found = self._keys.get(value)
+        if isinstance(found, set):
+            found.discard(key)
+            if len(found) == 1:
+                self._keys[value] = found.pop()
+        elif found == key:
+            del self._keys[value]
+
+    def find(self, value):
+        """Returns sorted keys which data has given field value"""
+        found = self._keys.get(value)
+        return [] if found is None else sorted(found) if isinstance(found, set) else [found]
+
+
+class ExpiryIndex():
+    """
+    Secondary index of store data by expiry time (value of a field - UNIX timestamp, None if data never expires) kept
+    as min-heap of (expiry time, key) entries, so expired data is found without scanning the store (stores delete it
+    before any operation, see SortedInMemoryStore). Entries of changed or deleted data are left in the heap and skipped
+    when they're popped (heap is rebuilt once they'd outnumber current ones), so every change costs O(log n) and finding
+    expired data O(log n) per key, only when some data has expired.
+    """
+    unique = False
+
+    def __init__(self, field=None, position=None):
+        self.field, self.position = field, position
+        self._expires = {}  # expiry time by key (of data that expires)
+        self._heap = []  # (expiry time, key) entries, the earliest first
+
+    def bound(self, field, position):
+        """Returns new (empty) index for given field"""
+        return ExpiryIndex(field, position)
+
+    def value_of(self, data):
+        return data[self.position] if len(data) > self.position else None  # (records written before field was added)
+
+    def build(self, items):
+        """Indexes given data (dict of key: data) of store at once (heap is built in O(n)), should be called on empty index"""
+        self._expires = {key: expires for key, expires in zip(items, map(self.value_of, items.values()))
+                         if expires is not None}
+        self._heap = [(expires, key) for key, expires in self._expires.items()]
+        heapify(self._heap)
+
+    def check(self, items):
+        """Expiry times don't have to be unique, so nothing may conflict"""
+
+    def add(self, key, data):
+        expires = self.value_of(data)
+        if expires is None:
+            return
+        self._expires[key] = expires
+        heappush(self._heap, (expires, key))
+        if len(self._heap) > 2 * len(self._expires) + 64:  # mostly entries of changed data, so drop them (amortized O(1))
+            self._heap = [(expires, key) for key, expires in self._expires.items()]
+            heapify(self._heap)
+
+    def remove(self, key, data):
+        self._expires.pop(key, None)  # its entry is skipped when it's popped
+
+    def find(self, value):
+        """Returns sorted keys which data expires by given time"""
+        return sorted(key for key, expires in self._expires.items() if expires <= value)
+
+    def due(self, now):
+        """Returns whether some data may have expired by given time (cheap check of the earliest entry)"""
+        return bool(self._heap) and self._heap[0][0] <= now
+
+    def pop_expired(self, now):
+        """Pops entries of data expired by given time, returns their keys"""
+        keys, heap = {}, self._heap
+        while heap and heap[0][0] <= now:
+            expires, key = heappop(heap)
+            if self._expires.get(key) == expires:
+                keys[key] = None
+        return list(keys)
+
+    def expired(self, key, now):
+        """Returns whether data of given key has expired by given time"""
+        expires = self._expires.get(key)
+        return expires is not None and expires <= now
+
+
+def _prefix_end(prefix):
+    """Returns the lowest string greater than all strings starting with given prefix (None if there's no such one)"""
+    prefix = prefix.rstrip(chr(0x10ffff))
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1) if prefix else None
+
+
+class Store():
+    """
+    Interface of storage backends used by models (a hug.store.InMemoryStore compatible key-value store with sorted
+    keys index, bulk writes and versions). Store version is increased by every write and data for every key has the
+    version of its last write, so version of data changes whenever data changes.
+    """
+    blocking = True  # whether store operations may block (on I/O, locks etc.)
+
+    def get(self, key):
+        """Get data for given store key. Raise hug.exceptions.StoreKeyNotFound if key does not exist."""
+        raise NotImplementedError
+
+    def get_versioned(self, key):
+        """Get data for given store key along with its version. Raise StoreKeyNotFound if key does not exist."""
+        raise NotImplementedError
+
+    def exists(self, key):
+        """Return whether key exists or not."""
+        raise NotImplementedError
+
+    def version(self):
+        """Returns version of the store (increased by every write)."""
+        raise NotImplementedError
+
+    def set(self, key, data, version=None):
+        """
+        Set data object for given store key. If version is given, data is set only if current data for the key has
+        this version (compare-and-set, ABSENT version creates data only if it doesn't exist), otherwise
+        StoreVersionConflict is raised.
+        :return: New version of data for the key
+        """
+        raise NotImplementedError
+
+    def delete(self, key, version=None):
+        """
+        Delete data for given store key (if it exists). If version is given, data is deleted only if it has this
+        version, otherwise StoreVersionConflict is raised.
+        """
+        raise NotImplementedError
+
+    def set_many(self, items, versions=None):
+        """
+        Set data objects for given store keys (dict of key: data) in one step, returns new version of them. If versions
+        are given (dict of key: version, ABSENT for data that mustn't exist), data is set only if current data for all
+        of given keys has these versions, otherwise StoreVersionConflict (with all conflicting keys) is raised and
+        nothing is set.
+        """
+        version = None
+        for key, data in items.items():
+            version = self.set(key, data, (versions or {}).get(key))
+        return version
+
+    def delete_many(self, keys):
+        """Delete data for given store keys in one step."""
+        for key in keys:
+            self.delete(key)
+
+    def keys(self, after=None, limit=None, prefix=None):
+        """
+        Returns sorted keys (at most limit of them) that follows given after key (or all keys from the beginning),
+        only ones starting with given prefix if it's given.
+        """
+        raise NotImplementedError
+
+    def items(self, after=None, limit=None, prefix=None):
+        """Returns (key, data) pairs for keys that keys method returns for the same arguments."""
+        items = []
+        for key in self.keys(after, limit, prefix):
+            try:
+                items.append((key, self.get(key)))
+            except StoreKeyNotFound:
+                pass  # deleted in the meantime
+        return items
+
+    def create_index(self, name, index):
+        """Adds given secondary index (i.e. HashIndex) of store data under given name (and indexes current data)."""
+        raise NotImplementedError
+
+    def find(self, name, value):
+        """Returns sorted keys which data has given value of field indexed by index with given name."""
+        raise NotImplementedError
+
+    def changes(self, since):
+        """
+        Returns version of the store and changes made after given version - (key, data) pairs of changed keys (every
+        key once, ordered by version of its last change) where data is None if key has been deleted (tombstone).
+        Raises StoreChangesExpired if some of changes made after given version are not kept anymore.
+        """
+        raise NotImplementedError
+
+    def stats(self):
+        """Returns statistics of store (as a dict) - number of data deleted as it expired so far."""
+        return {'expirations': 0}
+
+    def close(self):
+        """Releases resources used by store (if any)."""
+
+
+class SortedInMemoryStore(InMemoryStore, Store):
+    """
+    In memory store that maintains sorted index of its keys (updated incrementally on every write) and versions.
+    Versions are not persisted, they start from current time (in microseconds) instead, so they keep increasing when
+    store is created again (i.e. after restart) and versions handed out before are never reused.
+    Data is always changed before its version, so version read before data is never newer than the data.
+    Secondary indexes are updated along with data (writes that would break unique index fail before changing any).
+    It's thread-safe without one global lock held for whole operations: writes of a key are serialized by the lock of
+    its stripe (one of striped locks, so conditional writes of other keys are not blocked), shared structures (keys
+    index, versions and secondary indexes) are changed under a short lock and reads take no lock at all (pages of keys
+    or items are read again if any write has happened meanwhile, like seqlock does, so they are consistent snapshots).
+    Keys changed by last changelog_size changes (at least) are kept in change log along with versions of changes, so
+    changes made after any of these versions can be retrieved (in time proportional to their number).
+    If it has ExpiryIndex, data is deleted (as by delete_many) once it expires - every operation deletes expired data
+    first (readers wait meanwhile), so it's never read, and costs just a check of the earliest expiry time otherwise.
+    """
+    blocking = False
+
+    def __init__(self, stripes=64, changelog_size=10000):
+        super().__init__()
+        self._keys = []  # sorted index of all keys kept in store
+        self._version = self._initial_version = time.time_ns() // 1000
+        self._versions = {}  # version of data by key (data that hasn't been written since store creation has none)
+        # secondary indexes by name (store initialized again, i.e. cleared, keeps them but empty)
+        self._indexes = {name: index.bound(index.field, index.position)
+                         for name, index in getattr(self, '_indexes', {}).items()}
+        self._stripes = [threading.Lock() for _ in range(stripes)]  # locks of keys (by hash of key)
+        self._write_lock = threading.Lock()  # guards changes of data and shared structures
+        self._sequence = 0  # sequence number of changes, odd while change is being made (so readers know they should wait)
+        self.changelog_size = changelog_size
+        self._changed_keys, self._changed_versions = [], []  # change log (keys changed and versions of changes)
+        self._expired = self._initial_version  # version of the last change dropped from change log (or of store creation)
+        self._expiry = next((index for index in self._indexes.values() if isinstance(index, ExpiryIndex)), None)
+        self._expiring = threading.Lock()  # held while expired data is being deleted
+        self.expirations = 0
+
+    def _stripe(self, key):
+        """Returns lock of given key (the same one for all keys in its stripe)"""
+        return self._stripes[hash(key) % len(self._stripes)]
+
+    @contextmanager
+    def _stripes_of(self, keys):
+        """Holds locks of given keys (acquired in fixed order, so concurrent writes of many keys don't deadlock)"""
+        locks = [self._stripes[stripe] for stripe in sorted({hash(key) % len(self._stripes) for key in keys})]
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    @contextmanager
+    def _changing(self):
+        """Holds write lock while shared structures are changed (sequence number is odd meanwhile)"""
+        with self._write_lock:
+            self._sequence += 1
+            try:
+                yield
+            finally:
+                self._sequence += 1
+
+    def _read(self, read, *args):
+        """Calls given read function (without any lock) until no write has happened while it was called"""
+        while True:
+            sequence = self._sequence
+            if not sequence & 1:
+                try:
+                    result = read(*args)
+                except Exception:
+                    if sequence == self._sequence:
+                        raise
+                else:
+                    if sequence == self._sequence:
+                        return result
+            time.sleep(0)  # let the writer finish
+
+    def _expire(self):
+        """Deletes expired data (if store has ExpiryIndex), waits if other thread is deleting it"""
+        expiry = self._expiry
+        if expiry is None:
+            return
+        now = time.time()
+        if not expiry.due(now) and not self._expiring.locked():
+            return
+        with self._expiring:
+            with self._write_lock:
+                keys = expiry.pop_expired(now)
+            if keys:
+                with self._stripes_of(keys):
+                    self._delete_expired([key for key in keys if expiry.expired(key, now)])  # (unless written meanwhile)
+
+    def _delete_expired(self, keys):
+        """Deletes given expired keys, should be called with locks of the keys acquired"""
+        self._delete_many(keys)
+        self.expirations += len(keys)
+
+    def _version_of(self, key):
+        """Returns version of data for given key (ABSENT if it doesn't exist)"""
+        return self._versions.get(key, self._initial_version if key in self._data else ABSENT)
+
+    def _check_version(self, key, version):
+        """Raises StoreVersionConflict if version is given and data for given key doesn't have it"""
+        if version is not None and self._version_of(key) != version:
+            raise StoreVersionConflict(key)
+
+    def _check_versions(self, versions):
+        """Raises StoreVersionConflict (with all conflicting keys) if data for given keys doesn't have given versions"""
+        conflicts = [key for key, version in (versions or {}).items() if self._version_of(key) != version]
+        if conflicts:
+            raise StoreVersionConflict(*conflicts)
+
+    def get(self, key):
+        """Get data for given store key. Raise hug.exceptions.StoreKeyNotFound if key does not exist."""
+        self._expire()
+        return super().get(key)
+
+    def exists(self, key):
+        """Return whether key exists or not."""
+        self._expire()
+        return key in self._data
+
+    def get_versioned(self, key):
+        """Get data for given store key along with its version. Raise StoreKeyNotFound if key does not exist."""
+        version = self._versions.get(key, self._initial_version)
+        return self.get(key), version
+
+    def version(self):
+        """Returns version of the store (increased by every write)."""
+        self._expire()
+        return self._version
+
+    def set(self, key, data, version=None):
+        """
+        Set data object for given store key (indexing key if it's a new one). If version is given, data is set only
+        if current data for the key has this version (ABSENT if it doesn't exist), otherwise StoreVersionConflict is
+        raised.
+        :return: New version of data for the key
+        """
+        self._expire()
+        with self._stripe(key):
+            return self._set(key, data, version)
+
+    def _set(self, key, data, version):
+        """Sets data for given key, should be called with lock of the key acquired"""
+        self._check_version(key, version)
+        with self._write_lock:  # (as _changing does, inlined as it's the hottest write)
+            for index in self._indexes.values():
+                index.check({key: data})
+            self._sequence += 1
+            try:
+                if key not in self._data:
+                    insort(self._keys, key)
+                elif self._indexes:
+                    self._unindex(key, self._data[key])
+                self._data[key] = data
+                if self._indexes:
+                    self._index(key, data)
+                self._version += 1
+                self._versions[key] = self._version
+                self._changed_keys.append(key)
+                self._changed_versions.append(self._version)
+                if len(self._changed_keys) >= 2 * self.changelog_size:
+                    self._trim_changelog()
+            finally:
+                self._sequence += 1
+            return self._version
+
+    def delete(self, key, version=None):
+        """
+        Delete data for given store key (and remove key from index). If version is given, data is deleted only if it
+        has this version, otherwise StoreVersionConflict is raised.
+        """
+        self._expire()
+        with self._stripe(key):
+            self._delete(key, version)
+
+    def _delete(self, key, version):
+        """Deletes data for given key, should be called with lock of the key acquired"""
+        self._check_version(key, version)
+        if key in self._data:
+            with self._changing():
+                del self._keys[bisect_left(self._keys, key)]
+                self._unindex(key, self._data.pop(key))
+                self._versions.pop(key, None)
+                self._version += 1
+                self._log_changes((key,))
+
+    def set_many(self, items, versions=None):
+        """
+        Set data objects for given store keys (dict of key: data) in one step, returns new version of them. If versions
+        are given (dict of key: version, ABSENT for data that mustn't exist), data is set only if current data for all
+        of given keys has these versions (checked with locks of the keys held, so it's atomic), otherwise
+        StoreVersionConflict (with all conflicting keys) is raised and nothing is set.
+        """
+        self._expire()
+        with self._stripes_of(items):
+            return self._set_many(items, versions)
+
+    def _set_many(self, items, versions=None):
+        """Sets data for given keys (if they have given versions), should be called with locks of the keys acquired"""
+        self._check_versions(versions)
+        with self._changing():
+            for index in self._indexes.values():
+                index.check(items)
+            new_keys = sorted(key for key in items if key not in self._data)
+            if len(new_keys) <= INSERT_MAX:  # cheaper to insert few keys one by one than sort whole index again
+                for key in new_keys:
+                    insort(self._keys, key)
+            else:
+                self._keys = sorted(self._keys + new_keys)  # both are sorted runs, so it's just a (C speed) merge
+            if self._indexes:
+                for key, data in items.items():
+                    if key in self._data:
+                        self._unindex(key, self._data[key])
+                    self._index(key, data)
+            self._data.update(items)
+            self._version += 1
+            self._versions.update(dict.fromkeys(items, self._version))
+            self._log_changes(items)
+            return self._version
+
+    def delete_many(self, keys):
+        """Delete data for given store keys in one step."""
+        keys = set(keys)
+        self._expire()
+        with self._stripes_of(keys):
+            self._delete_many(keys)
+
+    def _delete_many(self, keys):
+        """Deletes data for given keys, should be called with locks of the keys acquired"""
+        keys = {key for key in keys if key in self._data}
+        if not keys:
+            return
+        with self._changing():
+            if len(keys) * 16 < len(self._keys):
+                for key in keys:
+                    del self._keys[bisect_left(self._keys, key)]
+            else:
+                self._keys = [key for key in self._keys if key not in keys]
+            for key in keys:
+                self._unindex(key, self._data.pop(key))
+                self._versions.pop(key, None)
+            self._version += 1
+            self._log_changes(keys)
+
+    def _log_changes(self, keys):
+        """Appends changes of given keys (made with current version) to change log"""
+        self._changed_keys.extend(keys)
+        self._changed_versions.extend([self._version] * len(keys))
+        if len(self._changed_keys) >= 2 * self.changelog_size:
+            self._trim_changelog()
+
+    def _trim_changelog(self):
+        """Drops the oldest changes beyond changelog_size (it's done once log is twice as long, so it's amortized O(1))"""
+        dropped = len(self._changed_keys) - self.changelog_size
+        self._expired = self._changed_versions[dropped - 1]
+        del self._changed_keys[:dropped], self._changed_versions[:dropped]
+
+    def keys(self, after=None, limit=None, prefix=None):
+        """
+        Returns sorted keys (at most limit of them) that follows given after key (or all keys from the beginning),
+        only ones starting with given prefix if it's given. Cost is O(log n + limit) as keys (and range of keys with
+        the prefix) are located by bisection of the index.
+        """
+        self._expire()
+        return self._read(self._keys_page, after, limit, prefix)
+
+    def _keys_page(self, after, limit, prefix):
+        keys = self._keys
+        start = 0 if after is None else bisect_right(keys, after)
+        stop = len(keys)
+        if prefix:
+            start = max(start, bisect_left(keys, prefix))
+            end = _prefix_end(prefix)
+            if end is not None:
+                stop = bisect_left(keys, end, start)
+        if limit is not None:
+            stop = min(stop, start + limit)
+        return keys[start:stop]
+
+    def items(self, after=None, limit=None, prefix=None):
+        """
+        Returns (key, data) pairs for keys that keys method returns for the same arguments, read at once (so they're
+        consistent snapshot of a page of data).
+        """
+        self._expire()
+        return self._read(self._items_page, after, limit, prefix)
+
+    def _items_page(self, after, limit, prefix):
+        data = self._data
+        return [(key, data[key]) for key in self._keys_page(after, limit, prefix)]
+
+    def _index(self, key, data):
+        for index in self._indexes.values():
+            index.add(key, data)
+
+    def _unindex(self, key, data):
+        for index in self._indexes.values():
+            index.remove(key, data)
+
+    def create_index(self, name, index):
+        """Adds given secondary index (i.e. HashIndex) of store data under given name (and indexes current data)."""
+        with self._changing():
+            index = index.bound(index.field, index.position)
+            index.build(self._data)
+            self._indexes[name] = index
+            if isinstance(index, ExpiryIndex):
+                self._expiry = index
+
+    def find(self, name, value):
+        """
+        Returns sorted keys which data has given value of field indexed by index with given name. Cost is O(1) (plus
+        sorting of found keys).
+        """
+        self._expire()
+        return self._read(self._indexes[name].find, value)
+
+    def changes(self, since):
+        """
+        Returns version of the store and changes made after given version - (key, data) pairs of changed keys (every
+        key once, ordered by version of its last change) where data is None if key has been deleted (tombstone).
+        Raises StoreChangesExpired if some of changes made after given version have been dropped from change log.
+        Cost is O(log n + number of changes) as the first change is located by bisection of the log (expired data
+        is reported as deleted).
+        """
+        self._expire()
+        return self._read(self._changes_since, since)
+
+    def _changes_since(self, since):
+        if since < self._expired:
+            raise StoreChangesExpired(since)
+        start = bisect_right(self._changed_versions, since)
+        keys = list(dict.fromkeys(reversed(self._changed_keys[start:])))  # the last change of every key only
+        data = self._data
+        return self._version, [(key, data.get(key)) for key in reversed(keys)]
+
+    def stats(self):
+        """Returns statistics of store (as a dict) - number of data deleted as it expired so far."""
+        return {'expirations': self.expirations}
+
+
+@contextmanager
+def _gc_paused():
+    """Pauses cyclic garbage collector (it would traverse objects loaded so far many times while millions are loaded)"""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+class LogStore(SortedInMemoryStore):
+    """
+    Durable store that keeps all data in memory (as SortedInMemoryStore does) and persists every write in append-only
+    log (JSON line per write) which is periodically compacted into a snapshot (chunks of pickled keys, sorted, and data).
+    Data objects have to be JSON serializable (tuples are written as JSON arrays and read back as tuples).
+    Store is opened at once and data is recovered in background thread - by loading the snapshot (mmap-ed) and replaying
+    only the log written after it. Operations wait until data is recovered, except for creating indexes (they're built
+    along with recovered data, so model that starts using store doesn't wait).
+    """
+    SNAPSHOT_FILE, LOG_FILE, OLD_LOG_FILE = 'snapshot.pickle', 'log.ndjson', 'log.ndjson.old'
+    LOCK_FILE = 'lock'  # locked exclusively while store is open, so no two stores write the same files
+    blocking = True
+
+    def __init__(self, path, durability=DURABILITY_SYNC, compact_after=100000, sync_interval=1.0):
+        if durability not in (DURABILITY_NONE, DURABILITY_PERIODIC, DURABILITY_SYNC):
+            raise ValueError('Unknown durability level: {}'.format(durability))
+        super().__init__()
+        self.path, self.durability, self.compact_after = path, durability, compact_after
+        self._lock = threading.Lock()  # guards data changes along with pending log lines and log sequence numbers
+        self._commit_lock = threading.Lock()  # only one writer (group commit leader) writes log file at a time
+        self._pending, self._logged, self._committed, self._log_size = [], 0, 0, 0
+        self._closed, self._compacting = threading.Event(), False
+        self._loaded, self._load_error, self._deferred_indexes, self._log = threading.Event(), None, {}, None
+        os.makedirs(path, exist_ok=True)
+        self._lock_file = open(self._file(self.LOCK_FILE), 'a')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_file.close()
+            raise StoreInUse('Store {} is open already (i.e. by another process)'.format(path))
+        threading.Thread(target=self._load, args=(sync_interval,), daemon=True).start()
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _load(self, sync_interval):
+        """Recovers data and opens the log, then builds indexes created meanwhile (runs in background thread)"""
+        try:
+            self._recover()
+            self._log = open(self._file(self.LOG_FILE), 'a', encoding='utf-8')
+            with self._lock:
+                for name, index in self._deferred_indexes.items():
+                    super().create_index(name, index)
+                self._loaded.set()
+        except Exception as error:
+            self._load_error = error
+            self._loaded.set()
+            return
+        if self.durability == DURABILITY_PERIODIC:
+            threading.Thread(target=self._sync_periodically, args=(sync_interval,), daemon=True).start()
+
+    def _wait_loaded(self):
+        """Waits until data is recovered, raises exception that recovery has failed with (if any)"""
+        if not self._loaded.is_set():
+            self._loaded.wait()
+        if self._load_error is not None:
+            raise self._load_error
+
+    def _recover(self):
+        """Loads snapshot and replays logs written after it (including old one left by interrupted compaction)"""
+        if os.path.exists(self._file(self.SNAPSHOT_FILE)):
+            with open(self._file(self.SNAPSHOT_FILE), 'rb') as snapshot:
+                with mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    while data.tell() < len(data):
+                        with _gc_paused():
+                            keys, records = pickle.load(data)
+                        self._keys += keys
+                        self._data.update(records if isinstance(records, dict) else zip(keys, records))  # (or whole data)
+        for name in (self.OLD_LOG_FILE, self.LOG_FILE):
+            if os.path.exists(self._file(name)):
+                self._log_size += self._replay(self._file(name))
+        if os.path.exists(self._file(self.OLD_LOG_FILE)):
+            # previous compaction was interrupted, so finish it now (before the old log could be overwritten)
+            self._write_snapshot((self._keys, self._data))
+            open(self._file(self.LOG_FILE), 'w').close()
+            self._log_size = 0
+
+    def _replay(self, log_path):
+        """Applies writes from given log, returns number of replayed writes"""
+        replayed, valid_size = 0, 0
+        with open(log_path, 'rb') as log:
+            for line in log:
+                try:
+                    operation, key, data = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    break  # torn write (at the very end of log) after crash, skip it
+                if operation == 'set':
+                    self._set(key, tuple(data) if isinstance(data, list) else data, None)
+                else:
+                    self._delete(key, None)
+                replayed, valid_size = replayed + 1, valid_size + len(line)
+        if valid_size < os.path.getsize(log_path):
+            os.truncate(log_path, valid_size)  # so next writes are not appended to the torn one
+        return replayed
+
+    @staticmethod
+    def _line(operation, key, data=None):
+        return json.dumps([operation, key, data], ensure_ascii=False) + '\n'
+
+    def _append(self, lines):
+        """Adds given lines to pending ones, should be called (with lock acquired) just after data has been changed"""
+        self._pending.extend(lines)
+        self._log_size += len(lines)
+        self._logged += 1
+        return self._logged
+
+    def _commit(self, sequence):
+        """
+        Writes pending lines (up to given sequence number at least) to the log. Writers that came while other one
+        was writing wait for it and then the first of them writes (and fsyncs) all lines pending so far, so concurrent
+        writes share single write and fsync (group commit).
+        """
+        with self._commit_lock:
+            if self._committed < sequence:
+                self._write_pending(fsync=self.durability == DURABILITY_SYNC)
+        if self._log_size > self.compact_after and not self._compacting:
+            threading.Thread(target=self.compact, daemon=True).start()
+
+    def _write_pending(self, fsync):
+        """Writes pending lines to the log, should be called with commit lock acquired"""
+        with self._lock:
+            lines, self._pending, sequence = self._pending, [], self._logged
+        self._log.write(''.join(lines))
+        self._log.flush()
+        if fsync:
+            os.fsync(self._log.fileno())
+        self._committed = sequence
+
+    def _sync_periodically(self, interval):
+        while not self._closed.wait(interval):
+            self.sync()
+
+    def sync(self):
+        """Writes all pending lines to the log and fsyncs it."""
+        self._wait_loaded()
+        with self._commit_lock:
+            self._write_pending(fsync=True)
+
+    # log lines are encoded while only locks of written keys are held (writes of the same key are logged in order)
+
+    def set(self, key, data, version=None):
+        """Set data object for given store key (and log it), conditionally if version is given (see Store.set)."""
+        self._expire()
+        with self._stripe(key):
+            line = self._line('set', key, data)
+            with self._lock:
+                version = self._set(key, data, version)
+                sequence = self._append([line])
+        self._commit(sequence)
+        return version
+
+    def _expire(self):
+        self._wait_loaded()  # (every operation of store expires data first)
+        super()._expire()
+
+    def get_versioned(self, key):
+        """Get data for given store key along with its version. Raise StoreKeyNotFound if key does not exist."""
+        self._wait_loaded()
+        return super().get_versioned(key)
+
+    def delete(self, key, version=None):
+        """Delete data for given store key (and log it, if it existed), conditionally if version is given."""
+        self._expire()
+        with self._stripe(key):
+            with self._lock:
+                if key not in self._data and version is None:
+                    return
+                self._delete(key, version)
+                sequence = self._append([self._line('del', key)])
+        self._commit(sequence)
+
+    def set_many(self, items, versions=None):
+        """
+        Set data objects for given store keys (dict of key: data) in one step (and single log write), conditionally if
+        versions are given (see SortedInMemoryStore.set_many).
+        """
+        self._expire()
+        with self._stripes_of(items):
+            lines = [self._line('set', key, data) for key, data in items.items()]
+            with self._lock:
+                version = self._set_many(items, versions)
+                sequence = self._append(lines)
+        self._commit(sequence)
+        return version
+
+    def delete_many(self, keys):
+        """Delete data for given store keys in one step (and single log write)."""
+        self._expire()
+        keys = set(keys)
+        with self._stripes_of(keys):
+            with self._lock:
+                keys = [key for key in keys if key in self._data]
+                self._delete_many(keys)
+                sequence = self._append([self._line('del', key) for key in keys])
+        self._commit(sequence)
+
+    def _delete_expired(self, keys):
+        """
+        Deletes given expired keys (and logs it), should be called with locks of the keys acquired. Log isn't written
+        until the next write, as expired data lost by crash would be deleted again after recovery anyway.
+        """
+        with self._lock:
+            keys = [key for key in keys if key in self._data]
+            self._delete_many(keys)
+            self.expirations += len(keys)
+            self._append([self._line('del', key) for key in keys])
+
+    def create_index(self, name, index):
+        """
+        Adds given secondary index of store data under given name (and indexes current data, once it's recovered if it's
+        being recovered).
+        """
+        with self._lock:
+            if not self._loaded.is_set():
+                self._deferred_indexes[name] = index
+                return
+            super().create_index(name, index)
+
+    def compact(self):
+        """
+        Writes snapshot of current data and drops the log written before it. Writes are blocked only while the log is
+        switched and data is copied (shallow copy), the snapshot itself is written while other writes go on (it's
+        called in a separate thread once log exceeds compact_after writes). If previous compaction has failed to write
+        snapshot, the log is appended to old one left by it (not replacing it, as it's not in any snapshot yet).
+        """
+        self._wait_loaded()
+        with self._commit_lock:
+            if self._compacting:
+                return
+            self._compacting = True
+            self._write_pending(fsync=True)
+            with self._lock:
+                self._log.close()
+                if os.path.exists(self._file(self.OLD_LOG_FILE)):
+                    self._append_to_old_log()
+                else:
+                    os.replace(self._file(self.LOG_FILE), self._file(self.OLD_LOG_FILE))
+                self._log = open(self._file(self.LOG_FILE), 'w', encoding='utf-8')
+                snapshot, self._log_size = (list(self._keys), dict(self._data)), 0
+        try:
+            self._write_snapshot(snapshot)
+        finally:
+            self._compacting = False
+
+    def _append_to_old_log(self):
+        """
+        Appends the log to old one and fsyncs it (the log is truncated afterwards, if it's not, its writes are replayed
+        twice after crash - with the same result)
+        """
+        with open(self._file(self.LOG_FILE), 'rb') as log, open(self._file(self.OLD_LOG_FILE), 'ab') as old_log:
+            shutil.copyfileobj(log, old_log)
+            old_log.flush()
+            os.fsync(old_log.fileno())
+
+    def _write_snapshot(self, snapshot):
+        """Durably replaces snapshot with given one and removes old log (already included in the snapshot)"""
+        keys, data = snapshot
+        with open(self._file(self.SNAPSHOT_FILE + '.tmp'), 'wb') as snapshot_file:
+            for start in range(0, len(keys) or 1, SNAPSHOT_CHUNK):  # (at least one chunk, as empty file can't be mmap-ed)
+                chunk = keys[start:start + SNAPSHOT_CHUNK]
+                pickle.dump((chunk, [data[key] for key in chunk]), snapshot_file, protocol=pickle.HIGHEST_PROTOCOL)
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(self._file(self.SNAPSHOT_FILE + '.tmp'), self._file(self.SNAPSHOT_FILE))
+        os.unlink(self._file(self.OLD_LOG_FILE))
+        fd = os.open(self.path, os.O_RDONLY)  # fsync directory too, so renames / removals are durable
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        """Writes (and fsyncs) all pending lines to the log and closes it (once data is recovered), then unlocks store."""
+        self._closed.set()
+        self._loaded.wait()
+        if self._log is not None:
+            self.sync()
+            self._log.close()
+        self._lock_file.close()  # (which releases the lock)
+
+
+# Namespaces (many independent stores, i.e. invitees lists of many events, used by the same model)
+
+STORE_OPERATIONS = ('get', 'get_versioned', 'exists', 'version', 'set', 'delete', 'set_many', 'delete_many', 'keys',
+                    'items', 'find', 'changes')
+CREATING_OPERATIONS = ('set', 'set_many')  # the only ones that create store of namespace (others don't change empty one)
+
+current_namespace = ContextVar('current_namespace', default=None)  # set for every request (None for default store)
+
+
+class _Loaded():
+    """Store of a namespace (loaded or being loaded) along with number of its current users and time of last use"""
+    __slots__ = ('store', 'error', 'ready', 'closed', 'users', 'used')
+
+    def __init__(self):
+        self.store, self.error, self.users, self.used = None, None, 0, 0
+        self.ready, self.closed = threading.Event(), threading.Event()
+
+
+class StoreNamespaces():
+    """
+    Stores of namespaces, created by given factory (called with namespace) lazily - when namespace is written for the
+    first time. Namespace that has no store (neither loaded one nor one that exists, i.e. on disk) is read from an
+    empty store, so reads (i.e. of made up namespaces) don't create stores. If stores are evictable (durable ones, that
+    can be loaded again), the ones unused for idle_timeout seconds and the least recently used ones beyond max_loaded
+    are closed and dropped from memory (never while they're used), so only hot namespaces take memory. Eviction is
+    checked whenever a store is used.
+    """
+
+    def __init__(self, factory, exists=None, evictable=False, max_loaded=1000, idle_timeout=600):
+        self._factory, self._evictable, self._max_loaded, self._idle_timeout = factory, evictable, max_loaded, idle_timeout
+        self._exists = exists or (lambda namespace: False)  # whether store of namespace exists (besides loaded ones)
+        self._empty = SortedInMemoryStore()  # read instead of stores of namespaces that don't exist (never written)
+        self.blocking = evictable  # evictable stores are loaded (from disk) again, so using them may block
+        self._stores = OrderedDict()  # loaded stores by namespace, the least recently used first
+        self._closing = {}  # evicted stores being closed by namespace (they're loaded again once they're closed)
+        self._indexes = {}  # secondary indexes added to every store
+        self._lock = threading.Lock()
+        self.loads = self.evictions = self.expirations = 0  # (expirations of stores that aren't loaded anymore)
+
+    def call(self, namespace, operation, *args, **kwargs):
+        """Calls given operation (method) of store of given namespace with given arguments, returns its result"""
+        loaded = self._stores.get(namespace)
+        if loaded is not None and loaded.store is not None and not self._evictable:  # never evicted, so not tracked
+            return getattr(loaded.store, operation)(*args, **kwargs)
+        if loaded is None and operation not in CREATING_OPERATIONS and not self._exists(namespace):
+            return getattr(self._empty, operation)(*args, **kwargs)
+        loaded = self._acquire(namespace)
+        try:
+            return getattr(loaded.store, operation)(*args, **kwargs)
+        finally:
+            self._release(loaded)
+
+    def _acquire(self, namespace):
+        """Returns loaded store of given namespace (loading it if it's needed), it's not evicted until it's released"""
+        with self._lock:
+            loaded = self._stores.get(namespace)
+            if loaded is None:
+                loaded = self._stores[namespace] = _Loaded()
+                loading, closing = True, self._closing.get(namespace)
+            else:
+                self._stores.move_to_end(namespace)
+                loading = False
+            loaded.users += 1
+        if loading:
+            self._load(namespace, loaded, closing)
+        elif not loaded.ready.is_set():  # waiting takes a lock even if it's set already
+            loaded.ready.wait()
+        if loaded.error is not None:
+            raise loaded.error
+        return loaded
+
+    def _load(self, namespace, loaded, closing):
+        if closing is not None:
+            closing.closed.wait()  # the same store mustn't be opened again before it's closed
+        try:
+            store = self._factory(namespace)
+            for name, index in list(self._indexes.items()):
+                store.create_index(name, index)
+        except Exception as error:
+            with self._lock:
+                if self._stores.get(namespace) is loaded:
+                    del self._stores[namespace]  # so it's loaded again next time
+            loaded.error = error
+        else:
+            loaded.store = store
+            self.loads += 1
+        loaded.ready.set()
+
+    def _release(self, loaded):
+        with self._lock:
+            loaded.users -= 1
+            loaded.used = time.monotonic()
+            evicted = self._evict(loaded.used) if self._evictable else ()
+        for namespace, loaded in evicted:
+            loaded.store.close()
+            loaded.closed.set()
+            with self._lock:
+                self.expirations += loaded.store.stats()['expirations']
+                if self._closing.get(namespace) is loaded:
+                    del self._closing[namespace]
+
+    def _evict(self, now):
+        """Drops unused stores beyond max_loaded or idle for too long (should be called with lock acquired)"""
+        evicted, excess = [], len(self._stores) - self._max_loaded
+        for namespace, loaded in self._stores.items():  # the least recently used first, so it stops on the first hot one
+            if excess <= 0 and now - loaded.used < self._idle_timeout:
+                break
+            if not loaded.users:
+                evicted.append((namespace, loaded))
+                excess -= 1
+        for namespace, loaded in evicted:
+            self._closing[namespace] = self._stores.pop(namespace)
+        self.evictions += len(evicted)
+        return evicted
+
+    def create_index(self, name, index):
+        """Adds given secondary index (under given name) to stores of all namespaces (loaded and ones loaded later)."""
+        with self._lock:
+            self._indexes[name] = index
+            stores = list(self._stores.values())
+        self._empty.create_index(name, index)
+        for loaded in stores:
+            loaded.ready.wait()
+            if loaded.store is not None:
+                loaded.store.create_index(name, index)
+
+    def stats(self):
+        """Returns numbers of loaded stores, loads and evictions (of stores) and expirations (of data of all stores)"""
+        with self._lock:
+            stores = [loaded.store for loaded in self._stores.values() if loaded.store is not None]
+        expirations = self.expirations + sum(store.stats()['expirations'] for store in stores)
+        return {'loaded': len(self._stores), 'loads': self.loads, 'evictions': self.evictions, 'expirations': expirations}
+
+    def close(self):
+        """Closes stores of all namespaces (they're loaded again if they're used later)."""
+        with self._lock:
+            stores, self._stores = list(self._stores.values()), OrderedDict()
+        for loaded in stores:
+            loaded.ready.wait()
+            if loaded.store is not None:
+                loaded.store.close()
+                self.expirations += loaded.store.stats()['expirations']
+
+
+def store_namespaces(path=None, durability=DURABILITY_SYNC, **kwargs):
+    """
+    Returns StoreNamespaces of durable stores (evictable) kept in subdirectories of NAMESPACES_DIR of given directory,
+    or of in memory ones if it's not given.
+    """
+    if path is None:
+        return StoreNamespaces(lambda namespace: SortedInMemoryStore(), **kwargs)
+    return StoreNamespaces(lambda namespace: LogStore(os.path.join(path, NAMESPACES_DIR, namespace), durability),
+                           lambda namespace: os.path.isdir(os.path.join(path, NAMESPACES_DIR, namespace)),
+                           evictable=True, **kwargs)
+
+
+class StoreShards():
+    """
+    Namespaces partitioned by hash of namespace among given shards (StoreNamespaces or proxies of ones kept by other
+    processes), so every namespace is kept by one of them and load of many namespaces is spread among all of them.
+    """
+
+    blocking = True
+
+    def __init__(self, shards):
+        self.shards = shards
+
+    def shard(self, namespace):
+        """Returns shard that keeps given namespace (hash is stable, so it's the same one in every process)"""
+        return self.shards[zlib.crc32(namespace.encode('utf-8')) % len(self.shards)]
+
+    def call(self, namespace, operation, *args, **kwargs):
+        return self.shard(namespace).call(namespace, operation, *args, **kwargs)
+
+    def create_index(self, name, index):
+        for shard in self.shards:
+            shard.create_index(name, index)
+
+    def stats(self):
+        """Returns statistics of all shards (summed up)"""
+        stats = [shard.stats() for shard in self.shards]
+        return {stat: sum(shard_stats[stat] for shard_stats in stats) for stat in stats[0]}
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+
+class NamespacedStore(Store):
+    """
+    Store of many namespaces - every operation is made on store of current namespace (current_namespace context
+    variable, set i.e. while request is handled) kept by given namespaces (StoreNamespaces or StoreShards), or on
+    default store if there is no current namespace.
+    """
+
+    def __init__(self, default, namespaces):
+        self.default, self.namespaces = default, namespaces
+        self.blocking = getattr(default, 'blocking', True) or namespaces.blocking
+
+    def create_index(self, name, index):
+        """Adds given secondary index of store data under given name to default store and stores of all namespaces."""
+        self.default.create_index(name, index)
+        self.namespaces.create_index(name, index)
+
+    def stats(self):
+        """Returns statistics of default store and stores of all namespaces (summed up)."""
+        return {'expirations': self.default.stats()['expirations'] + self.namespaces.stats()['expirations']}
+
+    def close(self):
+        """Closes default store and stores of all namespaces."""
+        self.default.close()
+        self.namespaces.close()
+
+
+def _namespaced(operation):
+    """Returns method of NamespacedStore that makes given operation on store of current namespace"""
+    def method(self, *args, **kwargs):
+        namespace = current_namespace.get()
+        if namespace is None:
+            return getattr(self.default, operation)(*args, **kwargs)
+        return self.namespaces.call(namespace, operation, *args, **kwargs)
+    method.__name__, method.__doc__ = operation, getattr(Store, operation).__doc__
+    return method
+
+
+for _operation in STORE_OPERATIONS:
+    setattr(NamespacedStore, _operation, _namespaced(_operation))
+
+
+class StoreManager(BaseManager):
+    """
+    Manager of store shared by many processes. The store is kept by manager's server process and other processes use
+    it via proxies (Store method of connected manager returns one), so all of them see the same data.
+    """
+
+
+_shared_stores = {}
+
+
+def _shared_store(path=None, durability=DURABILITY_SYNC):
+    """Returns store kept by manager's server process (created by the first call, durable one if path is given)"""
+    if path not in _shared_stores:
+        # manager's server handles every connection in a separate thread (both stores are thread-safe)
+        _shared_stores[path] = LogStore(path, durability) if path else SortedInMemoryStore()
+    return _shared_stores[path]
+
+
+_shared_namespaces = {}
+
+
+def _shared_store_namespaces(path=None, durability=DURABILITY_SYNC):
+    """Returns StoreNamespaces kept by manager's server process (created by the first call, see store_namespaces)"""
+    if path not in _shared_namespaces:
+        _shared_namespaces[path] = store_namespaces(path, durability)
+    return _shared_namespaces[path]
+
+
+StoreManager.register('Store', callable=_shared_store, exposed=STORE_OPERATIONS + ('create_index', 'stats', 'close'))
+StoreManager.register('Namespaces', callable=_shared_store_namespaces, exposed=('call', 'create_index', 'stats', 'close'))
@@ -17,13 +17,38 @@ Tests that ensures that all endpoints work correctly in sense of API and expecte
 # OTHER DEALINGS IN THE SOFTWARE.
 # -----------------------------------------------------------------------------------------------------------------------
 
+import asyncio
+import gzip
+import json
+import socket
+import sys
+import threading
+import time
+from http.client import HTTPConnection
+
 import hug
 import pytest
 
-from falcon import HTTP_200, HTTP_201, HTTP_204, HTTP_400, HTTP_404
+from falcon import testing
+from falcon import HTTP_200, HTTP_201, HTTP_204, HTTP_207, HTTP_304, HTTP_400, HTTP_404, HTTP_409, HTTP_410, HTTP_412, HTTP_429
+from falcon import HTTP_503
 
+import metrics
+import validators
+from admission import AdmissionControl, HIGH, LOW, MAX_IN_FLIGHT
+from api import create_invitee, retrieve_invitees, update_invitee, delete_invitee, EXISTING_INVITEE_ERROR
+from api import invitee_responses, list_responses
+from asgi import admission_control as asgi_admission_control, application as asgi_application, _Request as Request
+from cache import ResponseCache
+from compression import CODINGS, CompressedStream, compressed_responses, negotiate
 from models import Invitee
-from app import hug_api as api
+from outputs import JSONArrayStream
+from server import _WorkerServer
+from stores import HashIndex, LogStore, SortedInMemoryStore, StoreInUse, StoreUniqueConflict, StoreVersionConflict
+from stores import ABSENT, DURABILITY_NONE, ExpiryIndex, StoreChangesExpired, StoreNamespaces, StoreShards, current_namespace
+from stores import store_namespaces
+from app import admission_control, hug_api as api
+
 
 # This list is not in alphabetical order, so reverse it before comparing
 # with responses as list of invitees in responses is sorted.
@@ -36,14 +61,22 @@ test_invitee = [
 class APITest():
     api_url = '/invitation'
 
+    @classmethod
+    @pytest.fixture
+    def prepare_empty_db(cls):
+        db = Invitee._storage.default
+        db.__init__()  # make db empty ;)
+        yield
+        db.__init__()  # rollback all changes ;)
+
     @classmethod
     @pytest.fixture
     def prepare_db_with_test_invitee_0(cls):
         # creates invite record in "db"
-        db = Invitee._storage
+        db = Invitee._storage.default
         db.__init__()  # make db empty ;)
         key = test_invitee[0]['invitee']
-        db.set(key, test_invitee[0])
+        db.set(key, Invitee._as_record(test_invitee[0]))  # (as model keeps it)
         yield
         db.__init__()  # rollback all changes ;)
 
@@ -51,17 +84,39 @@ class APITest():
     @pytest.fixture
     def prepare_db_with_both_test_invitees(cls):
         # creates invite record in "db"
-        db = Invitee._storage
+        db = Invitee._storage.default
         db.__init__()  # make db empty ;)
         data = test_invitee[0]
         key = data['invitee']
-        db.set(key, data)
+        db.set(key, Invitee._as_record(data))  # (as model keeps it)
         data = test_invitee[1]
         key = data['invitee']
-        db.set(key, data)
+        db.set(key, Invitee._as_record(data))
         yield
         db.__init__()  # rollback all changes ;)
 
+    @classmethod
+    @pytest.fixture
+    def rate_limited(cls):
+        controls = admission_control, asgi_admission_control
+        limits = [{'rate': control.rate, 'burst': control.burst} for control in controls]
+        for control in controls:
+            control.configure(rate=0.5, burst=2)  # 2 requests at once, then one per 2 seconds
+            control.rejected = dict.fromkeys(control.rejected, 0)
+        yield
+        for control, control_limits in zip(controls, limits):
+            control.configure(**control_limits)
+
+    @classmethod
+    @pytest.fixture
+    def unique_emails(cls):
+        indexes = Invitee.indexes
+        Invitee.indexes = dict(indexes, email=HashIndex(unique=True))  # (as models.py suggests)
+        Invitee._create_indexes()
+        yield
+        Invitee.indexes = indexes
+        Invitee._create_indexes()
+
     def assert_invitee(self, invitee_res, invitee_exp=None):
         """Validates if invitee_res (from response) has proper form and same data as optional invite_exp (expected)"""
         assert type(invitee_res) == dict
@@ -100,6 +155,15 @@ class TestInviteeRetrieve(APITest):
         assert res.status == HTTP_200
         self.assert_invitee(res.data, test_invitee[0])
 
+    @pytest.mark.usefixtures('prepare_db_with_both_test_invitees')
+    def test_invitees_retrieve_direct_calls(self):
+        invitees = sorted(test_invitee, key=lambda data: data['invitee'])
+        for _ in range(2):  # (data is returned as it is, not responses cached by HTTP routes)
+            assert retrieve_invitees(Invitee.lookup(test_invitee[0]['invitee'])) == test_invitee[0]
+            assert retrieve_invitees() == invitees
+            assert retrieve_invitees(limit=1) == invitees[:1]
+            assert retrieve_invitees(email=test_invitee[1]['email']) == [test_invitee[1]]
+
     @pytest.mark.usefixtures('prepare_db_with_both_test_invitees')
     def test_invitee_retrieve_ok_multiple_invitees(self):
         for ti in test_invitee:
@@ -128,15 +192,82 @@ class TestInviteeRetrieve(APITest):
         for tr, ti in zip(res.data, reversed(test_invitee)):
             self.assert_invitee(tr, ti)
 
+    @pytest.mark.usefixtures('prepare_db_with_test_invitee_0')
+    def test_invitees_list_retrieve_ok_streamed(self):
+        for i in range(1, 1200):  # more than single chunk of stream
+            Invitee(invitee='{} ({})'.format(test_invitee[1]['invitee'], i), email=test_invitee[1]['email']).save()
+        res = hug.test.get(api, self.api_url, None)
+        assert res.status == HTTP_200
+        assert 'content-length' not in res.headers_dict
+        assert res.data == Invitee(invitee=None).get()
+
+    @pytest.mark.usefixtures('prepare_empty_db')
+    def test_invitees_list_retrieve_ok_empty_db(self):
+        res = hug.test.get(api, self.api_url, None)
+        assert res.status == HTTP_200
+        assert res.data == []
+
+    def test_invitees_list_stream_chunks(self):
+        stream = JSONArrayStream(iter(test_invitee), chunk_size=1)
+        chunks = list(iter(stream.read, b''))
+        assert len(chunks) == len(test_invitee) + 1
+        assert json.loads(b''.join(chunks).decode('utf8')) == test_invitee
+
+    @pytest.mark.usefixtures('prepare_db_with_both_test_invitees')
+    def test_invitees_list_retrieve_ok_paginated(self):
+        test_data = {'limit': 1}
+        for ti in reversed(test_invitee):
+            res = hug.test.get(api, self.api_url, test_data)
+            assert res.status == HTTP_200
+            assert len(res.data) == 1
+            self.assert_invitee(res.data[0], ti)
+            test_data['after'] = res.headers_dict.get('x-next-cursor')
+        assert test_data['after'] is None  # no more pages
+
+    @pytest.mark.usefixtures('prepare_db_with_both_test_invitees')
+    def test_invitees_list_retrieve_nok_bad_pagination(self):
+        for test_data, field in [({'limit': 0}, 'limit'), ({'limit': 'a'}, 'limit'), ({'after': '!@#'}, 'after')]:
+            res = hug.test.get(api, self.api_url, test_data)
+            assert res.status == HTTP_400
+            self.assert_error(res, [field])
+
+    @pytest.mark.usefixtures('prepare_db_with_both_test_invitees')
+    def test_invitees_list_retrieve_by_email(self):
+        res = hug.test.get(api, self.api_url, {'email': test_invitee[1]['email']})
+        assert res.status == HTTP_200
+        assert res.data == [test_invitee[1]]
+        hug.test.put(api, self.api_url, {'invitee': test_invitee[0]['invitee'], 'email': test_invitee[1]['email']})
+        res = hug.test.get(api, self.api_url, {'email': test_invitee[1]['email'], 'limit': 1})
+        assert res.data == [test_invitee[1]]
+        res = hug.test.get(api, self.api_url, {'email': test_invitee[1]['email'],
+                                               'after': res.headers_dict['x-next-cursor']})
+        assert res.data == [dict(test_invitee[0], email=test_invitee[1]['email'])]
+        res = hug.test.get(api, self.api_url, {'email': test_invitee[0]['email']})
+        assert res.data == []  # index follows updates
+        res = hug.test.get(api, self.api_url, {'email': 'bad email'})
+        assert res.status == HTTP_400
+        self.assert_error(res, ['email'])
+
+    @pytest.mark.usefixtures('prepare_db_with_both_test_invitees')
+    def test_invitees_list_retrieve_by_prefix(self):
+        for test_data, expected in [({'prefix': 'J'}, test_invitee[::-1]), ({'prefix': 'Jo'}, test_invitee[:1]),
+                                    ({'prefix': 'J', 'limit': 1}, test_invitee[1:]), ({'prefix': 'x'}, []),
+                                    ({'prefix': 'J', 'email': test_invitee[0]['email']}, test_invitee[:1])]:
+            res = hug.test.get(api, self.api_url, test_data)
+            assert res.status == HTTP_200
+            assert res.data == expected
+
 
 class TestInviteeCreation(APITest):
     """Tests for POST /invitation endpoint"""
 
+    @pytest.mark.usefixtures('prepare_empty_db')
     def test_invitee_creation_ok(self):
         test_data = test_invitee[0].copy()
         res = hug.test.post(api, self.api_url, test_data)
         assert res.status == HTTP_201
         self.assert_invitee(res.data, test_invitee[0])
+        assert Invitee._storage.get(test_data['invitee']) == (test_data['invitee'], test_data['email'])  # compact record
 
     @pytest.mark.usefixtures('prepare_db_with_test_invitee_0')
     def test_invitee_creation_nok_invitee_already_exists(self):
@@ -145,6 +276,13 @@ class TestInviteeCreation(APITest):
         assert res.status == HTTP_400
         self.assert_error(res, ['invitee'])
 
+    @pytest.mark.usefixtures('prepare_db_with_test_invitee_0')
+    def test_invitee_creation_nok_created_meanwhile(self):
+        data = dict(test_invitee[0], email='other@email.me')
+        assert create_invitee(data['invitee'], data['email']) == {  # called directly (not validated, as by CLI)
+            'errors': {'invitee': EXISTING_INVITEE_ERROR.format(data['invitee'])}}
+        assert Invitee(invitee=data['invitee']).get() == test_invitee[0]
+
     def test_invitee_creation_nok_mising_fields(self):
         for field in ['invitee', 'email']:
             test_data = test_invitee[0].copy()
@@ -182,6 +320,14 @@ class TestInviteeUpdate(APITest):
             assert res.status == HTTP_400
             self.assert_error(res, ['email'])
 
+    @pytest.mark.usefixtures('prepare_db_with_both_test_invitees', 'unique_emails')
+    def test_invitee_update_nok_email_taken(self):
+        test_data = dict(test_invitee[1], email=test_invitee[0]['email'])
+        res = hug.test.put(api, self.api_url, test_data)
+        assert res.status == HTTP_409
+        self.assert_error(res, ['email'])
+        assert update_invitee(test_data['invitee'], test_data['email']) == res.data  # called directly (without response)
+
 
 class TestInviteeDelete(APITest):
     """Tests for DELETE /invitation endpoint"""
@@ -206,3 +352,1081 @@ class TestInviteeDelete(APITest):
         res = hug.test.delete(api, self.api_url, test_data)
         assert res.status == HTTP_400
         self.assert_error(res, ['invitee'])
+
+
+class TestInviteeConditional(APITest):
+    """Tests for conditional requests (ETag response header with If-None-Match / If-Match request headers)"""
+
+    @pytest.mark.usefixtures('prepare_db_with_test_invitee_0')
+    def test_invitees_not_modified(self):
+        res = hug.test.get(api, self.api_url)
+        etag = res.headers_dict['ETag']
+        res = hug.test.get(api, self.api_url, headers={'If-None-Match': etag})
+        assert (res.status, res.headers_dict['ETag']) == (HTTP_304, etag)
+        res = hug.test.get(api, self.api_url, {'limit': 1}, headers={'If-None-Match': 'W/"1", ' + etag})
+        assert res.status == HTTP_304
+        hug.test.post(api, self.api_url, test_invitee[1])
+        res = hug.test.get(api, self.api_url, headers={'If-None-Match': etag})
+        assert res.status == HTTP_200
+        assert len(res.data) == 2
+        assert res.headers_dict['ETag'] != etag
+
+    @pytest.mark.usefixtures('prepare_db_with_both_test_invitees')
+    def test_invitee_not_modified(self):
+        res = hug.test.get(api, self.api_url, {'invitee': test_invitee[0]['invitee']})
+        etag = res.headers_dict['ETag']
+        hug.test.put(api, self.api_url, dict(test_invitee[1], email='new@email.me'))  # other invitee changed
+        res = hug.test.get(api, self.api_url, {'invitee': test_invitee[0]['invitee']}, headers={'If-None-Match': etag})
+        assert res.status == HTTP_304
+
+    @pytest.mark.usefixtures('prepare_db_with_test_invitee_0')
+    def test_invitee_update_if_match(self):
+        etag = hug.test.get(api, self.api_url, {'invitee': test_invitee[0]['invitee']}).headers_dict['ETag']
+        test_data = dict(test_invitee[0], email='first@email.me')
+        res = hug.test.put(api, self.api_url, test_data, headers={'If-Match': etag})
+        assert res.status == HTTP_200
+        self.assert_invitee(res.data, test_data)
+        assert res.headers_dict['ETag'] != etag
+        res = hug.test.put(api, self.api_url, dict(test_data, email='second@email.me'), headers={'If-Match': etag})
+        assert res.status == HTTP_412
+        self.assert_error(res, ['invitee'])
+        assert Invitee(invitee=test_data['invitee']).get() == test_data
+        res = hug.test.delete(api, self.api_url, {'invitee': test_data['invitee']}, headers={'If-Match': etag})
+        assert res.status == HTTP_412
+        res = hug.test.delete(api, self.api_url, {'invitee': test_data['invitee']}, headers={'If-Match': '*'})
+        assert res.status == HTTP_204
+
+    @pytest.mark.usefixtures('prepare_db_with_test_invitee_0')
+    def test_invitee_conditional_direct_calls(self):
+        name = test_invitee[0]['invitee']  # (handlers take invitees as validator looks them up)
+        etag = hug.test.get(api, self.api_url, {'invitee': name}).headers_dict['ETag']
+        assert retrieve_invitees(Invitee.lookup(name), request=Request({b'if-none-match': etag.encode()})) is None
+        res = hug.test.delete(api, self.api_url, {'invitee': name}, headers={'If-Match': '"1"'})
+        assert delete_invitee(Invitee.lookup(name), request=Request({b'if-match': b'"1"'})) == res.data  # without response
+        assert Invitee(invitee=name).get() == test_invitee[0]
+
+    def test_store_versions(self):
+        store = SortedInMemoryStore()
+        version = store.version()
+        assert store.set('a', 1) == version + 1
+        assert store.set_many({'b': 2, 'c': 3}) == version + 2
+        assert store.get_versioned('b') == (2, version + 2)
+        with pytest.raises(StoreVersionConflict):
+            store.set('a', 4, version=version)
+        with pytest.raises(StoreVersionConflict):
+            store.set('d', 4, version=version)
+        assert store.set('a', 4, version=version + 1) == version + 3
+        store.delete('d')  # nothing deleted, so nothing changed
+        assert store.version() == version + 3
+        with pytest.raises(StoreVersionConflict):
+            store.delete('a', version=version + 1)
+        store.delete('a', version=version + 3)
+        assert (store.exists('a'), store.version()) == (False, version + 4)
+        assert SortedInMemoryStore().version() > version  # versions are not reused by new store (i.e. after restart)
+
+
+class TestInviteeDeltaSync(APITest):
+    """Tests for GET /invitation?since=<version> (changes of the list made after given version)"""
+
+    @pytest.mark.usefixtures('prepare_db_with_both_test_invitees')
+    def test_invitees_changes(self):
+        since = hug.test.get(api, self.api_url).headers_dict['etag'].strip('"')
+        created, updated = {'invitee': 'New One', 'email': 'new@email.me'}, dict(test_invitee[0], email='new@email.me')
+        hug.test.post(api, self.api_url, created)
+        hug.test.put(api, self.api_url, updated)
+        hug.test.put(api, self.api_url, dict(created, email='newer@email.me'))
+        hug.test.delete(api, self.api_url, {'invitee': test_invitee[1]['invitee']})
+        res = hug.test.get(api, self.api_url, {'since': since})
+        assert res.status == HTTP_200
+        assert res.data['changes'] == [updated, dict(created, email='newer@email.me'),
+                                       {'invitee': test_invitee[1]['invitee'], 'deleted': True}]
+        assert '"{}"'.format(res.data['version']) == hug.test.get(api, self.api_url).headers_dict['etag']
+        assert hug.test.get(api, self.api_url, {'since': res.data['version']}).data['changes'] == []
+        Invitee._storage.default.changelog_size = 1
+        hug.test.delete(api, self.api_url, {'invitee': created['invitee']})
+        hug.test.post(api, self.api_url, created)  # so changes since the last sync are dropped from change log
+        synced = res.data['version']
+        res = hug.test.get(api, self.api_url, {'since': synced})
+        assert res.status == HTTP_410
+        self.assert_error(res, ['since'])
+        assert retrieve_invitees(since=synced) == res.data  # called directly (without response)
+        res = hug.test.get(api, self.api_url, {'since': -1})
+        assert res.status == HTTP_400
+        self.assert_error(res, ['since'])
+
+    def test_store_changes(self):
+        store = SortedInMemoryStore(changelog_size=3)
+        version = store.version()
+        store.set('a', 1)
+        store.set_many({'b': 2, 'c': 3})
+        store.delete_many(['a', 'd'])
+        assert store.changes(version) == (version + 3, [('b', 2), ('c', 3), ('a', None)])
+        assert store.changes(version + 2) == (version + 3, [('a', None)])
+        store.set('b', 4)
+        store.delete('c')  # change log is twice as long as kept, so the oldest changes are dropped
+        assert store.changes(version + 2) == (version + 5, [('a', None), ('b', 4), ('c', None)])
+        with pytest.raises(StoreChangesExpired):
+            store.changes(version + 1)
+        with pytest.raises(StoreChangesExpired):
+            SortedInMemoryStore().changes(version)  # changes made before store creation (i.e. restart) are unknown
+
+
+class TestInviteeExpiry(APITest):
+    """Tests for invitations with expiry time (ones that have expired are deleted)"""
+
+    @pytest.mark.usefixtures('prepare_db_with_test_invitee_0')
+    def test_invitee_expiry(self):
+        since = hug.test.get(api, self.api_url).headers_dict['etag'].strip('"')
+        res = hug.test.post(api, self.api_url, dict(test_invitee[1], ttl=0.2))
+        assert res.status == HTTP_201
+        assert res.data['expires'] == pytest.approx(time.time() + 0.2, abs=0.1)
+        expires = time.time() + 60
+        res = hug.test.put(api, self.api_url, dict(test_invitee[0], expires=expires))
+        assert res.data == dict(test_invitee[0], expires=expires)
+        assert [data['invitee'] for data in hug.test.get(api, self.api_url).data] == [test_invitee[1]['invitee'],
+                                                                                      test_invitee[0]['invitee']]
+        time.sleep(0.3)
+        self.assert_error(hug.test.get(api, self.api_url, {'invitee': test_invitee[1]['invitee']}), ['invitee'])
+        assert hug.test.get(api, self.api_url).data == [dict(test_invitee[0], expires=expires)]
+        assert hug.test.get(api, self.api_url, {'since': since}).data['changes'] == [
+            dict(test_invitee[0], expires=expires), {'invitee': test_invitee[1]['invitee'], 'deleted': True}]
+        assert Invitee.stats() == {'expirations': 1}
+        assert 'invitation_storage_expirations_total{model="invitee"} 1' in hug.test.get(api, '/metrics').data.splitlines()
+        res = hug.test.put(api, self.api_url, dict(test_invitee[0], email='new@email.me'))
+        assert res.data == dict(test_invitee[0], email='new@email.me', expires=expires)  # kept unless it's given
+
+    @pytest.mark.usefixtures('prepare_empty_db')
+    def test_invitee_expiry_nok_wrong_values(self):
+        for values in [{'ttl': 0}, {'ttl': 'soon'}, {'expires': time.time() - 1}, {'expires': 'tomorrow'}]:
+            res = hug.test.post(api, self.api_url, dict(test_invitee[0], **values))
+            assert res.status == HTTP_400
+            self.assert_error(res, list(values))
+        res = hug.test.post(api, self.api_url + '/_bulk', [dict(test_invitee[0], expires=1), dict(test_invitee[1], expires='')])
+        assert [result['status'] for result in res.data] == [400, 201]
+        assert res.data[1]['data'] == test_invitee[1]  # empty expiry time is not set
+
+    def test_expiry_index(self):
+        store = SortedInMemoryStore()
+        store.create_index('expires', ExpiryIndex().bound('expires', 1))
+        now = time.time()
+        store.set_many({'a': ('a', now - 1), 'b': ('b', now + 60), 'c': ('c',), 'd': ('d', now - 2)})
+        assert store.keys() == ['b', 'c']  # expired ones are deleted before they're read
+        assert store.stats() == {'expirations': 2}
+        assert store.find('expires', now + 60) == ['b']
+        for _ in range(1000):
+            store.set('b', ('b', now + 60))
+        assert len(store._expiry._heap) < 200  # entries of changed data are dropped
+        store.set('b', ('b', now - 1))
+        assert not store.exists('b')
+        assert store.stats() == {'expirations': 3}
+
+    def test_expiry_of_durable_store(self, tmpdir):
+        db = LogStore(str(tmpdir))
+        db.create_index('expires', ExpiryIndex(field='expires', position=1))
+        db.set_many({'a': ('a', time.time() + 0.1), 'b': ('b', time.time() + 60)})
+        time.sleep(0.2)
+        assert db.keys() == ['b']
+        db.close()
+        db = LogStore(str(tmpdir))
+        assert db.keys() == ['b']  # deletion of expired data is logged too
+        db.close()
+
+
+class TestMetrics(APITest):
+    """Tests for /metrics endpoint (latency histograms of request processing stages)"""
+
+    @classmethod
+    @pytest.fixture
+    def sample_every_request(cls):
+        sample_every, metrics.sample_every = metrics.sample_every, 1
+        metrics.reset()
+        yield
+        metrics.sample_every = sample_every
+
+    @pytest.mark.usefixtures('prepare_db_with_test_invitee_0', 'sample_every_request')
+    def test_metrics(self):
+        hug.test.post(api, self.api_url, test_invitee[1])
+        hug.test.post(api, self.api_url, test_invitee[1])  # already exists
+        res = hug.test.get(api, '/metrics')
+        assert res.status == HTTP_200
+        assert res.headers_dict['content-type'].startswith('text/plain; version=0.0.4')
+        lines = res.data.splitlines()
+        for line in ['invitation_stage_seconds_count{stage="route",name="POST /invitation"} 2',
+                     'invitation_stage_errors_total{stage="route",name="POST /invitation"} 1',
+                     'invitation_stage_seconds_count{stage="validation",name="nonexisting_invitee"} 2',
+                     'invitation_stage_errors_total{stage="validation",name="nonexisting_invitee"} 1',
+                     'invitation_stage_seconds_count{stage="validation",name="email"} 2',
+                     'invitation_stage_seconds_count{stage="model",name="Model.lookup"} 2',
+                     'invitation_stage_seconds_count{stage="model",name="Model.create"} 1',
+                     'invitation_stage_seconds_count{stage="serialization",name="json"} 2',
+                     'invitation_stage_seconds_bucket{stage="route",name="POST /invitation",le="+Inf"} 2']:
+            assert line in lines
+        assert not any('GET /metrics' in line for line in lines)  # request to /metrics has not finished yet
+
+    @pytest.mark.usefixtures('sample_every_request')
+    def test_metrics_sampling(self):
+        metrics.sample_every = 4
+        for i in range(8):
+            hug.test.get(api, '/bad-api-url')
+        assert metrics.histogram('route', 'GET unmatched').calls == 2
+        assert metrics.histogram('route', 'GET unmatched').errors == 2
+        metrics.enabled = False
+        try:
+            for i in range(8):
+                hug.test.get(api, '/bad-api-url')
+        finally:
+            metrics.enabled = True
+        assert metrics.histogram('route', 'GET unmatched').calls == 2
+
+    @pytest.mark.usefixtures('sample_every_request')
+    def test_metrics_sampling_per_request(self):
+        stage = metrics.timed('test', 'stage')(lambda: None)
+        started = metrics.request_started()
+        thread = threading.Thread(target=stage)  # i.e. stage of other request handled meanwhile (not sampled)
+        thread.start()
+        thread.join()
+        stage()
+        metrics.request_finished('GET', None, '200 OK', started)
+        stage()
+        assert metrics.histogram('test', 'stage').calls == 1  # only the one of sampled request
+
+
+class TestResponseCache(APITest):
+    """Tests for cache of encoded responses"""
+
+    def test_response_cache(self):
+        cache = ResponseCache('test', max_entries=2, max_bytes=6, max_entry_bytes=5)
+        assert cache.put('a', 1, b'aa') == b'aa'
+        assert (cache.get('a', 1), cache.get('a', 2)) == ((b'aa', ()), None)  # entry is valid for its version only
+        cache.put('b', 1, b'bb', (('X-Header', '1'),))
+        cache.get('a', 1)
+        cache.put('c', 1, b'cc')  # more than max entries, so least recently used one is evicted
+        assert (cache.get('a', 1), cache.get('b', 1)) == ((b'aa', ()), None)
+        cache.put('d', 1, b'dddddd')  # larger than max entry size, so not cached
+        cache.put('d', 1, b'ddddd')  # more than max entries and then max bytes, so both others are evicted
+        assert (cache.get('a', 1), cache.get('c', 1), cache.get('d', 1)) == (None, None, (b'ddddd', ()))
+        cache.invalidate(['d'])
+        assert cache.stats() == {'entries': 0, 'bytes': 0, 'hits': 4, 'misses': 4, 'hit_rate': 0.5, 'evictions': 3,
+                                 'invalidations': 1}
+
+    @pytest.mark.usefixtures('prepare_db_with_both_test_invitees')
+    def test_invitee_cached(self):
+        hits = invitee_responses.hits
+        for _ in range(3):
+            res = hug.test.get(api, self.api_url, {'invitee': test_invitee[0]['invitee']})
+            assert res.data == test_invitee[0]
+        assert invitee_responses.hits == hits + 2
+        updated = dict(test_invitee[0], email='new@email.me')
+        hug.test.put(api, self.api_url, updated)
+        assert hug.test.get(api, self.api_url, {'invitee': updated['invitee']}).data == updated  # invalidated by write
+        # not through model (i.e. by other process)
+        Invitee._storage.set(test_invitee[0]['invitee'], Invitee._as_record(test_invitee[0]))
+        assert hug.test.get(api, self.api_url, {'invitee': updated['invitee']}).data == test_invitee[0]
+
+    @pytest.mark.usefixtures('prepare_db_with_both_test_invitees')
+    def test_invitees_page_cached(self):
+        hits = list_responses.hits
+        for _ in range(2):
+            res = hug.test.get(api, self.api_url, {'limit': 1})
+            assert (res.data, res.headers_dict.get('x-next-cursor') is not None) == ([test_invitee[1]], True)
+        assert list_responses.hits == hits + 1
+        hug.test.delete(api, self.api_url, {'invitee': test_invitee[1]['invitee']})
+        assert hug.test.get(api, self.api_url, {'limit': 1}).data == [test_invitee[0]]
+        assert 'invitation_response_cache_hits_total{cache="list"} ' in hug.test.get(api, '/metrics').data
+
+
+class TestCompression(APITest):
+    """Tests for compression of responses negotiated by Accept-Encoding header"""
+
+    @pytest.fixture
+    def prepare_db_with_many_invitees(self, prepare_empty_db):
+        for i in range(100):
+            Invitee(invitee='Invitee ({:03})'.format(i), email='invitee{}@email.me'.format(i)).save()
+
+    def test_negotiate(self):
+        best = CODINGS[0]
+        for accept_encoding, coding in [(None, None), ('', None), ('identity', None), ('gzip, deflate', 'gzip'),
+                                        ('br;q=0.5, gzip', 'gzip'), ('*', best), ('gzip;q=0, *;q=0.1', CODINGS[0]
+                                                                                  if best != 'gzip' else None)]:
+            assert negotiate(accept_encoding) == coding
+
+    def test_compressed_stream(self):
+        completed = []
+        stream = CompressedStream(JSONArrayStream(iter(test_invitee * 100), chunk_size=10), 'gzip', completed.append)
+        body = b''.join(iter(stream.read, b''))
+        assert json.loads(gzip.decompress(body).decode('utf8')) == test_invitee * 100
+        assert completed == [body]
+        stream = CompressedStream(JSONArrayStream(iter(test_invitee * 100)), 'gzip', completed.append, max_size=10)
+        assert b''.join(iter(stream.read, b'')) and len(completed) == 1  # too large to be kept
+
+    @pytest.mark.usefixtures('prepare_db_with_many_invitees')
+    def test_compressed_responses(self):
+        client = testing.TestClient(api.http.server())
+        expected = Invitee(invitee=None).get()
+        hits = compressed_responses.hits
+        for content_length in [False, True]:  # compressed while streamed, then served from cache
+            res = client.simulate_get(self.api_url, headers={'Accept-Encoding': 'gzip'})
+            assert (res.headers['content-encoding'], res.headers['vary']) == ('gzip', 'Accept-Encoding')
+            assert ('content-length' in res.headers) == content_length
+            assert json.loads(gzip.decompress(res.content).decode('utf8')) == expected
+        assert compressed_responses.hits == hits + 1
+        Invitee(invitee=expected[0]['invitee'], email='new@email.me').save()  # new version, so compressed again
+        res = client.simulate_get(self.api_url, headers={'Accept-Encoding': 'gzip'})
+        assert json.loads(gzip.decompress(res.content).decode('utf8'))[0]['email'] == 'new@email.me'
+        res = client.simulate_get(self.api_url, query_string='limit=50', headers={'Accept-Encoding': 'gzip'})
+        assert len(json.loads(gzip.decompress(res.content).decode('utf8'))) == 50
+        res = client.simulate_get(self.api_url, params=expected[1], headers={'Accept-Encoding': 'gzip'})
+        assert 'content-encoding' not in res.headers  # too small to be compressed
+        assert res.json == expected[1]
+        res = client.simulate_get(self.api_url)
+        assert 'content-encoding' not in res.headers and res.json[0]['email'] == 'new@email.me'
+
+    @pytest.mark.usefixtures('prepare_db_with_many_invitees')
+    def test_compressed_responses_etags(self):
+        client = testing.TestClient(api.http.server())
+        etag = client.simulate_get(self.api_url).headers['etag']
+        coded_etag = client.simulate_get(self.api_url, headers={'Accept-Encoding': 'gzip'}).headers['etag']
+        assert coded_etag == etag[:-1] + '-gzip"'  # other representation, so other ETag
+        for if_none_match in [coded_etag, etag]:  # (falcon test client doesn't accept 304 with Content-Type, hug does)
+            res = hug.test.get(api, self.api_url, headers={'Accept-Encoding': 'gzip', 'If-None-Match': if_none_match})
+            assert (res.status, res.headers_dict['ETag']) == (HTTP_304, if_none_match)
+        invitee = Invitee(invitee=None).get()[0]
+        invitee_etag = hug.test.get(api, self.api_url, {'invitee': invitee['invitee']}).headers_dict['ETag']
+        res = hug.test.put(api, self.api_url, dict(invitee, email='new@email.me'),
+                           headers={'If-Match': invitee_etag[:-1] + '-gzip"'})
+        assert res.status == HTTP_200  # ETag of compressed response matches as well
+
+
+class TestAdmission(APITest):
+    """Tests for admission control of requests (rate limiting, in flight limit and priorities)"""
+
+    @pytest.mark.usefixtures('prepare_db_with_test_invitee_0', 'rate_limited')
+    def test_admission_rate_limiting(self):
+        query = 'invitee=John+Doe+%280%29'
+        for _ in range(2):
+            assert hug.test.get(api, self.api_url, query_string=query).status == HTTP_200
+        res = hug.test.get(api, self.api_url, query_string=query)
+        assert res.status == HTTP_429
+        assert res.headers_dict['retry-after'] == '2'
+        assert hug.test.get(api, '/metrics').status == HTTP_200  # monitoring is not rate limited
+        assert admission_control.stats()['rejected']['rate_limited'] == {'high': 1, 'low': 0}
+
+    def test_admission_limits(self):
+        control = AdmissionControl('test')
+        for _ in range(1000):  # clients are not rate limited by default
+            assert control.admit('client') is None
+            control.release()
+        control.configure(rate=1, burst=1)
+        assert control.admit('client') is None
+        assert control.admit('client') == (HTTP_429, 1)
+        with pytest.raises(TypeError):
+            control.configure(rte=1)
+        for limits in [{'rate': 0}, {'rate': -1}, {'burst': 0}]:  # no request would be admitted ever
+            with pytest.raises(ValueError):
+                control.configure(**limits)
+            with pytest.raises(ValueError):
+                AdmissionControl('test', **dict({'rate': 1}, **limits))
+        assert (control.rate, control.burst) == (1, 1)  # (limits are not changed by wrong ones)
+
+    def test_admission_priorities(self):
+        control = AdmissionControl('test', max_in_flight=2, low_share=0.5, max_wait=0.05, rate=None)
+        assert control.admit('client', LOW) is None
+        assert control.admit('client', LOW, wait=False) == (HTTP_503, 1)  # low priority ones may take half of slots
+        assert control.admit('client', HIGH) is None
+        assert control.admit('client', HIGH) == (HTTP_503, 1)  # waited for too long
+        control.max_wait, results = 5, []
+        waiting = [threading.Thread(target=lambda priority=priority: results.append((priority, control.admit('client', priority))))
+                   for priority in (LOW, HIGH)]
+        for queued, thread in enumerate(waiting, start=1):
+            thread.start()
+            while control.stats()['queued'] < queued:
+                time.sleep(0.001)
+        control.release()
+        waiting[1].join()
+        assert results == [(HIGH, None)]  # high priority one goes first, though it's come later
+        control.release()
+        control.release()
+        waiting[0].join()
+        assert results == [(HIGH, None), (LOW, None)]
+        control.max_queue = 0
+        assert control.admit('client', HIGH) is None
+        assert control.admit('client', HIGH) == (HTTP_503, 1)  # queue is full
+        assert control.stats() == {'in_flight': 2, 'queued': 0, 'admitted': {'high': 3, 'low': 2},
+                                   'rejected': {'rate_limited': {'high': 0, 'low': 0}, 'overloaded': {'high': 1, 'low': 1},
+                                                'timed_out': {'high': 1, 'low': 0}}}
+
+    @pytest.mark.usefixtures('prepare_db_with_both_test_invitees')
+    def test_admission_of_streamed_list(self):
+        admitted = admission_control.stats()['admitted']['low']
+        assert hug.test.get(api, self.api_url).data == list(reversed(test_invitee))
+        assert admission_control.stats()['admitted']['low'] == admitted + 1
+        assert admission_control.stats()['in_flight'] == 0  # released once the whole list is sent
+
+
+class CountingStore(SortedInMemoryStore):
+    """Store that counts reads and writes"""
+
+    def __init__(self):
+        super().__init__()
+        self.reads = self.writes = 0
+
+    def get(self, key):
+        self.reads += 1
+        return super().get(key)
+
+    def exists(self, key):
+        self.reads += 1
+        return super().exists(key)
+
+    def set(self, key, data, version=None):
+        self.writes += 1
+        return super().set(key, data, version)
+
+    def delete(self, key, version=None):
+        self.writes += 1
+        super().delete(key, version)
+
+
+class TestInviteeStorageAccess(APITest):
+    """Tests that every single invitee request reads and writes its record in storage once at most"""
+
+    @classmethod
+    @pytest.fixture
+    def counting_db(cls, monkeypatch):
+        monkeypatch.setattr(Invitee, '_storage', CountingStore())  # (model uses storage of Model class again afterwards)
+        Invitee._storage.set(test_invitee[0]['invitee'], Invitee._as_record(test_invitee[0]))
+        Invitee._storage.writes = 0
+        return Invitee._storage
+
+    def test_invitee_storage_access(self, counting_db):
+        test_data = [test_invitee[1].copy(), dict(test_invitee[0], email='new@email.me'), {'invitee': 'Jane Roe (1)'}]
+        for apicall, data, writes in [(hug.test.post, test_data[0], 1), (hug.test.put, test_data[1], 1),
+                                      (hug.test.get, test_data[2], 0), (hug.test.delete, test_data[2], 1)]:
+            counting_db.reads = counting_db.writes = 0
+            res = apicall(api, self.api_url, data)
+            assert res.status in (HTTP_200, HTTP_201, HTTP_204)
+            assert (counting_db.reads, counting_db.writes) == (1, writes)
+
+
+class TestInviteeBulk(APITest):
+    """Tests for /invitation/_bulk endpoint"""
+    api_url = APITest.api_url + '/_bulk'
+
+    @pytest.mark.usefixtures('prepare_db_with_test_invitee_0')
+    def test_invitees_bulk_creation(self):
+        test_data = [test_invitee[1], test_invitee[0], {'invitee': 'Bad Email', 'email': 'bad'}, test_invitee[1]]
+        res = hug.test.post(api, self.api_url, test_data)
+        assert res.status == HTTP_207
+        assert [item['status'] for item in res.data] == [201, 400, 400, 400]
+        self.assert_invitee(res.data[0]['data'], test_invitee[1])
+        assert 'invitee' in res.data[1]['errors']
+        assert 'email' in res.data[2]['errors']
+        assert 'invitee' in res.data[3]['errors']  # duplicated within batch
+        assert Invitee(invitee=None).get() == list(reversed(test_invitee))
+
+    @pytest.mark.usefixtures('prepare_empty_db')
+    def test_invitees_bulk_creation_ndjson(self):
+        test_data = '\n'.join(json.dumps(ti) for ti in test_invitee)
+        res = hug.test.post(api, self.api_url, test_data, headers={'content-type': 'application/x-ndjson'})
+        assert res.status == HTTP_207
+        assert [item['status'] for item in res.data] == [201, 201]
+        assert Invitee(invitee=None).get() == list(reversed(test_invitee))
+
+    @pytest.mark.usefixtures('prepare_db_with_test_invitee_0')
+    def test_invitees_bulk_retrieve(self):
+        res = hug.test.get(api, self.api_url, params={'invitee': [ti['invitee'] for ti in test_invitee]})
+        assert res.status == HTTP_207
+        assert [item['status'] for item in res.data] == [200, 400]
+        self.assert_invitee(res.data[0]['data'], test_invitee[0])
+
+    @pytest.mark.usefixtures('prepare_db_with_test_invitee_0')
+    def test_invitees_bulk_update(self):
+        test_data = [dict(ti, email='new@email.me') for ti in test_invitee]
+        res = hug.test.put(api, self.api_url, test_data)
+        assert res.status == HTTP_207
+        assert [item['status'] for item in res.data] == [200, 400]
+        assert Invitee(invitee=None).get() == [test_data[0]]
+
+    @pytest.mark.usefixtures('prepare_db_with_both_test_invitees')
+    def test_invitees_bulk_delete(self):
+        test_data = [{'invitee': test_invitee[0]['invitee']}, {'invitee': 'Nobody'}]
+        res = hug.test.delete(api, self.api_url, test_data)
+        assert res.status == HTTP_207
+        assert [item['status'] for item in res.data] == [200, 400]
+        assert res.data[0]['data'] == test_invitee[0]  # deleted data is returned, so it's not 204 No Content
+        assert Invitee(invitee=None).get() == [test_invitee[1]]
+
+    def validated_concurrently(self, monkeypatch, write):
+        """Makes bulk handlers validate batches just before given write is done (as if it's been done concurrently)"""
+        def validate_batch(*args, **kwargs):
+            validated = validators.validate_batch(*args, **kwargs)
+            write()
+            return validated
+        monkeypatch.setattr('api.validate_batch', validate_batch)
+
+    @pytest.mark.usefixtures('prepare_empty_db')
+    def test_invitees_bulk_creation_race(self, monkeypatch):
+        self.validated_concurrently(monkeypatch, lambda: Invitee(**dict(test_invitee[0], email='first@email.me')).create())
+        res = hug.test.post(api, self.api_url, test_invitee)
+        assert [item['status'] for item in res.data] == [400, 201]
+        assert 'invitee' in res.data[0]['errors']
+        assert Invitee(invitee=test_invitee[0]['invitee']).get()['email'] == 'first@email.me'  # not overwritten
+
+    @pytest.mark.usefixtures('prepare_db_with_both_test_invitees')
+    def test_invitees_bulk_update_race(self, monkeypatch):
+        expires = time.time() + 60
+
+        def write():
+            Invitee(invitee=test_invitee[0]['invitee'], expires=expires).save()
+            Invitee(invitee=test_invitee[1]['invitee']).delete()
+        self.validated_concurrently(monkeypatch, write)
+        res = hug.test.put(api, self.api_url, [dict(ti, email='new@email.me') for ti in test_invitee])
+        assert [item['status'] for item in res.data] == [200, 400]
+        assert res.data[0]['data'] == dict(test_invitee[0], email='new@email.me', expires=expires)  # change not lost
+        assert Invitee(invitee=None).get() == [res.data[0]['data']]
+
+    @pytest.mark.usefixtures('prepare_db_with_test_invitee_0', 'unique_emails')
+    def test_invitees_bulk_unique_conflicts(self, monkeypatch):
+        test_data = [{'invitee': 'A', 'email': 'a@email.me'}, {'invitee': 'B', 'email': 'a@email.me'},
+                     {'invitee': 'C', 'email': test_invitee[0]['email']}, {'invitee': 'D', 'email': 'd@email.me'}]
+        res = hug.test.post(api, self.api_url, test_data)
+        assert [item['status'] for item in res.data] == [201, 409, 409, 201]
+        assert 'email' in res.data[1]['errors'] and 'email' in res.data[2]['errors']
+        test_data = [dict(test_invitee[0], email='a@email.me'), {'invitee': 'A', 'email': test_invitee[0]['email']}]
+        res = hug.test.put(api, self.api_url, test_data)
+        assert [item['status'] for item in res.data] == [200, 200]  # emails may be swapped within a batch
+        self.validated_concurrently(monkeypatch, lambda: Invitee(invitee='E', email='e@email.me').create())
+        res = hug.test.post(api, self.api_url, [{'invitee': 'F', 'email': 'e@email.me'}, {'invitee': 'G', 'email': 'g@email.me'}])
+        assert [item['status'] for item in res.data] == [409, 201]  # email taken after validation
+        assert [data['invitee'] for data in Invitee(invitee=None).get()] == ['A', 'D', 'E', 'G', test_invitee[0]['invitee']]
+
+    def test_invitees_bulk_nok_bad_batch(self):
+        for test_data in [{'invitee': 'Not a list'}, [], ['not an object']]:
+            res = hug.test.post(api, self.api_url, test_data)
+            assert res.status == HTTP_400
+            self.assert_error(res, ['body'])
+
+
+class TestInviteeImportExport(APITest):
+    """Tests for import_invitees / export_invitees CLI commands"""
+
+    def durable_storage(self, path):
+        """Returns path of durable store (commands use it) with the same invitees as in memory one (fixtures set them)"""
+        store = LogStore(str(path), DURABILITY_NONE)
+        store.set_many(dict(Invitee._storage.default.items()))
+        store.close()
+        return str(path)
+
+    def stored_invitees(self, storage_path):
+        store = LogStore(storage_path, DURABILITY_NONE)
+        try:
+            return [Invitee._as_data(data) for _, data in store.items()]
+        finally:
+            store.close()
+
+    @pytest.mark.usefixtures('prepare_db_with_test_invitee_0')
+    def test_import_csv(self, tmpdir):
+        source = tmpdir.join('invitees.csv')
+        source.write('invitee,email\n'
+                     'Jane Roe (1),jane@email.me\n'
+                     '"Multiline\nEmail",bad\nemail\n'  # quoted value spans two lines, unquoted one doesn't
+                     '"Multiline\nEmail","bad\nemail"\n'
+                     '{},john@email.me\n'
+                     'Jane Roe (1),jane@email.me\n'
+                     'Too,many,values\n'.format(test_invitee[0]['invitee']))
+        storage_path = self.durable_storage(tmpdir.join('storage'))
+        result = hug.test.cli('import_invitees', str(source), api=api, batch_size=2, processes='1',  # as given in command line
+                              storage_path=storage_path, durability='none')
+        assert (result['imported'], result['rejected'], result['rejects']) == (1, 6, str(source) + '.rejects')
+        rejects = [json.loads(line) for line in tmpdir.join('invitees.csv.rejects').readlines()]
+        assert [(reject['line'], list(reject['errors'])) for reject in rejects] == [
+            (3, ['email']), (5, ['row']), (6, ['email']), (9, ['invitee']), (10, ['invitee']), (11, ['row'])]
+        assert rejects[2]['row'] == ['Multiline\nEmail', 'bad\nemail']  # numbers of first lines of multiline rows
+        assert self.stored_invitees(storage_path) == list(reversed(test_invitee))
+
+    @pytest.mark.usefixtures('prepare_empty_db')
+    def test_import_ndjson_in_parallel(self, tmpdir):
+        source = tmpdir.join('invitees.ndjson')
+        source.write('\n'.join([json.dumps(test_invitee[0]), '{"invitee": "Broken', '', '["not an object"]',
+                                json.dumps({'invitee': 'No Email'}), json.dumps(test_invitee[1])]))
+        storage_path = str(tmpdir.join('storage'))
+        result = hug.test.cli('import_invitees', str(source), api=api, batch_size='1', processes=2, storage_path=storage_path)
+        assert (result['imported'], result['rejected']) == (2, 3)
+        rejects = [json.loads(line) for line in tmpdir.join('invitees.ndjson.rejects').readlines()]
+        assert [(reject['line'], list(reject['errors'])) for reject in rejects] == [(2, ['row']), (4, ['row']), (5, ['email'])]
+        assert self.stored_invitees(storage_path) == list(reversed(test_invitee))
+
+    @pytest.mark.usefixtures('prepare_db_with_test_invitee_0', 'unique_emails')
+    def test_import_unique_conflicts(self, tmpdir):
+        source = tmpdir.join('invitees.csv')
+        source.write('invitee,email\nA,a@email.me\nB,a@email.me\nC,{}\n'.format(test_invitee[0]['email']))
+        result = hug.test.cli('import_invitees', str(source), api=api, storage_path=self.durable_storage(tmpdir.join('storage')))
+        assert (result['imported'], result['rejected']) == (1, 2)
+        rejects = [json.loads(line) for line in tmpdir.join('invitees.csv.rejects').readlines()]
+        assert [(reject['line'], list(reject['errors'])) for reject in rejects] == [(3, ['email']), (4, ['email'])]
+
+    @pytest.mark.usefixtures('prepare_db_with_both_test_invitees')
+    def test_export_and_import_again(self, tmpdir):
+        storage_path = self.durable_storage(tmpdir.join('storage'))
+        for file_format in ['csv', 'ndjson']:
+            target = tmpdir.join('invitees.' + file_format)
+            assert hug.test.cli('export_invitees', str(target), api=api, batch_size='1', storage_path=storage_path)['exported'] == 2
+            if file_format == 'csv':
+                assert target.readlines() == ['invitee,email,expires\n'] + ['{invitee},{email},\n'.format(**ti)
+                                                                    for ti in reversed(test_invitee)]
+            imported_path = str(tmpdir.join('imported-' + file_format))
+            assert hug.test.cli('import_invitees', str(target), api=api, storage_path=imported_path)['imported'] == 2
+            assert not tmpdir.join('invitees.{}.rejects'.format(file_format)).check()
+            assert self.stored_invitees(imported_path) == list(reversed(test_invitee))
+
+    def test_storage_path_required(self, tmpdir):
+        source = tmpdir.join('invitees.ndjson')
+        source.write(json.dumps(test_invitee[0]))
+        for command, path in [('import_invitees', source), ('export_invitees', tmpdir.join('exported.ndjson'))]:
+            assert 'storage_path' in str(hug.test.cli(command, str(path), api=api))  # (error the command fails with)
+
+
+class TestInviteeNamespaces(APITest):
+    """Tests for /events/<id>/invitation endpoints (every event has its own invitees list)"""
+
+    @pytest.fixture
+    def prepare_empty_namespaces(self, prepare_empty_db):
+        Invitee._storage.namespaces.close()  # in memory ones are dropped, so they're empty when used again
+        yield
+        Invitee._storage.namespaces.close()
+        current_namespace.set(None)
+
+    @pytest.mark.usefixtures('prepare_empty_namespaces')
+    def test_events_invitees(self):
+        events = {'a': [test_invitee[0]],
+                  'b': [test_invitee[1], dict(test_invitee[0], email='other@email.me')]}  # the same invitee in both
+        for event, invitees in events.items():
+            for data in invitees:
+                assert hug.test.post(api, '/events/{}{}'.format(event, self.api_url), data).status == HTTP_201
+        for event, invitees in events.items():
+            url = '/events/{}{}'.format(event, self.api_url)
+            expected = sorted(invitees, key=lambda data: data['invitee'])
+            assert hug.test.get(api, url).data == expected
+            assert hug.test.get(api, url, {'limit': 10}).data == expected
+            assert hug.test.get(api, url, {'invitee': test_invitee[0]['invitee']}).data == invitees[-1]
+            res = hug.test.get(api, url + '/_bulk', {'invitee': test_invitee[1]['invitee']})
+            assert res.data[0]['status'] == (200 if event == 'b' else 400)
+        assert hug.test.get(api, self.api_url).data == []  # default list is not affected
+
+    @pytest.mark.usefixtures('prepare_empty_namespaces')
+    def test_events_invitees_of_unknown_event(self):
+        url = '/events/unknown' + self.api_url
+        assert hug.test.get(api, url).data == []
+        assert hug.test.get(api, url, {'invitee': test_invitee[0]['invitee']}).status == HTTP_400
+        assert hug.test.delete(api, url, {'invitee': test_invitee[0]['invitee']}).status == HTTP_400  # nothing to delete
+        assert Invitee._storage.namespaces.stats()['loaded'] == 0  # reads don't create stores
+
+    @pytest.mark.usefixtures('prepare_empty_namespaces')
+    def test_events_invitees_nok_wrong_event(self):
+        for event in ['.hidden', 'a' * 65, '-a']:
+            res = hug.test.get(api, '/events/{}{}'.format(event, self.api_url))
+            assert res.status == HTTP_404
+
+    def test_namespaces_eviction(self, tmpdir):
+        namespaces = StoreNamespaces(lambda namespace: LogStore(str(tmpdir.join(namespace)), DURABILITY_NONE),
+                                     lambda namespace: tmpdir.join(namespace).check(), evictable=True, max_loaded=2)
+        namespaces.create_index('email', HashIndex(field='email', position=1))
+        for namespace in ['a', 'b', 'c']:
+            namespaces.call(namespace, 'set', namespace, (namespace, namespace + '@email.me'))
+        assert namespaces.stats() == {'loaded': 2, 'loads': 3, 'evictions': 1, 'expirations': 0}  # least recently used is evicted
+        assert namespaces.call('a', 'find', 'email', 'a@email.me') == ['a']  # loaded again, along with indexes
+        assert namespaces.stats() == {'loaded': 2, 'loads': 4, 'evictions': 2, 'expirations': 0}
+        idle = StoreNamespaces(lambda namespace: SortedInMemoryStore(), evictable=True, idle_timeout=0)
+        idle.call('a', 'set', 'a', ('a', 'a@email.me'))
+        assert idle.stats() == {'loaded': 0, 'loads': 1, 'evictions': 1, 'expirations': 0}
+        namespaces.close()
+
+    def test_namespaces_created_by_writes(self, tmpdir):
+        for namespaces in [store_namespaces(), store_namespaces(str(tmpdir), DURABILITY_NONE)]:
+            namespaces.create_index('email', HashIndex(field='email', position=1))
+            for namespace in ['probe-{}'.format(number) for number in range(50)]:
+                assert namespaces.call(namespace, 'keys') == []
+                assert namespaces.call(namespace, 'find', 'email', 'a@email.me') == []
+                version = namespaces.call(namespace, 'version')
+                assert namespaces.call(namespace, 'changes', version) == (version, [])
+                namespaces.call(namespace, 'delete_many', ['a'])
+            assert namespaces.stats()['loaded'] == 0
+            assert not tmpdir.listdir()  # nothing is written to disk either
+            namespaces.call('a', 'set', 'a', ('a', 'a@email.me'))
+            assert namespaces.call('a', 'find', 'email', 'a@email.me') == ['a']
+            assert namespaces.stats()['loads'] == 1
+            namespaces.close()
+
+    def test_namespaces_sharding(self):
+        shards = StoreShards([StoreNamespaces(lambda namespace: SortedInMemoryStore()) for _ in range(4)])
+        namespaces = ['event-{}'.format(number) for number in range(20)]
+        for namespace in namespaces:
+            shards.call(namespace, 'set', 'key', namespace)
+        assert [shards.call(namespace, 'get', 'key') for namespace in namespaces] == namespaces
+        assert all(shard.stats()['loaded'] for shard in shards.shards)  # all shards keep some of them
+        assert sum(shard.stats()['loaded'] for shard in shards.shards) == len(namespaces)
+
+
+class TestLogStore():
+    """Tests for durable storage (recovering data from snapshot and log)"""
+
+    def test_log_store_recovery(self, tmpdir):
+        db = LogStore(str(tmpdir))
+        db.set_many({ti['invitee']: ti for ti in test_invitee})
+        db.delete(test_invitee[0]['invitee'])
+        db.close()
+        db = LogStore(str(tmpdir))
+        assert db.keys() == [test_invitee[1]['invitee']]
+        assert db.get(test_invitee[1]['invitee']) == test_invitee[1]
+        db.close()
+
+    def test_log_store_recovery_after_compaction(self, tmpdir):
+        db = LogStore(str(tmpdir), durability=DURABILITY_NONE)
+        db.set(test_invitee[0]['invitee'], test_invitee[0])
+        db.compact()
+        db.set(test_invitee[1]['invitee'], test_invitee[1])
+        db.close()
+        with open(str(tmpdir.join(LogStore.LOG_FILE)), 'a') as log:
+            log.write('["set", "Torn')  # write interrupted by crash
+        db = LogStore(str(tmpdir))
+        assert db.keys() == [ti['invitee'] for ti in reversed(test_invitee)]
+        db.close()
+
+    def test_log_store_recovery_after_failed_compactions(self, tmpdir, monkeypatch):
+        def fail(snapshot):
+            raise OSError('No space left on device')
+        db = LogStore(str(tmpdir), durability=DURABILITY_NONE)
+        monkeypatch.setattr(db, '_write_snapshot', fail)
+        for invitee in test_invitee:
+            db.set(invitee['invitee'], invitee)
+            with pytest.raises(OSError):
+                db.compact()
+        db.close()
+        db = LogStore(str(tmpdir))
+        assert db.keys() == [ti['invitee'] for ti in reversed(test_invitee)]  # writes of both logs are kept
+        db.close()
+        assert not tmpdir.join(LogStore.OLD_LOG_FILE).exists()  # recovery has finished compaction
+
+    def test_log_store_lock(self, tmpdir):
+        db = LogStore(str(tmpdir))
+        with pytest.raises(StoreInUse):
+            LogStore(str(tmpdir))  # (the same way as by another process)
+        db.close()
+        LogStore(str(tmpdir)).close()  # unlocked once it's closed
+
+    def test_log_store_recovery_in_background(self, tmpdir, monkeypatch):
+        monkeypatch.setattr('stores.SNAPSHOT_CHUNK', 2)
+        db = LogStore(str(tmpdir), durability=DURABILITY_NONE)
+        db.set_many({key: (key, key + '@email.me') for key in 'abcde'})
+        db.compact()
+        db.close()
+        db = LogStore(str(tmpdir))
+        db.create_index('email', HashIndex(field='email', position=1))  # (built along with recovered data)
+        assert db.find('email', 'c@email.me') == ['c']
+        assert db.keys() == list('abcde')
+        db.close()
+        tmpdir.join(LogStore.SNAPSHOT_FILE).write_binary(b'corrupted')
+        db = LogStore(str(tmpdir))
+        with pytest.raises(Exception):
+            db.get('a')  # recovery has failed
+        db.close()
+
+
+class TestStoreIndexes():
+    """Tests for store secondary indexes and prefix queries"""
+
+    def test_hash_index(self):
+        store = SortedInMemoryStore()
+        store.set('a', ('a', 'x@email.me'))
+        store.create_index('email', HashIndex().bound('email', 1))
+        store.set_many({'b': ('b', 'x@email.me'), 'c': ('c', 'y@email.me')})
+        assert store.find('email', 'x@email.me') == ['a', 'b']
+        store.set('a', ('a', 'y@email.me'))
+        store.delete_many(['c'])
+        assert (store.find('email', 'x@email.me'), store.find('email', 'y@email.me')) == (['b'], ['a'])
+        store.delete('b')
+        assert store.find('email', 'x@email.me') == []
+        store.__init__()
+        assert store.find('email', 'y@email.me') == []  # cleared store keeps its (empty) indexes
+
+    def test_unique_hash_index(self):
+        store = SortedInMemoryStore()
+        store.create_index('email', HashIndex(unique=True).bound('email', 1))
+        store.set_many({'a': ('a', 'x'), 'b': ('b', 'y')})
+        for write in [lambda: store.set('c', ('c', 'x')), lambda: store.set_many({'c': ('c', 'z'), 'd': ('d', 'z')}),
+                      lambda: store.set_many({'a': ('a', 'z'), 'c': ('c', 'y')})]:
+            with pytest.raises(StoreUniqueConflict):
+                write()
+        assert store.keys() == ['a', 'b']  # rejected writes haven't changed anything
+        store.set_many({'a': ('a', 'y'), 'b': ('b', 'x')})  # values may be swapped within one write
+        assert store.find('email', 'x') == ['b']
+
+    def test_keys_prefix(self):
+        store = SortedInMemoryStore()
+        store.set_many(dict.fromkeys(['a', 'ab', 'abc', 'abd', 'b', 'a\U0010ffff', 'a\U0010ffffb']))
+        assert store.keys(prefix='ab') == ['ab', 'abc', 'abd']
+        assert store.keys(prefix='ab', after='abc', limit=5) == ['abd']
+        assert store.keys(prefix='a\U0010ffff') == ['a\U0010ffff', 'a\U0010ffffb']
+
+
+class TestStoreConcurrency(APITest):
+    """Stress tests of stores (and models) used by many threads at once"""
+    threads = 8
+
+    @pytest.fixture
+    def contention(self):
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)  # switch threads as often as possible, so they contend
+        yield
+        sys.setswitchinterval(switch_interval)
+
+    @pytest.fixture(params=['memory', 'log'])
+    def store(self, request, tmpdir, contention):
+        store = SortedInMemoryStore() if request.param == 'memory' else LogStore(str(tmpdir), DURABILITY_NONE)
+        yield store
+        store.close()
+
+    def run_threads(self, target, *args):
+        threads = [threading.Thread(target=target, args=(number,) + args) for number in range(self.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def test_create_if_absent(self, store):
+        created = []
+
+        def create(number):
+            for key in range(200):
+                try:
+                    store.set(str(key), number, version=ABSENT)
+                    created.append(key)
+                except StoreVersionConflict:
+                    pass
+        self.run_threads(create)
+        assert sorted(created) == list(range(200))  # every key created exactly once
+        assert store.keys() == sorted(map(str, range(200)))
+
+    def test_conditional_set_many(self, store):
+        version = store.set('a', 1)
+        with pytest.raises(StoreVersionConflict) as conflict:
+            store.set_many({'a': 2, 'b': 2, 'c': 2}, {'a': ABSENT, 'b': ABSENT, 'c': version})
+        assert sorted(conflict.value.args) == ['a', 'c']
+        assert store.items() == [('a', 1)]  # nothing has been written
+        store.set_many({'a': 2, 'b': 2}, {'a': version, 'b': ABSENT})
+        assert store.items() == [('a', 2), ('b', 2)]
+        created = []
+
+        def create(number):
+            for key in range(0, 200, 2):
+                try:
+                    store.set_many({str(key): number, str(key + 1): number}, dict.fromkeys([str(key), str(key + 1)], ABSENT))
+                    created.append(key)
+                except StoreVersionConflict:
+                    pass
+        self.run_threads(create)
+        assert sorted(created) == list(range(0, 200, 2))  # every pair created exactly once
+
+    def test_compare_and_set(self, store):
+        store.set_many(dict.fromkeys('abc', 0))
+
+        def increment(number):
+            for i in range(300):
+                key = 'abc'[i % 3]
+                while True:
+                    value, version = store.get_versioned(key)
+                    try:
+                        store.set(key, value + 1, version=version)
+                        break
+                    except StoreVersionConflict:
+                        pass
+        self.run_threads(increment)
+        assert [store.get(key) for key in 'abc'] == [self.threads * 100] * 3  # no update lost
+
+    def test_snapshot_reads(self, store):
+        done, errors = threading.Event(), []
+
+        def write(number):
+            for i in range(500):
+                # every write keeps sum of all values zero, while keys are added and removed
+                store.set_many({'a{}'.format(number): i, 'b{}'.format(number): -i, 'x{}-{}'.format(number, i): 0})
+                store.delete_many(['x{}-{}'.format(number, i - 1)])
+
+        def read():
+            while not done.is_set():
+                try:
+                    items = store.items()
+                except Exception as error:  # i.e. key of the page deleted before its data has been read
+                    errors.append(error)
+                    continue
+                keys = [key for key, _ in items]
+                if sum(value for _, value in items) != 0 or keys != sorted(set(keys)):
+                    errors.append(items)
+        readers = [threading.Thread(target=read) for _ in range(2)]
+        for reader in readers:
+            reader.start()
+        self.run_threads(write)
+        done.set()
+        for reader in readers:
+            reader.join()
+        assert errors == []
+        assert len(store.keys()) == self.threads * 3
+
+    def test_unique_index(self, store):
+        store.create_index('email', HashIndex(unique=True).bound('email', 1))
+        created = []
+
+        def create(number):
+            for key in range(50):
+                try:
+                    store.set('{}-{}'.format(key, number), (number, 'email{}'.format(key)))
+                    created.append(key)
+                except StoreUniqueConflict:
+                    pass
+        self.run_threads(create)
+        assert sorted(created) == list(range(50))
+
+    @pytest.mark.usefixtures('prepare_empty_db', 'contention')
+    def test_invitee_concurrent_creation(self):
+        statuses = []
+
+        def create(number):
+            for key in range(20):
+                res = hug.test.post(api, self.api_url, {'invitee': str(key), 'email': '{}@email.me'.format(number)})
+                statuses.append(res.status)
+        self.run_threads(create)
+        assert statuses.count(HTTP_201) == 20
+        assert statuses.count(HTTP_400) == 20 * (self.threads - 1)
+
+
+class TestServer(APITest):
+    """Tests for production webserver (keep-alive connections and chunked responses)"""
+
+    @classmethod
+    @pytest.fixture
+    def worker_server(cls):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(8)
+        listener.setblocking(False)
+        server = _WorkerServer(listener, api.http.server(), threads=2)
+        thread = threading.Thread(target=server.serve)
+        thread.start()
+        yield server
+        server.stopping = True
+        thread.join()
+        listener.close()
+
+    @pytest.mark.usefixtures('prepare_empty_db')
+    def test_server_keep_alive_and_chunked_response(self, worker_server):
+        connection = HTTPConnection(*worker_server.server_address[:2])
+        for ti in test_invitee:
+            connection.request('POST', self.api_url, json.dumps(ti), {'Content-Type': 'application/json'})
+            res = connection.getresponse()
+            assert (res.status, json.loads(res.read().decode('utf8'))) == (201, ti)
+        sock = connection.sock
+        connection.request('GET', self.api_url)
+        res = connection.getresponse()
+        assert res.status == 200
+        assert res.getheader('Transfer-Encoding') == 'chunked'
+        assert json.loads(res.read().decode('utf8')) == list(reversed(test_invitee))
+        assert connection.sock is sock  # all requests sent via single connection
+        connection.close()
+
+    @pytest.mark.usefixtures('prepare_db_with_test_invitee_0')
+    def test_server_keep_alive_responses_not_delayed(self, worker_server):
+        connection = HTTPConnection(*worker_server.server_address[:2])
+        latencies = []
+        for method in ['GET'] * 9 + ['DELETE']:  # (response without body is sent as well)
+            started = time.perf_counter()
+            connection.request(method, self.api_url + '?invitee=John+Doe+%280%29')
+            res = connection.getresponse()
+            res.read()
+            latencies.append(time.perf_counter() - started)
+        assert res.status == 204
+        assert sorted(latencies)[5] < 0.02  # not stalled by Nagle's algorithm and delayed ACK (~40ms per request)
+        connection.close()
+
+
+class TestASGI(APITest):
+    """Tests for ASGI application (serving the same handlers on asyncio event loop)"""
+
+    def call(self, method, url, query=b'', body=b'', headers=()):
+        """Calls ASGI application, returns response status, headers and body"""
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {'type': 'http', 'method': method, 'path': url, 'query_string': query,
+                 'headers': [(b'content-type', b'application/json')] + list(headers)}
+        asyncio.run(asgi_application(scope, receive, send))
+        body = b''.join(message.get('body', b'') for message in messages[1:])
+        return messages[0]['status'], dict(messages[0]['headers']), body
+
+    @pytest.mark.usefixtures('prepare_empty_db')
+    def test_asgi_invitees(self):
+        for ti in test_invitee:
+            status, headers, body = self.call('POST', self.api_url, body=json.dumps(ti).encode('utf8'))
+            assert (status, json.loads(body.decode('utf8'))) == (201, ti)
+        status, headers, body = self.call('GET', self.api_url)
+        assert (status, json.loads(body.decode('utf8'))) == (200, list(reversed(test_invitee)))
+        status, headers, body = self.call('GET', self.api_url, query=b'limit=1')
+        assert b'x-next-cursor' in headers
+        status, headers, body = self.call('GET', self.api_url, headers=[(b'if-none-match', headers[b'etag'])])
+        assert (status, body) == (304, b'')
+        status, headers, body = self.call('DELETE', self.api_url, query=b'invitee=Jane+Roe+%281%29')
+        assert (status, body) == (204, b'')
+
+    @pytest.mark.usefixtures('prepare_empty_db')
+    def test_asgi_compression(self):
+        Invitee.save_many(Invitee(invitee='Invitee ({:03})'.format(i), email='invitee@email.me') for i in range(100))
+        for query in [b'', b'limit=50']:
+            status, headers, body = self.call('GET', self.api_url, query=query, headers=[(b'accept-encoding', b'gzip')])
+            assert (headers[b'content-encoding'], headers[b'vary']) == (b'gzip', b'Accept-Encoding')
+            assert json.loads(gzip.decompress(body).decode('utf8')) == Invitee.select(limit=100 if not query else 50)[0]
+
+    @pytest.mark.usefixtures('prepare_empty_db')
+    def test_asgi_events_invitees(self):
+        Invitee._storage.namespaces.close()
+        url = '/events/asgi' + self.api_url
+        assert self.call('POST', url, body=json.dumps(test_invitee[0]).encode('utf-8'))[0] == 201
+        assert json.loads(self.call('GET', url)[2].decode('utf8')) == [test_invitee[0]]
+        assert json.loads(self.call('GET', self.api_url)[2].decode('utf8')) == []
+        assert self.call('GET', '/events/.asgi' + self.api_url)[0] == 404
+        Invitee._storage.namespaces.close()
+
+    @pytest.mark.usefixtures('prepare_db_with_test_invitee_0', 'rate_limited')
+    def test_asgi_admission(self):
+        for expected in [200, 200, 429]:
+            status, headers, body = self.call('GET', self.api_url, query=b'invitee=John+Doe+%280%29')
+            assert status == expected
+        assert headers[b'retry-after'] == b'2'
+        assert json.loads(body.decode('utf8'))['title'] == HTTP_429
+        assert asgi_admission_control.stats()['in_flight'] == 0
+        assert asgi_admission_control.stats()['rejected']['rate_limited'] == {'high': 1, 'low': 0}
+
+    @pytest.mark.usefixtures('prepare_db_with_test_invitee_0')
+    def test_asgi_admission_limit(self):
+        for _ in range(MAX_IN_FLIGHT):  # as many requests as WSGI worker handles at once are in flight already
+            assert asgi_admission_control.admit('client', wait=False) is None
+        try:
+            assert self.call('GET', self.api_url, query=b'invitee=John+Doe+%280%29')[0] == 200
+        finally:
+            for _ in range(MAX_IN_FLIGHT):
+                asgi_admission_control.release()
+
+    @pytest.mark.usefixtures('prepare_db_with_test_invitee_0')
+    def test_asgi_invitees_nok(self):
+        status, headers, body = self.call('POST', self.api_url, body=json.dumps(test_invitee[0]).encode('utf8'))
+        assert status == 400
+        assert 'invitee' in json.loads(body.decode('utf8'))['errors']
+        status, headers, body = self.call('PUT', self.api_url, body=b'{"invitee": ')
+        assert status == 400
+        status, headers, body = self.call('GET', '/bad-api-url')
+        assert status == 404
+        status, headers, body = self.call('GET', '/metrics')
+        assert (status, headers[b'content-type'][:10]) == (200, b'text/plain')
@@ -17,9 +17,24 @@ Validators definitions used by request handlers (to ensure data provided by requ
 # OTHER DEALINGS IN THE SOFTWARE.
 # -----------------------------------------------------------------------------------------------------------------------
 
+import time
+from base64 import b64decode, urlsafe_b64encode
+from binascii import Error as Base64Error
+
 import hug
 
+from metrics import timed, timed_type
 from models import Invitee
+from stores import USED_VALUE_ERROR
+
+
+MAX_PAGE_SIZE = 1000
+MAX_BATCH_SIZE = 10000
+
+EXISTING_INVITEE_ERROR = "Invitee '{}' already exists, probably you tried create it instead update."
+MISSING_INVITEE_ERROR = "Invitee '{}' not found, probably not invited yet or removed."
+DUPLICATED_INVITEE_ERROR = "Invitee '{}' is given more than once in a batch."
+MISSING_FIELD_ERROR = "Required parameter '{}' not supplied"
 
 
 @hug.type(extend=hug.types.text)
@@ -31,24 +46,171 @@ def _email_validator(value):
     return value
 
 
+@hug.type(extend=hug.types.float_number)
+def _expiry_validator(value):
+    """Expiry time of invitation (UNIX timestamp)."""
+    if value <= time.time():
+        raise ValueError('Expiry time must be in the future, got: {}'.format(value))
+    return value
+
+
+@hug.type(extend=hug.types.float_number)
+def _ttl_validator(value):
+    """Time to live of invitation (in seconds)."""
+    if value <= 0:
+        raise ValueError('Time to live must be positive, got: {}'.format(value))
+    return value
+
+
 @hug.type(extend=hug.types.text)
 def _nonexisting_invitee_validator(value):
     """New invitee name."""
-    if Invitee(invitee=value).get():
-        raise ValueError("Invitee '{}' already exists, probably you tried create it instead update.".format(value))
-    return value
+    invitee = Invitee.lookup(value)  # passed to handler, so its model won't look it up again
+    if invitee.data is not None:
+        raise ValueError(EXISTING_INVITEE_ERROR.format(value))
+    return invitee
 
 
 @hug.type(extend=hug.types.text)
 def _exisitng_invitee_validator(value):
     """Existing invitee name."""
-    if not Invitee(invitee=value).get():
-        raise ValueError("Invitee '{}' not found, probably not invited yet or removed.".format(value))
+    invitee = Invitee.lookup(value)  # passed to handler, so its model won't look it up again
+    if invitee.data is None:
+        raise ValueError(MISSING_INVITEE_ERROR.format(value))
+    return invitee
+
+
+@hug.type(extend=hug.types.number)
+def _page_size_validator(value):
+    """Number of invitees per page."""
+    if not 1 <= value <= MAX_PAGE_SIZE:
+        raise ValueError('Page size must be between 1 and {}, got: {}'.format(MAX_PAGE_SIZE, value))
+    return value
+
+
+@hug.type(extend=hug.types.text)
+def _cursor_validator(value):
+    """Opaque cursor (from X-Next-Cursor header) pointing where the next page starts."""
+    try:
+        return b64decode(value.encode('ascii'), altchars=b'-_', validate=True).decode('utf-8')
+    except (Base64Error, UnicodeError):
+        raise ValueError('Incorrect cursor: {}'.format(value))
+
+
+@hug.type(extend=hug.types.number)
+def _version_validator(value):
+    """Version of invitees list (from ETag header or version of changes)."""
+    if value < 0:
+        raise ValueError('Version must not be negative, got: {}'.format(value))
     return value
 
 
+def cursor_of(key):
+    """Returns opaque cursor for given key (counterpart of cursor validator)"""
+    return urlsafe_b64encode(key.encode('utf-8')).decode('ascii')
+
+
+@hug.type(extend=hug.types.Type)
+def _batch_validator(value):
+    """List of invitees data objects (JSON array or NDJSON)."""
+    if not isinstance(value, list) or not all(isinstance(item, dict) for item in value):
+        raise ValueError('Batch must be a list of invitees data objects')
+    if not 1 <= len(value) <= MAX_BATCH_SIZE:
+        raise ValueError('Batch size must be between 1 and {}, got: {}'.format(MAX_BATCH_SIZE, len(value)))
+    return value
+
+
+_FIELD_TYPES = {'invitee': hug.types.text, 'email': _email_validator, 'expires': _expiry_validator}
+
+
+def _validate_batch_item(item, fields):
+    """
+    Validates (and converts) given fields of single batch item, returns dict of errors (field: error message). Optional
+    fields that are not set (or empty, i.e. in CSV) are dropped, so they're not changed by update.
+    """
+    errors = {}
+    for field in fields:
+        value = item.get(field)
+        if field in Invitee.optional and value in (None, ''):
+            item.pop(field, None)
+        elif value is None:
+            errors[field] = MISSING_FIELD_ERROR.format(field)
+        else:
+            try:
+                item[field] = _FIELD_TYPES[field](value)
+            except ValueError as exception:
+                errors[field] = str(exception)
+    return errors
+
+
+@timed('validation', 'validate_fields')
+def validate_fields(batch, fields):
+    """
+    Validates (and converts) given fields of every batch item without looking invitees up (so it may be done by other
+    process than the one that owns the storage), returns errors (dict of field: error message) for every item.
+    """
+    return [_validate_batch_item(item, fields) for item in batch]
+
+
+class ConflictErrors(dict):
+    """Errors of batch item which data conflicts with data of other invitee (i.e. by unique index), dict as others"""
+
+
+def _check_unique(batch, errors, field):
+    """
+    Adds errors of valid batch items that have value of given field (with unique index) used by other invitee - one
+    that is in system (unless batch changes its value) or the earlier one of the batch.
+    """
+    values = {item['invitee']: item.get(field) for item, item_errors in zip(batch, errors) if not item_errors}
+    taken = {}
+    for index, (item, item_errors) in enumerate(zip(batch, errors)):
+        value = item.get(field)
+        if item_errors or value is None:
+            continue
+        owners = {data['invitee'] for data in Invitee.find(field, value)}
+        if taken.get(value, item['invitee']) != item['invitee'] or any(
+                owner != item['invitee'] and values.get(owner, value) == value for owner in owners):
+            errors[index] = ConflictErrors({field: USED_VALUE_ERROR.format(field, value)})
+        else:
+            taken[value] = item['invitee']
+
+
+@timed('validation', 'validate_batch')
+def validate_batch(batch, fields, existing):
+    """
+    Validates batch of invitees data in a single pass (looking up every invitee once). Every item must provide proper
+    values of given fields and its invitee has to exist in system (or not, depending on existing flag) and has to be
+    unique within the batch. Values of fields with unique index can't be used by other invitees (ConflictErrors).
+    :return: Tuple of errors (dict of field: error message, empty for valid item) for every item and dict of invitees
+             looked up during validation (Keys that carry their data and version, to be passed to model, by name).
+    """
+    errors = validate_fields(batch, fields)
+    found = Invitee.lookup_many({item['invitee'] for item, item_errors in zip(batch, errors) if 'invitee' not in item_errors})
+    seen = set()
+    for item, item_errors in zip(batch, errors):
+        if 'invitee' in item_errors:
+            continue
+        if (found[item['invitee']].data is not None) != existing:
+            item_errors['invitee'] = (MISSING_INVITEE_ERROR if existing else EXISTING_INVITEE_ERROR).format(item['invitee'])
+        elif item['invitee'] in seen:
+            item_errors['invitee'] = DUPLICATED_INVITEE_ERROR.format(item['invitee'])
+        seen.add(item['invitee'])
+    for field, index in Invitee.indexes.items():
+        if index.unique:
+            _check_unique(batch, errors, field)
+    return errors, found
+
+
 # exported validators
 
-nonexisting_invitee = _nonexisting_invitee_validator
-existing_invitee = _exisitng_invitee_validator
-email = _email_validator
+nonexisting_invitee = timed_type('nonexisting_invitee')(_nonexisting_invitee_validator)
+existing_invitee = timed_type('existing_invitee')(_exisitng_invitee_validator)
+email = timed_type('email')(_email_validator)
+expiry = timed_type('expiry')(_expiry_validator)
+ttl = timed_type('ttl')(_ttl_validator)
+page_size = timed_type('page_size')(_page_size_validator)
+cursor = timed_type('cursor')(_cursor_validator)
+list_version = timed_type('list_version')(_version_validator)
+batch = timed_type('batch')(_batch_validator)
+invitees = hug.types.multiple
+prefix = hug.types.text
@@ -8,4 +8,4 @@ fi
 # ok, found so run app bootstrap
 APP_ROOT_PATH=$(python3 -c "import os; print(os.path.realpath('$(dirname $0)'))")
 cd "${APP_ROOT_PATH}/app/"
-python3 __main__.py
+python3 __main__.py "$@"